@@ -0,0 +1,330 @@
+import argparse
+import asyncio
+import collections
+import importlib.util
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import httpx
+from telegram import Bot, Update
+from telegram.request import BaseRequest
+
+# Нагрузочный стенд: настоящие хендлеры бота на синтетических Update, Bot API
+# и PayPal подменены заглушками в процессе, DB.json заранее заполнен N
+# пользователями. Каждый прогон — в своем временном каталоге со свежей копией
+# модуля бота, системные команды идут через DryRunRunner. Итог — p50/p99 и
+# пропускная способность по командам (по умолчанию еще и в bench_output.txt):
+#   python bench.py --users 1000 10000 100000 --engine journal --rate 200
+
+BOT_FILE = Path(__file__).with_name("bot(fixed).py")
+COMMANDS = ("start", "subscribe", "status", "pay", "check_payment", "check_expiry")
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+
+def load_bot():
+    spec = importlib.util.spec_from_file_location("bot", BOT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeTelegramRequest(BaseRequest):
+    # Bot API в процессе: любой метод успешен, sendMessage/editMessageText
+    # возвращают сообщение. Ответы с "⚠️" — ошибки, которые хендлер поймал сам
+    def __init__(self, codec, latency: float = 0.0):
+        self.codec = codec
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.errors = 0
+        self.message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        api_method = url.rsplit("/", 1)[1]
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method in ("sendMessage", "editMessageText"):
+            text = str(params.get("text", ""))
+            if text.startswith("⚠️"):
+                self.errors += 1
+            self.message_id += 1
+            result = {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": text
+            }
+        else:
+            result = True
+        return 200, self.codec.dumps({"ok": True, "result": result})
+
+
+class FakePayPal:
+    # PayPal REST через httpx.MockTransport: заказ сразу одобрен, capture
+    # всегда успешен. Задержка ответа — --paypal-latency
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.orders = {}
+        self.calls = collections.Counter()
+
+    async def __call__(self, request: httpx.Request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        path = request.url.path
+        if path == "/v1/oauth2/token":
+            self.calls["token"] += 1
+            return httpx.Response(200, json={"access_token": "bench", "expires_in": 3600})
+        if path == "/v2/checkout/orders" and request.method == "POST":
+            self.calls["create_order"] += 1
+            order_id = f"BENCH{len(self.orders) + 1}"
+            self.orders[order_id] = "APPROVED"
+            return httpx.Response(201, json={
+                "id": order_id,
+                "status": "CREATED",
+                "links": [{"rel": "approve", "href": f"https://paypal.test/approve/{order_id}"}]
+            })
+        order_id = path.split("/")[4] if path.startswith("/v2/checkout/orders/") else None
+        if order_id not in self.orders:
+            self.calls["not_found"] += 1
+            return httpx.Response(404, json={"name": "RESOURCE_NOT_FOUND"})
+        if path.endswith("/capture"):
+            self.calls["capture"] += 1
+            self.orders[order_id] = "COMPLETED"
+        else:
+            self.calls["get_order"] += 1
+        return httpx.Response(200, json={"id": order_id, "status": self.orders[order_id]})
+
+
+def seed(bot, users: int):
+    # DB.json в формате бота; для sqlite — через штатную миграцию
+    now = datetime.now()
+    data = bot.Database.default_data()
+    data["users"] = [
+        bot.UserRecord(
+            user_id=user_id,
+            ssh_name=f"{bot.PROVISION_NAME_PREFIX}{user_id}",
+            ssh_password="bench",
+            tg_name=f"user{user_id}",
+            expire_at=now + timedelta(days=random.randint(1, 365)),
+            plan="1m",
+            provisioned_at=now
+        ).to_dict()
+        for user_id in range(1, users + 1)
+    ]
+    with open(bot.DB_FILE, 'wb') as f:
+        f.write(bot.Codec.dumps(data))
+    if bot.DB_ENGINE == "sqlite":
+        bot.Database.migrate_json_to_sqlite()
+
+
+def percentile(values: list, q: float):
+    # values отсортированы; ближайший ранг
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+class Bench:
+    def __init__(self, bot, tg_bot, telegram: FakeTelegramRequest, paypal: FakePayPal, users: int, args):
+        self.bot = bot
+        self.tg_bot = tg_bot
+        self.telegram = telegram
+        self.paypal = paypal
+        self.users = users
+        self.args = args
+        self.update_id = 0
+        self.new_user_id = users
+
+    def update(self, user_id: int, text: str):
+        self.update_id += 1
+        return Update.de_json({
+            "update_id": self.update_id,
+            "message": {
+                "message_id": self.update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"user{user_id}"},
+                "text": text
+            }
+        }, self.tg_bot)
+
+    def context(self, args: list = None):
+        return types.SimpleNamespace(args=args or [], bot=self.tg_bot, user_data={})
+
+    def existing_user(self):
+        return random.randint(1, self.users)
+
+    def prepare(self, command: str):
+        # Подготовка вне замера: (корутина хендлера, аргументы)
+        bot = self.bot
+        if command == "start":
+            self.new_user_id += 1
+            return bot.start, (self.update(self.new_user_id, "/start"), self.context())
+        if command == "subscribe":
+            return bot.subscribe, (self.update(self.existing_user(), "/subscribe"), self.context())
+        if command == "status":
+            return bot.status, (self.update(self.existing_user(), "/status"), self.context())
+        if command == "pay":
+            return bot.pay, (self.update(self.existing_user(), "/pay 1m"), self.context(["1m"]))
+        if command == "check_payment":
+            user_id = self.existing_user()
+            order_id = f"BENCH-CHECK{self.update_id}"
+            bot.PaymentStateMachine.create(user_id, order_id, "1m", 2)
+            self.paypal.orders[order_id] = "APPROVED"
+            return bot.check_payment, (self.update(user_id, f"/check_payment {order_id}"), self.context([order_id]))
+        if command == "check_expiry":
+            expired_at = datetime.now() - timedelta(minutes=1)
+            for _ in range(self.args.expiry_batch):
+                self.new_user_id += 1
+                bot.Database.update_user(bot.UserRecord(
+                    user_id=self.new_user_id,
+                    ssh_name=f"{bot.PROVISION_NAME_PREFIX}{self.new_user_id}",
+                    expire_at=expired_at
+                ))
+            return bot.check_expiry, (self.context(),)
+        raise ValueError(f"Неизвестная команда {command}")
+
+    async def run(self, command: str, count: int):
+        # Открытая нагрузка: запросы стартуют по расписанию --rate независимо
+        # от завершения предыдущих; латентность включает ожидание семафора
+        latencies = []
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        errors_before = self.telegram.errors
+
+        async def one():
+            started = time.perf_counter()
+            handler, handler_args = self.prepare(command)
+            prepared = time.perf_counter() - started
+            async with semaphore:
+                await handler(*handler_args)
+            latencies.append(time.perf_counter() - started - prepared)
+
+        started = time.perf_counter()
+        tasks = []
+        for i in range(count):
+            if self.args.rate:
+                delay = started + i / self.args.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(one()))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        return {
+            "command": command,
+            "count": count,
+            "errors": self.telegram.errors - errors_before,
+            "p50": percentile(latencies, 0.5) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "max": (latencies[-1] if latencies else 0.0) * 1000,
+            "throughput": count / elapsed if elapsed else 0.0
+        }
+
+
+async def bench_seed(users: int, args):
+    bot = load_bot()
+    bot.DB_ENGINE = args.engine
+    bot.PROVISION_RUNNER = "dry"
+    seed(bot, users)
+
+    bot.Database.open()
+    telegram = FakeTelegramRequest(bot.Codec, args.telegram_latency)
+    tg_bot = Bot(bot.TOKEN, request=telegram, get_updates_request=FakeTelegramRequest(bot.Codec))
+    await tg_bot.initialize()
+    paypal = FakePayPal(args.paypal_latency)
+    bot.PayPalClient._client = httpx.AsyncClient(base_url="https://paypal.test", transport=httpx.MockTransport(paypal))
+
+    bench = Bench(bot, tg_bot, telegram, paypal, users, args)
+    results = []
+    try:
+        for command in args.commands:
+            count = args.expiry_runs if command == "check_expiry" else args.requests
+            results.append(await bench.run(command, count))
+    finally:
+        await bot.PayPalClient.close()
+        await tg_bot.shutdown()
+        bot.Database.flush()
+    return results, telegram.calls, paypal.calls
+
+
+def format_report(users: int, args, results: list, telegram_calls, paypal_calls):
+    lines = [
+        f"users={users} engine={args.engine} rate={args.rate or 'max'} concurrency={args.concurrency} "
+        f"telegram_latency={args.telegram_latency * 1000:g}ms paypal_latency={args.paypal_latency * 1000:g}ms",
+        f"{'command':<15}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'req/s':>10}"
+    ]
+    for r in results:
+        lines.append(
+            f"{r['command']:<15}{r['count']:>8}{r['errors']:>8}{r['p50']:>10.2f}{r['p99']:>10.2f}"
+            f"{r['max']:>10.2f}{r['throughput']:>10.1f}"
+        )
+    lines.append("telegram: " + ", ".join(f"{k}={v}" for k, v in sorted(telegram_calls.items())))
+    lines.append("paypal: " + ", ".join(f"{k}={v}" for k, v in sorted(paypal_calls.items())))
+    return "\n".join(lines) + "\n"
+
+
+def parse_args(argv: list):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест хендлеров бота")
+    parser.add_argument("--users", type=int, nargs="+", default=[1000], help="размеры БД, например 1000 10000 100000")
+    parser.add_argument("--engine", choices=("json", "journal", "sqlite"), default="json")
+    parser.add_argument("--commands", nargs="+", choices=COMMANDS, default=list(COMMANDS))
+    parser.add_argument("--requests", type=int, default=1000, help="запросов на команду")
+    parser.add_argument("--rate", type=float, default=0, help="запросов в секунду; 0 — без ограничения")
+    parser.add_argument("--concurrency", type=int, default=16, help="одновременно выполняемых хендлеров")
+    parser.add_argument("--expiry-runs", type=int, default=10, help="запусков check_expiry")
+    parser.add_argument("--expiry-batch", type=int, default=100, help="истекших подписок на запуск check_expiry")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка Bot API, сек")
+    parser.add_argument("--paypal-latency", type=float, default=0.0, help="задержка PayPal, сек")
+    parser.add_argument("--seed", type=int, default=0, help="seed генератора случайных чисел")
+    parser.add_argument("--output", default=str(Path(__file__).with_name("bench_output.txt")),
+                        help="файл отчета; пусто — только stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    random.seed(args.seed)
+    # Логи бота на каждый запрос исказили бы замеры
+    logging.disable(logging.WARNING)
+    cwd = os.getcwd()
+    reports = []
+    try:
+        for users in args.users:
+            with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+                os.chdir(workdir)
+                try:
+                    report = format_report(users, args, *asyncio.run(bench_seed(users, args)))
+                finally:
+                    os.chdir(cwd)
+            print(report)
+            reports.append(report)
+    finally:
+        if args.output and reports:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                f.write("\n".join(reports))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,39 @@
-import subprocess
+import contextlib
+import dataclasses
+import functools
 import random
 import string
 import logging
 import json
 import os
+import socket
+import struct
+import fcntl
+import sys
+import sqlite3
+import threading
 import asyncio
-import requests
+import collections
+import signal
+import shlex
+import bisect
+import heapq
+import time
+import httpx
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, Forbidden, BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    BaseUpdateProcessor,
     filters
 )
 
@@ -29,210 +49,3266 @@ SUDO_USER = os.getenv('SUDO_USER', 'admin')
 PAYPAL_CLIENT_ID = "client_id"
 PAYPAL_SECRET = "secret_key"
 PAYPAL_MODE = "sandbox"  # "sandbox" для тестов, "live" для продакшена
+PAYPAL_TIMEOUT = float(os.getenv('PAYPAL_TIMEOUT', '10'))  # таймаут одного запроса к PayPal, сек
+PAYPAL_MAX_CONNECTIONS = int(os.getenv('PAYPAL_MAX_CONNECTIONS', '10'))
+PAYPAL_TOKEN_MARGIN = 60  # обновляем токен за минуту до истечения
+PAYPAL_API_URL = os.getenv('PAYPAL_API_URL', '')  # переопределение BASE_URL (локальная заглушка PayPal)
+PAYPAL_WEBHOOK_ID = os.getenv('PAYPAL_WEBHOOK_ID', '')  # пусто — вебхук PayPal не принимается
+PAYPAL_WEBHOOK_PATH = os.getenv('PAYPAL_WEBHOOK_PATH', '/paypal/webhook')
+PAYPAL_WEBHOOK_VERIFY = os.getenv('PAYPAL_WEBHOOK_VERIFY', '1') != '0'
+PAYPAL_WEBHOOK_DEDUP_SIZE = 10000  # сколько последних id событий помнить
+PROVISION_CONCURRENCY = int(os.getenv('PROVISION_CONCURRENCY', '8'))  # одновременных системных операций
+PROVISION_RETRIES = 3
+PROVISION_RETRY_DELAY = 1.0  # секунды, удваивается с каждой попыткой
+PROVISION_RUNNER = os.getenv('PROVISION_RUNNER', 'subprocess')  # "subprocess" или "dry" (только лог команд)
+PROVISION_REQUEUE_DELAY = 60  # повтор создания аккаунта после неудачи, сек
+PROVISION_NAME_PREFIX = os.getenv('PROVISION_NAME_PREFIX', 'vpn')  # имя аккаунта: префикс + user_id
+PROVISION_SHELL = os.getenv('PROVISION_SHELL', '/bin/bash')
+PROVISION_QUOTA_KB = int(os.getenv('PROVISION_QUOTA_KB', '0'))  # дисковая квота аккаунта; 0 — без квоты
+POOL_SIZE = int(os.getenv('POOL_SIZE', '0'))  # заранее созданных аккаунтов; 0 — пул выключен
+POOL_NAME_PREFIX = os.getenv('POOL_NAME_PREFIX', 'vpnp')
+POOL_FILE = os.getenv('POOL_FILE', 'account_pool.json')
+POOL_REFILL_INTERVAL = 300  # повторная попытка пополнить пул после ошибок, сек
+ORPHAN_FILE_DIRS = ("/tmp", "/var/tmp", "/dev/shm", "/var/mail")  # общие каталоги, где остаются файлы аккаунта перед возвратом в пул
+EXPIRY_RETRY_DELAY = 60  # повтор неудачного отключения через N секунд
+EXPIRY_SWEEP_INTERVAL = int(os.getenv('EXPIRY_SWEEP_INTERVAL', '86400'))  # страховочный полный проход
+SSH_PORT = int(os.getenv('SSH_PORT', '33'))
+SERVER_IP_TTL = int(os.getenv('SERVER_IP_TTL', '300'))  # кэш адреса сервера, сек
+SERVER_IP_REFRESH = 60  # фоновая проверка смены адресов интерфейсов, сек
+# Серверы по тарифам: {"1m": ["1.2.3.4:33"], "default": [...]}; пусто — адрес этой машины
+PLAN_SERVERS = json.loads(os.getenv('PLAN_SERVERS', '{}'))
+# Флот серверов: [{"name": "de1", "host": "1.2.3.4", "port": 33, "capacity": 500,
+# "transport": "ssh", "target": "root@1.2.3.4"}, ...]; пусто — только эта машина
+FLEET_NODES = json.loads(os.getenv('FLEET_NODES', '[]'))
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # "polling" или "webhook"
+HTTP_HOST = os.getenv('HTTP_HOST', '127.0.0.1')  # локальный HTTP сервер (вебхуки) за reverse proxy
+HTTP_PORT = int(os.getenv('HTTP_PORT', '8443'))
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')  # метрики Prometheus на локальном HTTP; пусто — выключены
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # публичный URL; пусто — set_webhook не вызывается
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))  # принятых вебхуком и еще не обработанных апдейтов
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '16'))  # апдейтов разных пользователей одновременно
+# Лимиты частоты запросов (жетонов в секунду, запас): на пользователя по
+# видам запроса и общий на бота. /pay и /check_payment ходят в PayPal
+RATE_LIMITS = {
+    "default": (1.0, 5),
+    "pay": (1 / 30, 2),
+    "check_payment": (1 / 10, 3)
+}
+RATE_LIMIT_GLOBAL = (float(os.getenv('RATE_LIMIT_GLOBAL', '50')), 100)
+RATE_LIMIT_MAX_TRACKED = 10000  # бакетов в памяти до чистки простаивающих
+RATE_LIMIT_NOTICE_INTERVAL = 30  # не чаще одного предупреждения пользователю, сек
+OUTBOX_FILE = os.getenv('OUTBOX_FILE', 'outbox.log')
+OUTBOX_RATE = float(os.getenv('OUTBOX_RATE', '25'))  # исходящих сообщений в секунду (лимит Telegram ~30)
+OUTBOX_CHAT_INTERVAL = 1.0  # не чаще одного сообщения в чат, сек
+OUTBOX_CONCURRENCY = 8  # одновременных запросов sendMessage
+OUTBOX_RETRIES = 5
+OUTBOX_JOBS_KEPT = 100  # сколько завершенных рассылок помнить для /broadcast_status
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip()}  # кому доступны /broadcast и список купонов
+PLAN_DAYS = {'1m': 30, '2m': 60, '3m': 90, '6m': 180, '1y': 365, '5y': 1825}
+TIME_LENGTH_UNITS = {'d': 1, 'w': 7, 'm': 30, 'y': 365}  # дней в единице TimeLength купона ("1w", "2m")
+PENDING_PAYMENT_STATUSES = ("CREATED", "APPROVED", "CAPTURED")
+PAYMENT_LOG_FILE = os.getenv('PAYMENT_LOG_FILE', 'payments.log')
+RECONCILE_INTERVAL = int(os.getenv('RECONCILE_INTERVAL', '15'))  # период фоновой сверки платежей, сек
+RECONCILE_BATCH_SIZE = int(os.getenv('RECONCILE_BATCH_SIZE', '20'))  # заказов к PayPal за проход
+RECONCILE_BASE_DELAY = 30  # первая пауза перед повторной проверкой заказа, сек
+RECONCILE_MAX_DELAY = 1800
+RECONCILE_MAX_AGE = 3 * 3600  # после этого заказ считается брошенным
+DB_ENGINE = os.getenv('DB_ENGINE', 'json')  # "json", "journal" или "sqlite"
+SQLITE_FILE = os.getenv('SQLITE_FILE', 'DB.sqlite3')
+DB_FLUSH_INTERVAL = int(os.getenv('DB_FLUSH_INTERVAL', '5'))  # секунды между сбросами БД на диск
+DB_FLUSH_MAX_DIRTY = int(os.getenv('DB_FLUSH_MAX_DIRTY', '100'))  # сброс после N изменений
+DB_JOURNAL_MAX_RECORDS = int(os.getenv('DB_JOURNAL_MAX_RECORDS', '10000'))  # сжатие журнала в снимок после N записей
+
+LANGUAGES = {
+    "en": "English",
+    "ru": "Русский"
+}
+DEFAULT_LANGUAGE = "en"
+
+# Каталог сообщений: id -> {язык: шаблон str.format}. Новый язык — это
+# новая строка в LANGUAGES и переводы здесь; недостающие берутся из DEFAULT_LANGUAGE
+MESSAGES = {
+    "choose_language": {
+        "en": "Choose language: / Выберите язык:"
+    },
+    "language_set": {
+        "en": "Language set to English!",
+        "ru": "Язык установлен на Русский!"
+    },
+    "welcome": {
+        "en": "Welcome {name}! Use /subscribe to see plans.",
+        "ru": "Добро пожаловать {name}! Используйте /subscribe для просмотра планов."
+    },
+    "help": {
+        "en": (
+            "/start - Welcome\n"
+            "/help - Show commands\n"
+            "/subscribe - Buy/renew\n"
+            "/status - Check subscription\n"
+            "/extend - Extend\n"
+            "/cancel - Remove access\n"
+            "/serverinfo - SSH details\n"
+            "/contact - Report issues\n"
+            "/coupon - Use free codes\n"
+            "/pay - Subscription payment\n"
+            "/check_payment - Get yours payment status"
+        ),
+        "ru": (
+            "/start - Приветствие\n"
+            "/help - Список команд\n"
+            "/subscribe - Покупка/продление\n"
+            "/status - Статус подписки\n"
+            "/extend - Продлить\n"
+            "/cancel - Удалить доступ\n"
+            "/serverinfo - SSH данные\n"
+            "/contact - Сообщить проблему\n"
+            "/coupon - Использовать кодов\n"
+            "/pay - Оплата подписки\n"
+            "/check_payment - Проверка статуса оплаты"
+        )
+    },
+    "subscribe_header": {
+        "en": "📊 Available subscription plans:\n\n",
+        "ru": "📊 Доступные планы подписки:\n\n"
+    },
+    "subscribe_item": {
+        "en": "• {plan}: ${price} {currency} ({comment})\n"
+    },
+    "subscribe_button": {
+        "en": "💳 {plan} — {price} {currency}"
+    },
+    "subscribe_footer": {
+        "en": "\nUse /pay <plan> to purchase (e.g. /pay 1m)",
+        "ru": "\nИспользуйте /pay <план> для покупки (напр. /pay 1m)"
+    },
+    "subscribe_error": {
+        "en": "⚠️ Error loading subscription plans. Please try later.",
+        "ru": "⚠️ Ошибка загрузки планов подписки. Попробуйте позже."
+    },
+    "status_active": {
+        "en": "Active until: {expire}",
+        "ru": "Активно до: {expire}"
+    },
+    "no_subscription": {
+        "en": "No active subscription.",
+        "ru": "Нет активной подписки."
+    },
+    "extend_active": {
+        "en": "Send 'payment confirmed' with plan (e.g., 'payment confirmed 3m') to extend.",
+        "ru": "Отправьте 'payment confirmed' с планом (например, 'payment confirmed 3m') для продления."
+    },
+    "extend_inactive": {
+        "en": "No active subscription to extend. Use /subscribe.",
+        "ru": "Нет активной подписки для продления. Используйте /subscribe."
+    },
+    "cancel_done": {
+        "en": "Access moved to expired.",
+        "ru": "Доступ перемещен в expired."
+    },
+    "cancel_no_account": {
+        "en": "No active account to cancel.",
+        "ru": "Нет активного аккаунта для отмены."
+    },
+    "cancel_renewed": {
+        "en": "The subscription was just renewed, access is kept.",
+        "ru": "Подписка только что продлена, доступ сохранен."
+    },
+    "cancel_confirm": {
+        "en": "Send exactly '/cancel iKnowWhatIamDoing' to cancel.",
+        "ru": "Отправьте точно '/cancel iKnowWhatIamDoing' для отмены."
+    },
+    "server_endpoint": {
+        "en": "IP: {ip}\nPort: {port}",
+        "ru": "IP: {ip}\nПорт: {port}"
+    },
+    "server_info": {
+        "en": "{servers}\nUser: {ssh_name}\nExpiry: {expire}",
+        "ru": "{servers}\nПользователь: {ssh_name}\nИстекает: {expire}"
+    },
+    "contact": {
+        "en": "Send your username and problem description for admin.",
+        "ru": "Отправьте имя пользователя и описание проблемы для администратора."
+    },
+    "coupon_list": {
+        "en": "Codes: {codes} - check quantities and durations in admin.",
+        "ru": "Коды: {codes} - проверьте количество и длительность у админа."
+    },
+    "rate_limited": {
+        "en": "⏳ Too many requests. Please slow down.",
+        "ru": "⏳ Слишком много запросов. Подождите немного."
+    },
+    "broadcast_usage": {
+        "en": "Usage: /broadcast <text>",
+        "ru": "Использование: /broadcast <текст>"
+    },
+    "broadcast_queued": {
+        "en": "📣 Broadcast {job} queued for {total} users. Progress: /broadcast_status {job}",
+        "ru": "📣 Рассылка {job} поставлена в очередь для {total} пользователей. Прогресс: /broadcast_status {job}"
+    },
+    "broadcast_status": {
+        "en": "📣 {job}: sent {sent}/{total}, failed {failed}, pending {pending}",
+        "ru": "📣 {job}: отправлено {sent}/{total}, ошибок {failed}, в очереди {pending}"
+    },
+    "broadcast_not_found": {
+        "en": "No such broadcast.",
+        "ru": "Нет такой рассылки."
+    },
+    "account_ready": {
+        "en": "🔐 Your server account is ready!\n{servers}\nUser: {ssh_name}\nPassword: {password}",
+        "ru": "🔐 Ваш аккаунт на сервере готов!\n{servers}\nПользователь: {ssh_name}\nПароль: {password}"
+    },
+    "coupon_usage": {
+        "en": "Usage: /coupon <code>",
+        "ru": "Использование: /coupon <код>"
+    },
+    "coupon_redeemed": {
+        "en": "🎁 Coupon applied! Subscription active until: {expire}",
+        "ru": "🎁 Купон применен! Подписка активна до: {expire}"
+    },
+    "coupon_unknown": {
+        "en": "Unknown coupon code.",
+        "ru": "Неизвестный код купона."
+    },
+    "coupon_exhausted": {
+        "en": "This coupon has run out.",
+        "ru": "Этот купон закончился."
+    },
+    "coupon_already_redeemed": {
+        "en": "You have already used this coupon.",
+        "ru": "Вы уже использовали этот купон."
+    },
+    "payment_confirmed_text": {
+        "en": "Payment confirmed! Use /subscribe or /extend.",
+        "ru": "Оплата подтверждена! Используйте /subscribe или /extend."
+    },
+    "payment_confirmed_invalid": {
+        "en": "Invalid. Send 'payment confirmed' with plan (e.g., 'payment confirmed 3m').",
+        "ru": "Неверно. Отправьте 'payment confirmed' с планом (например, 'payment confirmed 3m')."
+    },
+    "pay_no_plan": {
+        "en": "Please specify a plan (e.g., /pay 1m)",
+        "ru": "Укажите план (например, /pay 1m)"
+    },
+    "pay_invalid_plan": {
+        "en": "Invalid plan. Use /subscribe to see available plans.",
+        "ru": "Неверный план. Используйте /subscribe для просмотра доступных планов."
+    },
+    "pay_unavailable": {
+        "en": "Payment service is unavailable. Please try again later.",
+        "ru": "Платежный сервис недоступен. Пожалуйста, попробуйте позже."
+    },
+    "pay_error": {
+        "en": "Payment error. Please try again later.",
+        "ru": "Ошибка платежа. Пожалуйста, попробуйте позже."
+    },
+    "pay_link": {
+        "en": "🔗 Please complete your payment: {url}\n\nAfter payment, use /check_payment {order_id} to activate your subscription.",
+        "ru": "🔗 Пожалуйста, завершите оплату: {url}\n\nПосле оплаты используйте /check_payment {order_id} для активации подписки."
+    },
+    "check_no_order": {
+        "en": "Please specify payment ID (e.g., /check_payment ORDER-123)"
+    },
+    "check_not_found": {
+        "en": "Payment not found or you don't have permission to check it."
+    },
+    "check_failed": {
+        "en": "Failed to get payment status. Please try again later."
+    },
+    "check_completed": {
+        "en": "✅ Payment confirmed! Your {plan} subscription is now active."
+    },
+    "check_captured": {
+        "en": "✅ Payment captured! Subscription activated."
+    },
+    "check_capture_failed": {
+        "en": "⚠️ Payment capture failed. Please contact support."
+    },
+    "check_status": {
+        "en": "ℹ️ Payment status: {status}. Please wait or contact support."
+    }
+}
+
+
+class I18n:
+    # Каталог разбирается один раз при старте: шаблоны без подстановок
+    # хранятся готовыми строками, остальные — связанным str.format.
+    # Язык пользователя кэшируется при /start и выборе языка
+    _templates = {}
+    _user_language = {}
+
+    @classmethod
+    def compile(cls, messages: dict = MESSAGES):
+        formatter = string.Formatter()
+        templates = {}
+        for message_id, translations in messages.items():
+            default = translations[DEFAULT_LANGUAGE]
+            for lang in LANGUAGES:
+                template = translations.get(lang, default)
+                has_fields = any(field is not None for _, field, _, _ in formatter.parse(template))
+                templates[(message_id, lang)] = template.format if has_fields else template
+        cls._templates = templates
+
+    @classmethod
+    def language(cls, user_id: int):
+        lang = cls._user_language.get(user_id)
+        if lang is None:
+            db_user = Database.get_user(user_id)
+            lang = db_user.language if db_user else None
+            lang = lang if lang in LANGUAGES else DEFAULT_LANGUAGE
+            cls._user_language[user_id] = lang
+        return lang
+
+    @classmethod
+    def set_language(cls, user_id: int, lang: str):
+        cls._user_language[user_id] = lang if lang in LANGUAGES else DEFAULT_LANGUAGE
+
+    @classmethod
+    def render(cls, lang: str, message_id: str, **kwargs):
+        template = cls._templates[(message_id, lang if lang in LANGUAGES else DEFAULT_LANGUAGE)]
+        return template(**kwargs) if callable(template) else template
+
+    @classmethod
+    def t(cls, user_id: int, message_id: str, **kwargs):
+        return cls.render(cls.language(user_id), message_id, **kwargs)
+
+
+I18n.compile()
+
+
+class PlanCatalog:
+    # Готовые текст /subscribe и клавиатура покупки в один тап по языкам;
+    # сбрасываются только при изменении purchase_options
+    _rendered = {}
+
+    @classmethod
+    def render(cls, lang: str):
+        options = Database.get_purchase_options()
+        items = [
+            I18n.render(lang, "subscribe_item", plan=plan, price=details['Stripe_EUR'], currency="EUR", comment=details['comment'])
+            for plan, details in options.items()
+        ]
+        text = I18n.render(lang, "subscribe_header") + "".join(items) + I18n.render(lang, "subscribe_footer")
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton(
+                I18n.render(lang, "subscribe_button", plan=plan, price=details['Stripe_EUR'], currency="EUR"),
+                callback_data=f"pay:{plan}"
+            )]
+            for plan, details in options.items()
+        ])
+        return text, keyboard
+
+    @classmethod
+    def get(cls, lang: str):
+        rendered = cls._rendered.get(lang)
+        if rendered is None:
+            rendered = cls._rendered[lang] = cls.render(lang)
+        return rendered
+
+    @classmethod
+    def invalidate(cls):
+        cls._rendered = {}
+
+class Codec:
+    # Единая точка (де)сериализации JSON: orjson, если установлен, иначе
+    # stdlib. Везде компактный вывод в bytes; человекочитаемый отступ —
+    # только для экспорта (dumps_pretty)
+    @staticmethod
+    def dumps(obj) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+    @staticmethod
+    def loads(data):
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+    @staticmethod
+    def dumps_pretty(obj) -> bytes:
+        return json.dumps(obj, indent=4, ensure_ascii=False).encode()
+
+class Histogram:
+    # Гистограмма с фиксированными границами: счетчики по корзинам
+    # (накопительные суммы считаются только при выдаче), сумма и число
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    # Метрики процесса в памяти, отдаются на METRICS_PATH в текстовом
+    # формате Prometheus. Запись — сложение в dict или bisect по границам
+    # гистограммы, поэтому инструментирование не выключается в проде;
+    # датчики (глубины очередей, размер БД) вычисляются только при опросе
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+    SWEEP_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+    DEFINITIONS = {
+        "handler_seconds": ("histogram", "Время обработки апдейта хендлером", LATENCY_BUCKETS),
+        "db_operation_seconds": ("histogram", "Время операции фасада БД", FAST_BUCKETS),
+        "db_read_bytes_total": ("counter", "Прочитано байт из файлов БД", None),
+        "db_written_bytes_total": ("counter", "Записано байт в файлы БД", None),
+        "db_file_bytes": ("gauge", "Размер файла БД", None),
+        "paypal_request_seconds": ("histogram", "Время запроса к PayPal API", LATENCY_BUCKETS),
+        "paypal_errors_total": ("counter", "Неудачные запросы к PayPal API", None),
+        "provision_command_seconds": ("histogram", "Время системной команды Provisioner", LATENCY_BUCKETS),
+        "provision_command_failures_total": ("counter", "Команды Provisioner с неожиданным кодом возврата", None),
+        "expiry_sweep_seconds": ("histogram", "Длительность прохода по истекшим подпискам", SWEEP_BUCKETS),
+        "expired_users_total": ("counter", "Отключено истекших подписок", None),
+        "expiry_failures_total": ("counter", "Неудачные отключения истекших подписок", None),
+        "rate_limited_total": ("counter", "Апдейты, отброшенные лимитом частоты", None),
+        "queue_depth": ("gauge", "Глубина очереди", None),
+        "account_pool_ready": ("gauge", "Готовых аккаунтов в пуле сервера", None),
+        "fleet_node_load": ("gauge", "Аккаунтов на сервере флота", None),
+        "fleet_node_capacity": ("gauge", "Емкость сервера флота (0 — без ограничения)", None)
+    }
+    _counters = {}
+    _histograms = {}
+    _gauges = {}
+
+    @classmethod
+    def inc(cls, name: str, value: float = 1, **labels):
+        key = (name, tuple(labels.items()))
+        cls._counters[key] = cls._counters.get(key, 0) + value
+
+    @classmethod
+    def observe(cls, name: str, value: float, **labels):
+        key = (name, tuple(labels.items()))
+        histogram = cls._histograms.get(key)
+        if histogram is None:
+            histogram = cls._histograms[key] = Histogram(cls.DEFINITIONS[name][2])
+        histogram.observe(value)
+
+    @classmethod
+    def gauge(cls, name: str, collect):
+        # collect() -> число или [(labels, число), ...]; вызывается при опросе
+        cls._gauges.setdefault(name, []).append(collect)
+
+    @classmethod
+    def timed(cls, callback):
+        # Обертка хендлера PTB: время в handler_seconds{handler=имя функции}
+        name = callback.__name__
+
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                cls.observe("handler_seconds", time.perf_counter() - started, handler=name)
+        return wrapper
+
+    @classmethod
+    def db_operation(cls, kind: str):
+        # Декоратор методов Database: _count гистограммы — число чтений/записей
+        def decorate(func):
+            name = func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    cls.observe("db_operation_seconds", time.perf_counter() - started, op=name, kind=kind)
+            return wrapper
+        return decorate
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    @classmethod
+    def format_labels(cls, labels, extra: str = ""):
+        parts = [f'{k}="{cls.escape(v)}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    @classmethod
+    def render(cls):
+        samples = collections.defaultdict(list)
+        for (name, labels), value in cls._counters.items():
+            samples[name].append(f"{name}{cls.format_labels(labels)} {value}")
+        for (name, labels), histogram in cls._histograms.items():
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + ("+Inf",), histogram.counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                samples[name].append(f"{name}_bucket{cls.format_labels(labels, le)} {cumulative}")
+            samples[name].append(f"{name}_sum{cls.format_labels(labels)} {histogram.sum}")
+            samples[name].append(f"{name}_count{cls.format_labels(labels)} {histogram.count}")
+        for name, collectors in cls._gauges.items():
+            for collect in collectors:
+                try:
+                    value = collect()
+                except Exception as e:
+                    logger.error(f"Ошибка сбора метрики {name}: {e}")
+                    continue
+                if not isinstance(value, list):
+                    value = [({}, value)]
+                for labels, sample in value:
+                    samples[name].append(f"{name}{cls.format_labels(labels.items())} {sample}")
+        
+        lines = []
+        for name, metric_samples in samples.items():
+            metric_type, help_text, _ = cls.DEFINITIONS[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(metric_samples)
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    async def handle(cls, headers: dict, body: bytes):
+        return 200, cls.render()
 
 class PayPalClient:
     BASE_URL = {
         "sandbox": "https://api.sandbox.paypal.com",
         "live": "https://api.paypal.com"
     }
+    # Один keep-alive пул на весь процесс и access token в памяти до
+    # PAYPAL_TOKEN_MARGIN секунд перед истечением expires_in
+    _client = None
+    _token = None
+    _token_expires_at = 0.0
+    _token_lock = None
+
+    @classmethod
+    def client(cls):
+        if cls._client is None:
+            cls._client = httpx.AsyncClient(
+                base_url=PAYPAL_API_URL or cls.BASE_URL[PAYPAL_MODE],
+                timeout=PAYPAL_TIMEOUT,
+                limits=httpx.Limits(max_connections=PAYPAL_MAX_CONNECTIONS, max_keepalive_connections=PAYPAL_MAX_CONNECTIONS)
+            )
+        return cls._client
+
+    @classmethod
+    async def close(cls):
+        if cls._client is not None:
+            await cls._client.aclose()
+            cls._client = None
+
+    @classmethod
+    async def get_access_token(cls):
+        if cls._token and time.monotonic() < cls._token_expires_at:
+            return cls._token
+        if cls._token_lock is None:
+            cls._token_lock = asyncio.Lock()
+        async with cls._token_lock:
+            # Пока ждали лок, токен мог обновить другой запрос
+            if cls._token and time.monotonic() < cls._token_expires_at:
+                return cls._token
+            started = time.perf_counter()
+            try:
+                response = await cls.client().post(
+                    "/v1/oauth2/token",
+                    headers={"Content-Type": "application/x-www-form-urlencoded"},
+                    data={"grant_type": "client_credentials"},
+                    auth=(PAYPAL_CLIENT_ID, PAYPAL_SECRET)
+                )
+            except httpx.HTTPError as e:
+                Metrics.inc("paypal_errors_total", operation="oauth_token", reason="transport")
+                logger.error(f"PayPal auth error: {e!r}")
+                return None
+            finally:
+                Metrics.observe("paypal_request_seconds", time.perf_counter() - started, operation="oauth_token")
+            if response.status_code == 200:
+                token_data = Codec.loads(response.content)
+                cls._token = token_data.get("access_token")
+                cls._token_expires_at = time.monotonic() + token_data.get("expires_in", 0) - PAYPAL_TOKEN_MARGIN
+                return cls._token
+            Metrics.inc("paypal_errors_total", operation="oauth_token", reason=str(response.status_code))
+            logger.error(f"PayPal auth error: {response.text}")
+            return None
+
+    @classmethod
+    async def request(cls, method: str, url: str, expected_status: tuple, error_label: str, operation: str, **kwargs):
+        # operation — метка метрик без id заказа в пути
+        for attempt in range(2):
+            access_token = await cls.get_access_token()
+            if not access_token:
+                return None
+            headers = dict(kwargs.pop("headers", {}), Authorization=f"Bearer {access_token}")
+            if "json" in kwargs:
+                kwargs["content"] = Codec.dumps(kwargs.pop("json"))
+                headers["Content-Type"] = "application/json"
+            started = time.perf_counter()
+            try:
+                response = await cls.client().request(method, url, headers=headers, **kwargs)
+            except httpx.HTTPError as e:
+                Metrics.inc("paypal_errors_total", operation=operation, reason="transport")
+                logger.error(f"{error_label}: {e!r}")
+                return None
+            finally:
+                Metrics.observe("paypal_request_seconds", time.perf_counter() - started, operation=operation)
+            if response.status_code == 401 and attempt == 0:
+                # Токен отозван раньше срока — сбрасываем кэш и повторяем один раз
+                cls._token = None
+                kwargs["headers"] = headers
+                continue
+            if response.status_code in expected_status:
+                return Codec.loads(response.content)
+            Metrics.inc("paypal_errors_total", operation=operation, reason=str(response.status_code))
+            logger.error(f"{error_label}: {response.text}")
+            return None
+
+    @classmethod
+    async def verify_webhook_signature(cls, headers: dict, event: dict):
+        payload = {
+            "auth_algo": headers.get("paypal-auth-algo"),
+            "cert_url": headers.get("paypal-cert-url"),
+            "transmission_id": headers.get("paypal-transmission-id"),
+            "transmission_sig": headers.get("paypal-transmission-sig"),
+            "transmission_time": headers.get("paypal-transmission-time"),
+            "webhook_id": PAYPAL_WEBHOOK_ID,
+            "webhook_event": event
+        }
+        result = await cls.request("POST", "/v1/notifications/verify-webhook-signature", (200,),
+                                   "PayPal webhook verify error", "verify_webhook", json=payload)
+        return bool(result) and result.get("verification_status") == "SUCCESS"
+
+    @classmethod
+    async def create_order(cls, amount, currency, description, request_id):
+        # Повтор с тем же request_id PayPal отвечает тем же заказом (200 вместо 201)
+        headers = {
+            "Content-Type": "application/json",
+            "PayPal-Request-Id": request_id
+        }
+        
+        payload = {
+            "intent": "CAPTURE",
+            "purchase_units": [{
+                "amount": {
+                    "currency_code": currency,
+                    "value": str(amount)
+                },
+                "description": description
+            }]
+        }
+        
+        return await cls.request("POST", "/v2/checkout/orders", (201, 200), "PayPal create order error",
+                                 "create_order", headers=headers, json=payload)
+
+    @classmethod
+    async def capture_order(cls, order_id):
+        headers = {
+            "Content-Type": "application/json",
+            "PayPal-Request-Id": f"CAPTURE-{order_id}"
+        }
+        
+        return await cls.request("POST", f"/v2/checkout/orders/{order_id}/capture", (201, 200), "PayPal capture error",
+                                 "capture_order", headers=headers)
+
+    @classmethod
+    async def get_order_details(cls, order_id):
+        return await cls.request("GET", f"/v2/checkout/orders/{order_id}", (200,), "PayPal get order error",
+                                 "get_order")
+
+def parse_timestamp(value):
+    # ISO-строка из хранилища -> datetime; пустое или битое значение -> None
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        logger.error(f"Неверная дата в БД: {value!r}")
+        return None
+
+
+@dataclasses.dataclass(slots=True)
+class UserRecord:
+    # Пользователь в памяти: int user_id и уже разобранный срок подписки.
+    # В dict формата DB.json переводится только на границе хранилища
+    # (from_dict/to_dict); незнакомые ключи переживают цикл через extra
+    KEYS = ("user_id", "sshName", "sshPassword", "TGname", "expire_datetime", "language", "plan", "provisioned_at", "server")
+
+    user_id: int
+    ssh_name: str = ""
+    ssh_password: str = ""
+    tg_name: str = ""
+    expire_at: datetime = None
+    language: str = DEFAULT_LANGUAGE
+    plan: str = None
+    provisioned_at: datetime = None
+    server: str = None
+    extra: dict = dataclasses.field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, data):
+        if isinstance(data, cls):
+            return data
+        return cls(
+            user_id=int(data["user_id"]),
+            ssh_name=data.get("sshName") or "",
+            ssh_password=data.get("sshPassword") or "",
+            tg_name=data.get("TGname") or "",
+            expire_at=parse_timestamp(data.get("expire_datetime")),
+            language=data.get("language") or DEFAULT_LANGUAGE,
+            plan=data.get("plan") or None,
+            provisioned_at=parse_timestamp(data.get("provisioned_at")),
+            server=data.get("server") or None,
+            extra={k: v for k, v in data.items() if k not in cls.KEYS}
+        )
+
+    def to_dict(self):
+        data = {
+            "user_id": str(self.user_id),
+            "sshName": self.ssh_name,
+            "sshPassword": self.ssh_password,
+            "TGname": self.tg_name,
+            "expire_datetime": self.expire_at.isoformat() if self.expire_at else "",
+            "language": self.language
+        }
+        if self.plan:
+            data["plan"] = self.plan
+        if self.provisioned_at:
+            data["provisioned_at"] = self.provisioned_at.isoformat()
+        if self.server:
+            data["server"] = self.server
+        data.update(self.extra)
+        return data
+
+    def is_active(self, now: datetime = None):
+        return self.expire_at is not None and self.expire_at > (now or datetime.now())
+
+
+@dataclasses.dataclass(slots=True)
+class PaymentRecord:
+    # Платеж в памяти; order_id — ключ хранилища, в to_dict не попадает
+    KEYS = ("order_id", "user_id", "plan", "amount", "currency", "status", "created_at", "updated_at")
+
+    order_id: str
+    user_id: int
+    plan: str
+    amount: float
+    currency: str = "EUR"
+    status: str = "CREATED"
+    created_at: datetime = None
+    updated_at: datetime = None
+    extra: dict = dataclasses.field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, order_id: str, data):
+        if isinstance(data, cls):
+            return data
+        return cls(
+            order_id=order_id,
+            user_id=int(data["user_id"]),
+            plan=data["plan"],
+            amount=data["amount"],
+            currency=data.get("currency") or "EUR",
+            status=data["status"],
+            created_at=parse_timestamp(data.get("created_at")),
+            updated_at=parse_timestamp(data.get("updated_at")),
+            extra={k: v for k, v in data.items() if k not in cls.KEYS}
+        )
+
+    def to_dict(self):
+        data = {
+            "user_id": str(self.user_id),
+            "plan": self.plan,
+            "amount": self.amount,
+            "currency": self.currency,
+            "status": self.status,
+            "created_at": self.created_at.isoformat() if self.created_at else "",
+            "updated_at": self.updated_at.isoformat() if self.updated_at else ""
+        }
+        data.update(self.extra)
+        return data
+
+
+class JsonStorage:
+    # Резидентная копия DB.json: читается один раз, изменения сбрасываются
+    # на диск пачками (write-behind) по таймеру или по числу изменений.
+    # В памяти users — dict user_id -> UserRecord, payments — dict
+    # order_id -> PaymentRecord; на диске — dict'ы, users списком.
+    # Вторичные индексы: по sshName, по времени истечения (отсортированный
+    # список (datetime, user_id)), платежи по пользователю и коды купонов
+    # без учета регистра вместе с теми, кто их уже использовал
+    def __init__(self, path: str = DB_FILE):
+        self.path = path
+        self._data = None
+        self._dirty = 0
+        self._coupon_codes = {}
+        self._redemptions = {}
+        self._by_ssh_name = {}
+        self._expiry_index = []
+        self._indexed_keys = {}
+        self._payments_by_user = {}
+        self._pending_payments = set()
+        self._flushing = False
+        self._flush_task = None
+        self._seq = 0
+        self._written_seq = 0
+        self._write_lock = threading.Lock()
+
+    def open(self):
+        self.load()
+
+    def load(self):
+        if self._data is None:
+            self.attach(self.read_file())
+        return self._data
+
+    def read_file(self):
+        if not os.path.exists(self.path):
+            return self.initialize_db()
+        try:
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+            Metrics.inc("db_read_bytes_total", len(raw))
+            return Codec.loads(raw)
+        except Exception as e:
+            # Не затираем пользователей дефолтной БД из-за битого файла
+            raise RuntimeError(f"Ошибка загрузки БД {self.path}: {e}") from e
+
+    def attach(self, data):
+        users = data.get("users", [])
+        if isinstance(users, dict):
+            users = users.values()
+        users = map(UserRecord.from_dict, users)
+        payments = data.get("payments", {})
+        self._data = dict(
+            data,
+            users={user.user_id: user for user in users},
+            payments={order_id: PaymentRecord.from_dict(order_id, p) for order_id, p in payments.items()}
+        )
+        self._by_ssh_name = {}
+        self._expiry_index = []
+        self._indexed_keys = {}
+        self._payments_by_user = {}
+        self._pending_payments = set()
+        for user in self._data["users"].values():
+            self.index_user(user)
+        for order_id, payment in self._data["payments"].items():
+            self._payments_by_user.setdefault(payment.user_id, []).append(order_id)
+            if payment.status in PENDING_PAYMENT_STATUSES:
+                self._pending_payments.add(order_id)
+        self._coupon_codes = {code.lower(): code for code in self._data["coupons"]}
+        self._redemptions = {
+            code: {int(user_id) for user_id in coupon.get("redeemed_by", [])}
+            for code, coupon in self._data["coupons"].items()
+        }
+
+    def index_user(self, user: UserRecord):
+        user_id = user.user_id
+        ssh_name = user.ssh_name or None
+        expiry = user.expire_at
+        if ssh_name:
+            self._by_ssh_name[ssh_name] = user_id
+        if expiry:
+            bisect.insort(self._expiry_index, (expiry, user_id))
+        self._indexed_keys[user_id] = (ssh_name, expiry)
+
+    def unindex_user(self, user_id: int):
+        # Ключи берем из _indexed_keys: хендлеры меняют запись пользователя
+        # на месте, поэтому старые значения в нем уже перезаписаны
+        ssh_name, expiry = self._indexed_keys.pop(user_id, (None, None))
+        if ssh_name and self._by_ssh_name.get(ssh_name) == user_id:
+            del self._by_ssh_name[ssh_name]
+        if expiry:
+            i = bisect.bisect_left(self._expiry_index, (expiry, user_id))
+            if i < len(self._expiry_index) and self._expiry_index[i] == (expiry, user_id):
+                del self._expiry_index[i]
+
+    def initialize_db(self):
+        default_data = Database.default_data()
+        self.attach(default_data)
+        self.mark_dirty()
+        self.flush()
+        return default_data
+
+    def snapshot(self):
+        # Данные в формате DB.json (plain dict) — для записи и экспорта
+        data = self.load()
+        return dict(
+            data,
+            users=[user.to_dict() for user in data["users"].values()],
+            payments={order_id: p.to_dict() for order_id, p in data["payments"].items()}
+        )
+
+    def save(self, data):
+        if data is not self._data:
+            self.attach(data)
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        self._dirty += 1
+        if self._dirty >= DB_FLUSH_MAX_DIRTY and not self._flushing:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # Вне цикла событий (миграция, экспорт) — пишем сразу
+                self.flush()
+                return
+            # Одна фоновая запись за раз; изменения, пришедшие во время
+            # записи, заберет следующая
+            self._flushing = True
+            self._flush_task = loop.create_task(self.flush_async(claimed=True))
+
+    def dump(self):
+        return Codec.dumps(self.snapshot())
+
+    def next_seq(self):
+        # Номер снимка берется сразу после dump, в цикле событий
+        self._seq += 1
+        return self._seq
+
+    def write_atomic(self, payload: bytes, seq: int):
+        # Писателей двое: flush в цикле событий и flush_async в потоке.
+        # Лок не дает им делить .tmp, номер снимка — затереть новый файл старым
+        with self._write_lock:
+            if seq <= self._written_seq:
+                return
+            tmp_file = f"{self.path}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.path)
+            self._written_seq = seq
+        Metrics.inc("db_written_bytes_total", len(payload))
+
+    def flush(self):
+        # True — все изменения до вызова на диске
+        if not self._dirty or self._data is None:
+            return True
+        try:
+            self.write_atomic(self.dump(), self.next_seq())
+            self._dirty = 0
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения БД: {e}")
+            return False
+
+    async def flush_async(self, claimed: bool = False):
+        # Сериализуем в цикле событий (снимок согласован), пишем в потоке.
+        # Пока идет запись, повторный вызов сразу возвращает False
+        if not claimed:
+            if self._flushing:
+                return False
+            self._flushing = True
+        try:
+            if not self._dirty or self._data is None:
+                return True
+            dirty, payload = self._dirty, self.dump()
+            seq = self.next_seq()
+            await asyncio.to_thread(self.write_atomic, payload, seq)
+            self._dirty = max(0, self._dirty - dirty)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения БД: {e}")
+            return False
+        finally:
+            self._flushing = False
+
+    def get_user(self, user_id: int):
+        return self.load()["users"].get(user_id)
+
+    def get_user_ids(self):
+        return list(self.load()["users"])
+
+    def get_user_by_ssh_name(self, ssh_name: str):
+        users = self.load()["users"]
+        user_id = self._by_ssh_name.get(ssh_name)
+        return users.get(user_id) if user_id else None
+
+    def get_expired_users(self, now: datetime):
+        users = self.load()["users"]
+        end = bisect.bisect_right(self._expiry_index, now, key=lambda e: e[0])
+        return [users[user_id] for _, user_id in self._expiry_index[:end]]
+
+    def get_users_with_expiry(self):
+        users = self.load()["users"]
+        return [users[user_id] for _, user_id in self._expiry_index]
+
+    def update_user(self, user_data: UserRecord):
+        db = self.load()
+        user_id = user_data.user_id
+        self.unindex_user(user_id)
+        db["users"][user_id] = user_data
+        self.index_user(user_data)
+        self.mark_dirty()
+
+    def remove_user(self, user_id: int):
+        db = self.load()
+        if db["users"].pop(user_id, None) is not None:
+            self.unindex_user(user_id)
+            self.mark_dirty()
+
+    def add_payment(self, order_id: str, payment: PaymentRecord):
+        db = self.load()
+        db["payments"][order_id] = payment
+        self._payments_by_user.setdefault(payment.user_id, []).append(order_id)
+        if payment.status in PENDING_PAYMENT_STATUSES:
+            self._pending_payments.add(order_id)
+        self.mark_dirty()
+
+    def update_payment(self, order_id: str, fields: dict):
+        payment = self.load()["payments"].get(order_id)
+        if payment is None:
+            return False
+        for name, value in fields.items():
+            setattr(payment, name, value)
+        if payment.status in PENDING_PAYMENT_STATUSES:
+            self._pending_payments.add(order_id)
+        else:
+            self._pending_payments.discard(order_id)
+        self.mark_dirty()
+        return True
+
+    def get_payment(self, order_id: str):
+        return self.load()["payments"].get(order_id)
+
+    def get_user_payments(self, user_id: int):
+        payments = self.load()["payments"]
+        return {order_id: payments[order_id] for order_id in self._payments_by_user.get(user_id, [])}
+
+    def get_pending_payments(self):
+        payments = self.load()["payments"]
+        return {order_id: payments[order_id] for order_id in self._pending_payments}
+
+    def get_purchase_options(self):
+        return self.load()["purchase_options"]
+
+    def update_purchase_options(self, options: dict):
+        self.load()["purchase_options"] = options
+        self.mark_dirty()
+
+    def get_coupons(self):
+        return self.load()["coupons"]
+
+    def redeem_coupon(self, code: str, user_id: int):
+        # Проверка и списание без await между ними — атомарны для цикла событий
+        coupons = self.load()["coupons"]
+        code = self._coupon_codes.get(code.lower())
+        if code is None:
+            return "unknown", None
+        coupon = coupons[code]
+        redeemed_by = self._redemptions.setdefault(code, set())
+        if user_id in redeemed_by:
+            return "already_redeemed", None
+        if coupon["quantity"] <= 0:
+            return "exhausted", None
+        coupon["quantity"] -= 1
+        coupon.setdefault("redeemed_by", []).append(str(user_id))
+        redeemed_by.add(user_id)
+        self.mark_dirty()
+        return code, coupon["TimeLength"]
+
+
+class JournaledJsonStorage(JsonStorage):
+    # DB.json как снимок плюс журнал изменений DB.json.journal.<поколение>:
+    # каждое изменение — одна компактная JSON-строка в конце журнала, т.е.
+    # запись стоит O(размер записи), а не O(размер БД). Когда журнал
+    # разрастается, фоновое сжатие открывает следующее поколение журнала и
+    # пишет свежий снимок; старое поколение удаляется после подмены снимка.
+    # При старте: снимок + все журналы поколения не младше указанного в нем
+    def __init__(self, path: str = DB_FILE):
+        super().__init__(path)
+        self._journal = None
+        self._generation = 0
+        self._records = 0
+        self._compacting = False
+
+    def journal_path(self, generation: int):
+        return f"{self.path}.journal.{generation}"
+
+    def journal_generations(self):
+        prefix = os.path.basename(self.path) + ".journal."
+        directory = os.path.dirname(self.path) or "."
+        generations = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                generations.append(int(name[len(prefix):]))
+        return sorted(generations)
+
+    def read_file(self):
+        data = super().read_file()
+        self._generation = data.pop("_journal", 0)
+        if isinstance(data.get("users"), list):
+            data["users"] = {str(u["user_id"]): u for u in data["users"]}
+        replayed = 0
+        for generation in self.journal_generations():
+            if generation < self._generation:
+                os.remove(self.journal_path(generation))
+                continue
+            data, count = self.replay(data, self.journal_path(generation))
+            replayed += count
+            self._generation = generation
+        if replayed:
+            logger.info(f"Из журнала БД применено изменений: {replayed}")
+        self._records = replayed
+        return data
+
+    def replay(self, data: dict, path: str):
+        count = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                Metrics.inc("db_read_bytes_total", len(line))
+                try:
+                    record = Codec.loads(line)
+                except ValueError:
+                    # Оборванная запись в хвосте после падения
+                    logger.warning(f"Пропущена поврежденная запись журнала БД: {line[:80]!r}")
+                    break
+                data = self.apply(data, record)
+                count += 1
+        return data, count
+
+    @staticmethod
+    def apply(data: dict, record: dict):
+        op = record["op"]
+        if op == "user":
+            data["users"][str(record["v"]["user_id"])] = record["v"]
+        elif op == "del_user":
+            data["users"].pop(record["id"], None)
+        elif op == "payment":
+            data.setdefault("payments", {})[record["id"]] = record["v"]
+        elif op == "purchase_options":
+            data["purchase_options"] = record["v"]
+        elif op == "coupon":
+            data["coupons"][record["code"]] = record["v"]
+        elif op == "replace":
+            data = record["v"]
+            if isinstance(data.get("users"), list):
+                data["users"] = {str(u["user_id"]): u for u in data["users"]}
+        return data
+
+    def open(self):
+        self.load()
+        if self._records:
+            # Хвост журнала мог оборваться посреди строки — начинаем новое поколение
+            self.compact()
+        self.open_journal()
+
+    def open_journal(self):
+        if self._journal is None:
+            self._journal = open(self.journal_path(self._generation), 'ab')
+
+    def append(self, record: dict):
+        self.open_journal()
+        line = Codec.dumps(record) + b"\n"
+        self._journal.write(line)
+        Metrics.inc("db_written_bytes_total", len(line))
+        # В ОС сразу, fsync — пачкой в flush
+        self._journal.flush()
+        self._records += 1
+        self._dirty += 1
+
+    def mark_dirty(self):
+        # Изменения уже в журнале; снимок пишет compact
+        pass
+
+    def save(self, data):
+        super().save(data)
+        self.append({"op": "replace", "v": self.snapshot()})
+
+    def initialize_db(self):
+        default_data = Database.default_data()
+        self.attach(default_data)
+        self.write_atomic(self.dump_snapshot(), self.next_seq())
+        return default_data
+
+    def dump_snapshot(self):
+        return Codec.dumps(dict(self.snapshot(), _journal=self._generation))
+
+    def rotate(self):
+        # Снимок, сделанный сразу после смены поколения, покрывает все
+        # записи предыдущих поколений
+        old_generation = self._generation
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self._generation += 1
+        self._records = 0
+        self._dirty = 0
+        self.open_journal()
+        return old_generation, self.dump_snapshot()
+
+    def compact(self):
+        old_generation, payload = self.rotate()
+        self.write_atomic(payload, self.next_seq())
+        self.remove_journals(old_generation)
+
+    def remove_journals(self, up_to: int):
+        for generation in self.journal_generations():
+            if generation <= up_to:
+                os.remove(self.journal_path(generation))
+
+    def sync(self):
+        if self._journal is not None:
+            os.fsync(self._journal.fileno())
+
+    def flush(self):
+        if self._data is None:
+            return True
+        try:
+            self.sync()
+            if self._records:
+                self.compact()
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения БД: {e}")
+            return False
+
+    async def flush_async(self):
+        # True — журнал на диске; сжатие снимка на результат не влияет
+        if self._data is None or self._journal is None:
+            return True
+        try:
+            await asyncio.to_thread(self.sync)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения БД: {e}")
+            return False
+        if self._records < DB_JOURNAL_MAX_RECORDS or self._compacting:
+            return True
+        # Сериализация снимка — в цикле событий (он согласован),
+        # запись и удаление старого журнала — в потоке
+        self._compacting = True
+        try:
+            old_generation, payload = self.rotate()
+            await asyncio.to_thread(self.write_atomic, payload, self.next_seq())
+            await asyncio.to_thread(self.remove_journals, old_generation)
+        except Exception as e:
+            logger.error(f"Ошибка сжатия журнала БД: {e}")
+        finally:
+            self._compacting = False
+        return True
+
+    def update_user(self, user_data: UserRecord):
+        super().update_user(user_data)
+        self.append({"op": "user", "v": user_data.to_dict()})
+
+    def remove_user(self, user_id: int):
+        if user_id in self.load()["users"]:
+            super().remove_user(user_id)
+            self.append({"op": "del_user", "id": str(user_id)})
+
+    def add_payment(self, order_id: str, payment: PaymentRecord):
+        super().add_payment(order_id, payment)
+        self.append({"op": "payment", "id": order_id, "v": payment.to_dict()})
+
+    def update_payment(self, order_id: str, fields: dict):
+        if not super().update_payment(order_id, fields):
+            return False
+        self.append({"op": "payment", "id": order_id, "v": self.get_payment(order_id).to_dict()})
+        return True
+
+    def update_purchase_options(self, options: dict):
+        super().update_purchase_options(options)
+        self.append({"op": "purchase_options", "v": options})
+
+    def redeem_coupon(self, code: str, user_id: int):
+        code, time_length = super().redeem_coupon(code, user_id)
+        if time_length is not None:
+            self.append({"op": "coupon", "code": code, "v": self.load()["coupons"][code]})
+        return code, time_length
+
+
+class SqliteStorage:
+    # SQLite в режиме WAL: каждая операция — одна индексированная запрос-строка,
+    # без перезаписи всего файла. Поля пользователя/платежа, для которых нет
+    # колонки, лежат JSON-ом в extra
+    USER_COLUMNS = ("user_id", "sshName", "sshPassword", "TGname", "expire_datetime", "language")
+    PAYMENT_COLUMNS = ("order_id", "user_id", "plan", "amount", "currency", "status", "created_at", "updated_at")
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            sshName TEXT NOT NULL DEFAULT '',
+            sshPassword TEXT NOT NULL DEFAULT '',
+            TGname TEXT NOT NULL DEFAULT '',
+            expire_datetime TEXT NOT NULL DEFAULT '',
+            language TEXT NOT NULL DEFAULT 'en',
+            extra TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE INDEX IF NOT EXISTS users_ssh_name ON users (sshName) WHERE sshName != '';
+        CREATE INDEX IF NOT EXISTS users_expire ON users (expire_datetime) WHERE expire_datetime != '';
+        CREATE TABLE IF NOT EXISTS payments (
+            order_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            plan TEXT NOT NULL,
+            amount REAL NOT NULL,
+            currency TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            extra TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE INDEX IF NOT EXISTS payments_user ON payments (user_id);
+        CREATE INDEX IF NOT EXISTS payments_status ON payments (status);
+        CREATE TABLE IF NOT EXISTS purchase_options (
+            plan TEXT PRIMARY KEY,
+            Stripe_EUR REAL NOT NULL,
+            Litecoin_LTC REAL NOT NULL,
+            comment TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS coupons (
+            code TEXT PRIMARY KEY,
+            quantity INTEGER NOT NULL,
+            TimeLength TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS coupons_code_nocase ON coupons (code COLLATE NOCASE);
+        CREATE TABLE IF NOT EXISTS coupon_redemptions (
+            code TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            PRIMARY KEY (code, user_id)
+        );
+    """
+
+    def __init__(self, path: str = SQLITE_FILE):
+        self.path = path
+        self.conn = None
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        if not self.conn.execute("SELECT 1 FROM purchase_options LIMIT 1").fetchone():
+            self.initialize_db()
+
+    def db(self):
+        if self.conn is None:
+            self.open()
+        return self.conn
+
+    def snapshot(self):
+        # Полный снимок в формате DB.json — для экспорта, не для хендлеров
+        conn = self.db()
+        return {
+            "users": {row["user_id"]: self.row_to_dict(row) for row in conn.execute("SELECT * FROM users")},
+            "purchase_options": self.get_purchase_options(),
+            "coupons": self.get_coupons(),
+            "payments": {row["order_id"]: self.row_to_dict(row, "order_id") for row in conn.execute("SELECT * FROM payments")}
+        }
+
+    def initialize_db(self):
+        default_data = Database.default_data()
+        self.save(default_data)
+        return default_data
+
+    def load(self):
+        return self.snapshot()
+
+    def save(self, data):
+        users = data.get("users", [])
+        if isinstance(users, dict):
+            users = users.values()
+        conn = self.db()
+        with conn:
+            conn.execute("BEGIN")
+            for user in users:
+                self.update_user(UserRecord.from_dict(user))
+            for order_id, payment in data.get("payments", {}).items():
+                self.add_payment(order_id, PaymentRecord.from_dict(order_id, payment))
+            conn.executemany(
+                "INSERT OR REPLACE INTO purchase_options VALUES (?, ?, ?, ?)",
+                [(plan, o["Stripe_EUR"], o["Litecoin_LTC"], o["comment"]) for plan, o in data.get("purchase_options", {}).items()]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO coupons VALUES (?, ?, ?)",
+                [(code, c["quantity"], c["TimeLength"]) for code, c in data.get("coupons", {}).items()]
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO coupon_redemptions VALUES (?, ?)",
+                [(code, user_id) for code, c in data.get("coupons", {}).items() for user_id in c.get("redeemed_by", [])]
+            )
+
+    def flush(self):
+        # autocommit: каждая запись уже в файле
+        return True
+
+    async def flush_async(self):
+        return True
+
+    @staticmethod
+    def split(record: dict, columns: tuple):
+        values = [record.get(c, "") for c in columns]
+        extra = {k: v for k, v in record.items() if k not in columns}
+        return values + [Codec.dumps(extra).decode()]
+
+    @staticmethod
+    def row_to_dict(row, key: str = None):
+        record = {k: row[k] for k in row.keys() if k not in ("extra", key)}
+        record.update(Codec.loads(row["extra"]))
+        return record
+
+    def row_to_user(self, row):
+        return UserRecord.from_dict(self.row_to_dict(row))
+
+    def row_to_payment(self, row):
+        return PaymentRecord.from_dict(row["order_id"], self.row_to_dict(row, "order_id"))
+
+    def get_user(self, user_id: int):
+        row = self.db().execute("SELECT * FROM users WHERE user_id = ?", (str(user_id),)).fetchone()
+        return self.row_to_user(row) if row else None
+
+    def get_user_ids(self):
+        return [int(row["user_id"]) for row in self.db().execute("SELECT user_id FROM users")]
+
+    def get_user_by_ssh_name(self, ssh_name: str):
+        # Условие sshName != '' — чтобы подошел частичный индекс users_ssh_name
+        row = self.db().execute("SELECT * FROM users WHERE sshName = ? AND sshName != ''", (ssh_name,)).fetchone()
+        return self.row_to_user(row) if row else None
+
+    def get_expired_users(self, now: datetime):
+        rows = self.db().execute(
+            "SELECT * FROM users WHERE expire_datetime != '' AND expire_datetime <= ? ORDER BY expire_datetime",
+            (now.isoformat(),)
+        )
+        return [self.row_to_user(row) for row in rows]
+
+    def get_users_with_expiry(self):
+        rows = self.db().execute("SELECT * FROM users WHERE expire_datetime != '' ORDER BY expire_datetime")
+        return [self.row_to_user(row) for row in rows]
+
+    def update_user(self, user_data: UserRecord):
+        self.db().execute(
+            "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?)",
+            self.split(user_data.to_dict(), self.USER_COLUMNS)
+        )
+
+    def remove_user(self, user_id: int):
+        self.db().execute("DELETE FROM users WHERE user_id = ?", (str(user_id),))
+
+    def add_payment(self, order_id: str, payment: PaymentRecord):
+        self.db().execute(
+            "INSERT OR REPLACE INTO payments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            self.split(dict(payment.to_dict(), order_id=order_id), self.PAYMENT_COLUMNS)
+        )
+
+    def update_payment(self, order_id: str, fields: dict):
+        payment = self.get_payment(order_id)
+        if payment is None:
+            return False
+        for name, value in fields.items():
+            setattr(payment, name, value)
+        self.add_payment(order_id, payment)
+        return True
+
+    def get_payment(self, order_id: str):
+        row = self.db().execute("SELECT * FROM payments WHERE order_id = ?", (order_id,)).fetchone()
+        return self.row_to_payment(row) if row else None
+
+    def get_user_payments(self, user_id: int):
+        rows = self.db().execute("SELECT * FROM payments WHERE user_id = ? ORDER BY created_at", (str(user_id),))
+        return {row["order_id"]: self.row_to_payment(row) for row in rows}
+
+    def get_pending_payments(self):
+        placeholders = ", ".join("?" * len(PENDING_PAYMENT_STATUSES))
+        rows = self.db().execute(f"SELECT * FROM payments WHERE status IN ({placeholders})", PENDING_PAYMENT_STATUSES)
+        return {row["order_id"]: self.row_to_payment(row) for row in rows}
+
+    def get_purchase_options(self):
+        rows = self.db().execute("SELECT * FROM purchase_options ORDER BY rowid")
+        return {row["plan"]: {"Stripe_EUR": row["Stripe_EUR"], "Litecoin_LTC": row["Litecoin_LTC"], "comment": row["comment"]} for row in rows}
+
+    def update_purchase_options(self, options: dict):
+        conn = self.db()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM purchase_options")
+            conn.executemany(
+                "INSERT INTO purchase_options VALUES (?, ?, ?, ?)",
+                [(plan, o["Stripe_EUR"], o["Litecoin_LTC"], o["comment"]) for plan, o in options.items()]
+            )
+
+    def get_coupons(self):
+        conn = self.db()
+        redeemed = {}
+        for row in conn.execute("SELECT * FROM coupon_redemptions ORDER BY rowid"):
+            redeemed.setdefault(row["code"], []).append(row["user_id"])
+        rows = conn.execute("SELECT * FROM coupons ORDER BY rowid")
+        return {
+            row["code"]: {"quantity": row["quantity"], "TimeLength": row["TimeLength"], "redeemed_by": redeemed.get(row["code"], [])}
+            for row in rows
+        }
+
+    def redeem_coupon(self, code: str, user_id: int):
+        # Одна транзакция: запись о погашении (PRIMARY KEY не даст второй)
+        # и условный декремент quantity > 0 — без чтения-проверки-записи
+        conn = self.db()
+        row = conn.execute("SELECT code, TimeLength FROM coupons WHERE code = ? COLLATE NOCASE", (code,)).fetchone()
+        if not row:
+            return "unknown", None
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("INSERT INTO coupon_redemptions VALUES (?, ?)", (row["code"], str(user_id)))
+                if not conn.execute("UPDATE coupons SET quantity = quantity - 1 WHERE code = ? AND quantity > 0", (row["code"],)).rowcount:
+                    conn.execute("ROLLBACK")
+                    return "exhausted", None
+        except sqlite3.IntegrityError:
+            return "already_redeemed", None
+        return row["code"], row["TimeLength"]
+
+
+class Database:
+    # Фасад над хранилищем: сигнатуры прежние, движок выбирается DB_ENGINE.
+    # Наружу отдает UserRecord/PaymentRecord; user_id приводится к int здесь
+    STORAGE_ENGINES = {
+        "json": JsonStorage,
+        "journal": JournaledJsonStorage,
+        "sqlite": SqliteStorage
+    }
+    _engine = None
+
+    @staticmethod
+    def engine():
+        if Database._engine is None:
+            Database._engine = Database.STORAGE_ENGINES[DB_ENGINE]()
+        return Database._engine
+
+    @staticmethod
+    def default_data():
+        return {
+            "users": [],
+            "purchase_options": {
+                "1m": {"Stripe_EUR": 2, "Litecoin_LTC": 0.004, "comment": "1month subscription"},
+                "2m": {"Stripe_EUR": 4, "Litecoin_LTC": 0.008, "comment": "2month subscription"},
+                "3m": {"Stripe_EUR": 5, "Litecoin_LTC": 0.010, "comment": "3month subscription"},
+                "6m": {"Stripe_EUR": 8, "Litecoin_LTC": 0.016, "comment": "6month subscription"},
+                "1y": {"Stripe_EUR": 10, "Litecoin_LTC": 0.020, "comment": "1year subscription"},
+                "5y": {"Stripe_EUR": 40, "Litecoin_LTC": 0.080, "comment": "5year subscription"}
+            },
+            "coupons": {
+                "freeweek": {"quantity": 2, "TimeLength": "1w"},
+                "freemonth": {"quantity": 2, "TimeLength": "1m"}
+            }
+        }
+
+    @staticmethod
+    def open():
+        Database.engine().open()
+
+    @staticmethod
+    @Metrics.db_operation("read")
+    def load():
+        return Database.engine().load()
+
+    @staticmethod
+    @Metrics.db_operation("write")
+    def initialize_db():
+        PlanCatalog.invalidate()
+        return Database.engine().initialize_db()
+
+    @staticmethod
+    @Metrics.db_operation("write")
+    def save(data):
+        Database.engine().save(data)
+        PlanCatalog.invalidate()
+
+    @staticmethod
+    @Metrics.db_operation("write")
+    def flush():
+        return Database.engine().flush()
+
+    @staticmethod
+    async def flush_async():
+        return await Database.engine().flush_async()
+
+    @staticmethod
+    @Metrics.db_operation("read")
+    def get_user(user_id: int):
+        return Database.engine().get_user(int(user_id))
+
+    @staticmethod
+    @Metrics.db_operation("read")
+    def get_user_ids():
+        return Database.engine().get_user_ids()
+
+    @staticmethod
+    @Metrics.db_operation("read")
+    def get_user_by_ssh_name(ssh_name: str):
+        return Database.engine().get_user_by_ssh_name(ssh_name)
+
+    @staticmethod
+    @Metrics.db_operation("read")
+    def get_expired_users(now: datetime):
+        return Database.engine().get_expired_users(now)
+
+    @staticmethod
+    @Metrics.db_operation("read")
+    def get_users_with_expiry():
+        # Все пользователи с датой окончания подписки, по возрастанию даты
+        return Database.engine().get_users_with_expiry()
+
+    @staticmethod
+    @Metrics.db_operation("write")
+    def update_user(user_data: UserRecord):
+        Database.engine().update_user(user_data)
+        ExpiryScheduler.schedule(user_data)
+
+    @staticmethod
+    @Metrics.db_operation("write")
+    def remove_user(user_id: int):
+        Database.engine().remove_user(int(user_id))
+        ExpiryScheduler.unschedule(int(user_id))
+
+    @staticmethod
+    @Metrics.db_operation("write")
+    def add_payment(user_id: int, order_id: str, plan: str, amount: float, currency: str = "EUR", **extra):
+        now = datetime.now()
+        Database.engine().add_payment(order_id, PaymentRecord(
+            order_id=order_id,
+            user_id=int(user_id),
+            plan=plan,
+            amount=amount,
+            currency=currency,
+            status="CREATED",
+            created_at=now,
+            updated_at=now,
+            extra=extra
+        ))
+
+    @staticmethod
+    @Metrics.db_operation("write")
+    def update_payment_status(order_id: str, status: str):
+        return Database.engine().update_payment(order_id, {
+            "status": status,
+            "updated_at": datetime.now()
+        })
+
+    @staticmethod
+    @Metrics.db_operation("read")
+    def get_payment(order_id: str):
+        return Database.engine().get_payment(order_id)
+
+    @staticmethod
+    @Metrics.db_operation("read")
+    def get_user_payments(user_id: int):
+        return Database.engine().get_user_payments(int(user_id))
+
+    @staticmethod
+    @Metrics.db_operation("read")
+    def get_pending_payments():
+        return Database.engine().get_pending_payments()
+
+    @staticmethod
+    @Metrics.db_operation("read")
+    def get_purchase_options():
+        return Database.engine().get_purchase_options()
+
+    @staticmethod
+    @Metrics.db_operation("write")
+    def update_purchase_options(options: dict):
+        Database.engine().update_purchase_options(options)
+        PlanCatalog.invalidate()
+
+    @staticmethod
+    @Metrics.db_operation("read")
+    def get_coupons():
+        return Database.engine().get_coupons()
+
+    @staticmethod
+    @Metrics.db_operation("write")
+    def redeem_coupon(code: str, user_id: int):
+        # (код купона, TimeLength) при успехе, иначе (причина отказа, None):
+        # "unknown", "exhausted" или "already_redeemed"
+        return Database.engine().redeem_coupon(code, int(user_id))
+
+    @staticmethod
+    def export(path: str):
+        # Человекочитаемая копия БД с отступами — для ручного просмотра;
+        # само хранилище пишет компактный JSON
+        data = Database.engine().snapshot()
+        with open(path, 'wb') as f:
+            f.write(Codec.dumps_pretty(data))
+        logger.info(f"БД выгружена в {path}")
+
+    @staticmethod
+    def migrate_json_to_sqlite(json_file: str = DB_FILE, sqlite_file: str = SQLITE_FILE):
+        # Одноразовый перенос DB.json в SQLite; повторный запуск безопасен (INSERT OR REPLACE).
+        # Читаем через журналируемое хранилище: для обычного DB.json журналов
+        # нет и это просто чтение файла, для журнального — снимок плюс хвост
+        data = JournaledJsonStorage(json_file).load()
+        target = SqliteStorage(sqlite_file)
+        target.save(data)
+        logger.info(f"Перенесено в {sqlite_file}: {len(data.get('users', []))} пользователей, "
+                    f"{len(data.get('payments', {}))} платежей")
+
+class KeyedLock:
+    # Набор asyncio.Lock по ключу; лок удаляется, когда его никто не ждет
+    def __init__(self):
+        self._locks = {}
+        self._waiters = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class SubprocessRunner:
+    # Запуск команд ОС. Provisioner обращается к системе только через
+    # runner, поэтому пайплайн проверяется без root на DryRunRunner
+    async def run(self, cmd: tuple, input: bytes = None):
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate(input)
+        return process.returncode, stderr.decode(errors='replace').strip()
+
+
+class DryRunRunner:
+    # Ничего не выполняет: команды пишутся в лог и в commands, код
+    # возврата берется из returncodes по имени программы (по умолчанию 0)
+    def __init__(self, returncodes: dict = None):
+        self.commands = []
+        self.returncodes = returncodes or {}
+
+    async def run(self, cmd: tuple, input: bytes = None):
+        self.commands.append(cmd)
+        logger.info(f"[dry-run] {' '.join(cmd)}")
+        program = cmd[1] if cmd[0] == "sudo" else cmd[0]
+        return self.returncodes.get(program, 0), ""
+
+
+class SshRunner:
+    # Транспорт удаленного узла: та же команда через ssh (вход по ключу,
+    # BatchMode — без интерактивных вопросов), stdin уходит на узел
+    def __init__(self, target: str):
+        self.target = target
+        self.local = SubprocessRunner()
+
+    async def run(self, cmd: tuple, input: bytes = None):
+        return await self.local.run(("ssh", "-o", "BatchMode=yes", self.target, "--", shlex.join(cmd)), input)
+
+
+@dataclasses.dataclass(slots=True)
+class FleetNode:
+    # Сервер флота: адрес для пользователей, емкость (0 — без ограничения),
+    # транспорт команд и число размещенных на нем аккаунтов
+    name: str
+    host: str = ""
+    port: int = SSH_PORT
+    capacity: int = 0
+    transport: str = "local"
+    target: str = ""
+    load: int = 0
+    runner: object = None
+
+    def has_room(self):
+        return not self.capacity or self.load < self.capacity
+
+    def utilization(self):
+        return self.load / self.capacity if self.capacity else 0.0
+
+
+class Fleet:
+    # Реестр серверов из FLEET_NODES. Новый подписчик размещается на узле с
+    # наименьшей долей занятой емкости, имя узла хранится в UserRecord.server,
+    # и все команды Provisioner для аккаунта идут через транспорт этого узла:
+    # "local" — runner этой машины, "ssh" — SshRunner, "dry" — DryRunRunner
+    # в процессе (фейковые узлы для проверки). Мощность наращивается
+    # добавлением узлов в конфиг. Без FLEET_NODES флот — один локальный узел,
+    # и serverinfo ведет себя как раньше; пользователи без server — на первом узле
+    TRANSPORTS = {
+        "ssh": lambda node: SshRunner(node.target or node.host),
+        "dry": lambda node: DryRunRunner()
+    }
+    _nodes = {}
+
+    @classmethod
+    def configure(cls, specs: list = None):
+        specs = FLEET_NODES if specs is None else specs
+        nodes = [FleetNode(**spec) for spec in specs] or [FleetNode(name="local")]
+        for node in nodes:
+            if node.transport != "local":
+                node.runner = cls.TRANSPORTS[node.transport](node)
+        cls._nodes = {node.name: node for node in nodes}
+
+    @classmethod
+    def nodes(cls):
+        if not cls._nodes:
+            cls.configure()
+        return list(cls._nodes.values())
+
+    @classmethod
+    def node(cls, name: str = None):
+        nodes = cls.nodes()
+        if name is None:
+            return nodes[0]
+        if name not in cls._nodes:
+            raise RuntimeError(f"Сервер {name} отсутствует в FLEET_NODES")
+        return cls._nodes[name]
+
+    @classmethod
+    def known(cls, name: str = None):
+        return name is None or name in cls._nodes
+
+    @classmethod
+    def runner(cls, name: str = None):
+        return cls.node(name).runner or Provisioner.runner()
+
+    @classmethod
+    def count(cls):
+        # Загрузка по БД: аккаунт занимает место на узле, пока пользователь в базе
+        nodes = cls.nodes()
+        for node in nodes:
+            node.load = 0
+        for user in Database.get_users_with_expiry():
+            if user.ssh_name and cls.known(user.server):
+                cls.node(user.server).load += 1
+        for node in nodes:
+            logger.info(f"Сервер {node.name}: {node.load}/{node.capacity or '∞'}")
+
+    @classmethod
+    def loads(cls):
+        return [({"node": node.name}, node.load) for node in cls.nodes()]
+
+    @classmethod
+    def capacities(cls):
+        return [({"node": node.name}, node.capacity) for node in cls.nodes()]
+
+    @classmethod
+    def place(cls):
+        candidates = [node for node in cls.nodes() if node.has_room()]
+        if not candidates:
+            raise RuntimeError("Нет свободной емкости на серверах флота")
+        node = min(candidates, key=lambda node: (node.utilization(), node.load))
+        node.load += 1
+        return node.name
+
+    @classmethod
+    def release(cls, user: UserRecord):
+        if cls.known(user.server):
+            node = cls.node(user.server)
+            node.load = max(node.load - 1, 0)
+
+    @classmethod
+    def endpoints(cls, user: UserRecord):
+        # [(host, port), ...] для serverinfo; у узла без host — адреса этой машины
+        node = cls.node(user.server) if cls.known(user.server) else None
+        if node and node.host:
+            return [(node.host, node.port)]
+        return ServerInfo.endpoints(user.plan)
+
+
+class Provisioner:
+    # Системные операции над SSH-аккаунтами выполняются асинхронно: не больше
+    # PROVISION_CONCURRENCY одновременно, операции одного аккаунта строго по
+    # очереди, с повторами при сбое. Создание аккаунта после оплаты идет
+    # через очередь: каждый шаг идемпотентен (useradd терпит существующего
+    # пользователя, install -d и chpasswd просто перезаписывают), а имя и
+    # пароль сохраняются в БД до первой команды — повтор после сбоя или
+    # перезапуска доводит тот же аккаунт. Незавершенные при старте находятся
+    # по активной подписке без provisioned_at
+    RUNNERS = {
+        "subprocess": SubprocessRunner,
+        "dry": DryRunRunner
+    }
+    USERADD_EXISTS = 9  # код useradd "имя уже занято"
+    _runner = None
+    _semaphore = None
+    _locks = KeyedLock()
+    _queue = None
+    _queued = set()
+    _workers = []
+
+    @classmethod
+    def runner(cls):
+        if cls._runner is None:
+            cls._runner = cls.RUNNERS[PROVISION_RUNNER]()
+        return cls._runner
+
+    @classmethod
+    def semaphore(cls):
+        if cls._semaphore is None:
+            cls._semaphore = asyncio.Semaphore(PROVISION_CONCURRENCY)
+        return cls._semaphore
+
+    @classmethod
+    @contextlib.asynccontextmanager
+    async def slot(cls, key: str):
+        # Сначала лок аккаунта, потом общий семафор — иначе ожидающая
+        # очереди операция зря занимала бы место в пуле
+        async with cls._locks.hold(key), cls.semaphore():
+            yield
+
+    @classmethod
+    async def run(cls, *cmd: str, input: bytes = None, ok_codes: tuple = (0,), retries: int = PROVISION_RETRIES,
+                  node: str = None):
+        runner = Fleet.runner(node)
+        labels = {"program": cmd[1] if cmd[0] == "sudo" else cmd[0], "node": node or Fleet.node().name}
+        for attempt in range(retries):
+            started = time.perf_counter()
+            returncode, stderr = await runner.run(cmd, input)
+            Metrics.observe("provision_command_seconds", time.perf_counter() - started, **labels)
+            if returncode in ok_codes:
+                return returncode
+            Metrics.inc("provision_command_failures_total", **labels)
+            logger.warning(f"[{node or Fleet.node().name}] {' '.join(cmd)} завершилась с кодом {returncode} "
+                           f"(попытка {attempt + 1}/{retries}): {stderr}")
+            if attempt + 1 < retries:
+                await asyncio.sleep(PROVISION_RETRY_DELAY * 2 ** attempt)
+        raise RuntimeError(f"{' '.join(cmd)} завершилась с кодом {returncode}")
+
+    @staticmethod
+    def generate_password(length: int = 16):
+        alphabet = string.ascii_letters + string.digits
+        return "".join(random.SystemRandom().choice(alphabet) for _ in range(length))
+
+    @classmethod
+    async def set_password(cls, ssh_name: str, password: str, node: str = None):
+        # chpasswd заодно снимает блокировку "!" (пул, прошлое истечение)
+        await cls.run("sudo", "chpasswd", input=f"{ssh_name}:{password}\n".encode(), node=node)
+
+    @classmethod
+    async def create_account(cls, ssh_name: str, password: str = None, node: str = None):
+        # Без пароля — заблокированный аккаунт для AccountPool
+        async with cls.slot(ssh_name):
+            await cls.run("sudo", "useradd", "-m", "-s", PROVISION_SHELL, ssh_name,
+                          ok_codes=(0, cls.USERADD_EXISTS), node=node)
+            if password is None:
+                await cls.run("sudo", "usermod", "-p", "!", ssh_name, node=node)
+            else:
+                await cls.set_password(ssh_name, password, node)
+            await cls.run("sudo", "install", "-d", "-m", "700", "-o", ssh_name, "-g", ssh_name, f"/home/{ssh_name}",
+                          node=node)
+            if PROVISION_QUOTA_KB:
+                quota = str(PROVISION_QUOTA_KB)
+                await cls.run("sudo", "setquota", "-u", ssh_name, quota, quota, "0", "0", "-a", node=node)
+
+    @classmethod
+    async def provision(cls, user_id: int):
+        user = Database.get_user(user_id)
+        if not user or user.provisioned_at or not user.is_active():
+            return
+        pooled = None
+        if not user.ssh_name:
+            user.server = Fleet.place()
+            pooled = AccountPool.take(user.server)
+            user.ssh_name = pooled or f"{PROVISION_NAME_PREFIX}{user.user_id}"
+            user.ssh_password = cls.generate_password()
+            Database.update_user(user)
+        
+        if pooled:
+            async with cls.slot(pooled):
+                await cls.set_password(pooled, user.ssh_password, user.server)
+        else:
+            # Повтор после сбоя тоже идет сюда: шаги идемпотентны
+            await cls.create_account(user.ssh_name, user.ssh_password, user.server)
+        
+        user = Database.get_user(user_id)
+        if not user:
+            return
+        user.provisioned_at = datetime.now()
+        Database.update_user(user)
+        logger.info(f"Аккаунт {user.ssh_name} пользователя {user_id} создан")
+        
+        lang = I18n.language(user_id)
+        servers = "\n".join(
+            I18n.render(lang, "server_endpoint", ip=ip, port=port)
+            for ip, port in Fleet.endpoints(user)
+        )
+        Outbox.send(user_id, I18n.render(lang, "account_ready", servers=servers, ssh_name=user.ssh_name, password=user.ssh_password))
+
+    @classmethod
+    def depth(cls):
+        return len(cls._queued)
+
+    @classmethod
+    def enqueue(cls, user_id: int):
+        if cls._queue is None:
+            cls._queue = asyncio.Queue()
+        if user_id not in cls._queued:
+            cls._queued.add(user_id)
+            cls._queue.put_nowait(user_id)
+
+    @classmethod
+    async def worker(cls):
+        while True:
+            user_id = await cls._queue.get()
+            cls._queued.discard(user_id)
+            try:
+                await cls.provision(user_id)
+            except Exception as e:
+                logger.error(f"Ошибка создания аккаунта пользователя {user_id}: {e}")
+                asyncio.get_running_loop().call_later(PROVISION_REQUEUE_DELAY, cls.enqueue, user_id)
+            finally:
+                cls._queue.task_done()
+
+    @classmethod
+    def start(cls):
+        now = datetime.now()
+        for user in Database.get_users_with_expiry():
+            if user.is_active(now) and not user.provisioned_at:
+                cls.enqueue(user.user_id)
+        if cls._queue is None:
+            cls._queue = asyncio.Queue()
+        cls._workers = [asyncio.create_task(cls.worker()) for _ in range(PROVISION_CONCURRENCY)]
+
+    @classmethod
+    async def stop(cls):
+        for task in cls._workers:
+            task.cancel()
+        await asyncio.gather(*cls._workers, return_exceptions=True)
+        cls._workers = []
+
+    @staticmethod
+    def renewed(user_id: int, expire_at: datetime):
+        # Подписку продлили (оплата, купон) после того, как решили отключать;
+        # expire_at — срок на тот момент (JSON-движки отдают общий объект записи)
+        current = Database.get_user(user_id)
+        now = datetime.now()
+        baseline = max(expire_at, now) if expire_at else now
+        return current is not None and current.expire_at is not None and current.expire_at > baseline
+
+    @classmethod
+    def restore(cls, user_id: int):
+        # Отключение прервано продлением: аккаунт заново доводит очередь
+        user = Database.get_user(user_id)
+        user.provisioned_at = None
+        Database.update_user(user)
+        cls.enqueue(user_id)
+        logger.info(f"Подписку пользователя {user_id} продлили во время отключения, аккаунт восстанавливается")
+
+    @staticmethod
+    def archive_dir(ssh_name: str):
+        # Куда deactivate переносит домашний каталог истекшего аккаунта
+        return f"/home/{SUDO_USER}/expiredusers/{ssh_name}"
+
+    @classmethod
+    async def deactivate(cls, user: UserRecord):
+        # Полное снятие подписки: блокировка, перенос домашнего каталога,
+        # удаление из БД, освобождение места на узле и возврат аккаунта в пул.
+        # Перед каждым шагом и перед удалением пользователь перечитывается под
+        # локом аккаунта: продление в это время отменяет снятие.
+        # True — снято, False — подписку продлили
+        ssh_name = user.ssh_name
+        node = user.server
+        expire_at = user.expire_at
+        home_dir = f"/home/{ssh_name}"
+        expired_dir = cls.archive_dir(ssh_name)
+        moved = False
+        
+        async def move_home():
+            nonlocal moved
+            if await cls.run("test", "-d", home_dir, ok_codes=(0, 1), node=node) == 0:
+                await cls.run("sudo", "mv", home_dir, expired_dir, node=node)
+                moved = True
+            else:
+                await cls.run("mkdir", "-p", expired_dir, node=node)
+        
+        async def abort():
+            # Файлы пользователя возвращаются на место, разблокирует chpasswd в provision
+            if moved:
+                await cls.run("sudo", "rm", "-f", f"{expired_dir}/user_info.json", node=node)
+                await cls.run("sudo", "mv", expired_dir, home_dir, node=node)
+            cls.restore(user.user_id)
+            return False
+        
+        steps = (
+            lambda: cls.run("sudo", "usermod", "-p", "!", ssh_name, node=node),
+            lambda: cls.run("mkdir", "-p", os.path.dirname(expired_dir), node=node),
+            move_home,
+            lambda: cls.run("sudo", "tee", f"{expired_dir}/user_info.json", input=Codec.dumps(user.to_dict()), node=node)
+        )
+        async with cls.slot(ssh_name):
+            for step in steps:
+                if cls.renewed(user.user_id, expire_at):
+                    return await abort()
+                await step()
+            if cls.renewed(user.user_id, expire_at):
+                return await abort()
+            Database.remove_user(user.user_id)
+        Fleet.release(user)
+        AccountPool.recycle(ssh_name, node)
+        return True
+
+
+class AccountPool:
+    # Запас из POOL_SIZE заранее созданных заблокированных аккаунтов на
+    # каждом узле флота: при активации аккаунт берется из пула своего узла и
+    # только получает пароль (один chpasswd) вместо полного useradd. Пул
+    # пополняется в фоне; истекшие аккаунты после Provisioner.deactivate
+    # ждут в _expired и при пополнении идут первыми: переименовываются в имя
+    # пула и получают чистый домашний каталог из /etc/skel — uid
+    # переиспользуется, а старое имя больше никому не достанется. useradd —
+    # только когда истекших не хватает. Состояние — POOL_FILE
+    _ready = collections.defaultdict(collections.deque)
+    _expired = collections.defaultdict(collections.deque)
+    _pending = collections.Counter()
+    _seq = 0
+    _wakeup = None
+    _task = None
+
+    @classmethod
+    def load(cls, path: str = POOL_FILE):
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            state = Codec.loads(f.read())
+        ready = state["ready"]
+        if isinstance(ready, list):
+            # Файл до появления флота: все аккаунты на локальном узле
+            ready = {Fleet.node().name: ready}
+        cls._ready = collections.defaultdict(collections.deque, {
+            node: collections.deque(names) for node, names in ready.items()
+        })
+        cls._expired = collections.defaultdict(collections.deque, {
+            node: collections.deque(names) for node, names in state.get("expired", {}).items()
+        })
+        cls._seq = state["seq"]
+
+    @classmethod
+    def save(cls, path: str = POOL_FILE):
+        tmp_file = f"{path}.tmp"
+        ready = {node: list(names) for node, names in cls._ready.items()}
+        expired = {node: list(names) for node, names in cls._expired.items() if names}
+        with open(tmp_file, 'wb') as f:
+            f.write(Codec.dumps({"ready": ready, "expired": expired, "seq": cls._seq}))
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def next_name(cls):
+        cls._seq += 1
+        cls.save()
+        return f"{POOL_NAME_PREFIX}{cls._seq:05d}"
+
+    @classmethod
+    def deficit(cls, node: str):
+        return POOL_SIZE - len(cls._ready[node]) - cls._pending[node]
+
+    @classmethod
+    def take(cls, node: str = None):
+        node = Fleet.node(node).name
+        if not cls._ready[node]:
+            return None
+        ssh_name = cls._ready[node].popleft()
+        cls.save()
+        if cls._wakeup:
+            cls._wakeup.set()
+        return ssh_name
+
+    @classmethod
+    async def add(cls, node: str, prepare, *args):
+        cls._pending[node] += 1
+        try:
+            ssh_name = await prepare(node, *args)
+        except Exception as e:
+            logger.error(f"Ошибка подготовки аккаунта для пула сервера {node}: {e}")
+            return
+        finally:
+            cls._pending[node] -= 1
+        cls._ready[node].append(ssh_name)
+        cls.save()
+
+    @classmethod
+    async def create(cls, node: str):
+        ssh_name = cls.next_name()
+        await Provisioner.create_account(ssh_name, node=node)
+        return ssh_name
+
+    @classmethod
+    async def recycle_account(cls, node: str, old_name: str):
+        async with Provisioner.slot(old_name):
+            # Имя могло снова достаться владельцу: повторная подписка создает
+            # аккаунт с тем же vpn<user_id>, пока старый ждал в _expired
+            owner = Database.get_user_by_ssh_name(old_name)
+            if owner:
+                raise RuntimeError(f"аккаунт {old_name} снова занят пользователем {owner.user_id}")
+            ssh_name = cls.next_name()
+            home_dir = f"/home/{ssh_name}"
+            # uid достанется следующему владельцу: сначала завершаем все процессы
+            # старого (код 1 — процессов нет), его cron и файлы вне домашнего
+            # каталога, а архив его домашнего каталога отдаем root — иначе все
+            # это перейдет новому пользователю вместе с uid
+            await Provisioner.run("sudo", "pkill", "-KILL", "-u", old_name, ok_codes=(0, 1), node=node)
+            await Provisioner.run("sudo", "crontab", "-r", "-u", old_name, ok_codes=(0, 1), node=node)
+            await Provisioner.run(
+                "sudo", "find", *ORPHAN_FILE_DIRS, "-xdev", "-user", old_name, "-delete",
+                ok_codes=(0, 1), node=node
+            )
+            await Provisioner.run(
+                "sudo", "chown", "-R", "root:root", Provisioner.archive_dir(old_name),
+                ok_codes=(0, 1), node=node
+            )
+            await Provisioner.run("sudo", "usermod", "-l", ssh_name, "-d", home_dir, old_name, node=node)
+            # Личной группы может не быть (useradd -N) — код 6
+            await Provisioner.run("sudo", "groupmod", "-n", ssh_name, old_name, ok_codes=(0, 6), node=node)
+        async with Provisioner.slot(ssh_name):
+            await Provisioner.run("sudo", "cp", "-rT", "/etc/skel", home_dir, node=node)
+            await Provisioner.run("sudo", "chown", "-R", f"{ssh_name}:", home_dir, node=node)
+            await Provisioner.run("sudo", "chmod", "700", home_dir, node=node)
+        logger.info(f"Аккаунт {old_name} возвращен в пул сервера {node} как {ssh_name}")
+        return ssh_name
+
+    @classmethod
+    def ready_counts(cls):
+        return [({"node": node.name}, len(cls._ready[node.name])) for node in Fleet.nodes()]
+
+    @classmethod
+    def recycle(cls, ssh_name: str, node: str = None):
+        # Заблокированный аккаунт ждет ближайшего пополнения пула своего узла
+        if not cls._task or not Fleet.known(node):
+            return
+        cls._expired[Fleet.node(node).name].append(ssh_name)
+        cls.save()
+        cls._wakeup.set()
+
+    @classmethod
+    def refill(cls, node: str):
+        # Сначала истекшие аккаунты узла, useradd — на остаток дефицита
+        expired = cls._expired[node]
+        jobs = []
+        for _ in range(max(cls.deficit(node), 0)):
+            while expired and Database.get_user_by_ssh_name(expired[0]):
+                logger.info(f"Аккаунт {expired.popleft()} снова используется, в пул не идет")
+            if expired:
+                jobs.append(cls.add(node, cls.recycle_account, expired.popleft()))
+            else:
+                jobs.append(cls.add(node, cls.create))
+        if jobs:
+            cls.save()
+        return jobs
+
+    @classmethod
+    async def run(cls):
+        while True:
+            cls._wakeup.clear()
+            # Неудачные попытки повторим не раньше следующего интервала
+            await asyncio.gather(*(job for node in Fleet.nodes() for job in cls.refill(node.name)))
+            try:
+                await asyncio.wait_for(cls._wakeup.wait(), POOL_REFILL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    @classmethod
+    def start(cls):
+        if not POOL_SIZE:
+            return
+        cls.load()
+        cls._wakeup = asyncio.Event()
+        cls._task = asyncio.create_task(cls.run())
+
+    @classmethod
+    async def stop(cls):
+        if cls._task:
+            cls._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await cls._task
+            cls._task = None
+
+
+class ServerInfo:
+    # Адреса сервера без shell-конвейера: адрес маршрута по умолчанию
+    # (UDP connect ничего не отправляет) плюс IPv4 всех интерфейсов через
+    # ioctl. Результат кэшируется на SERVER_IP_TTL секунд и обновляется
+    # фоновой задачей; для тарифов из PLAN_SERVERS берутся их адреса
+    SIOCGIFADDR = 0x8915
+    _addresses = []
+    _resolved_at = 0.0
+
+    @classmethod
+    def resolve(cls):
+        addresses = []
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.connect(("8.8.8.8", 80))
+                addresses.append(s.getsockname()[0])
+        except OSError:
+            pass
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            for _, name in socket.if_nameindex():
+                try:
+                    packed = fcntl.ioctl(s.fileno(), cls.SIOCGIFADDR, struct.pack('256s', name[:15].encode()))
+                except OSError:
+                    continue
+                ip = socket.inet_ntoa(packed[20:24])
+                if not ip.startswith("127.") and ip not in addresses:
+                    addresses.append(ip)
+        return addresses
+
+    @classmethod
+    def refresh(cls):
+        addresses = cls.resolve()
+        if addresses != cls._addresses:
+            logger.info(f"Адреса сервера: {', '.join(addresses) or 'нет'}")
+        cls._addresses = addresses
+        cls._resolved_at = time.monotonic()
+        return addresses
+
+    @classmethod
+    def addresses(cls):
+        if not cls._addresses or time.monotonic() - cls._resolved_at > SERVER_IP_TTL:
+            return cls.refresh()
+        return cls._addresses
+
+    @classmethod
+    def endpoints(cls, plan: str = None):
+        # [(host, port), ...] для тарифа пользователя
+        servers = PLAN_SERVERS.get(plan) or PLAN_SERVERS.get("default")
+        if servers:
+            return [(host, int(port)) for host, _, port in (s.rpartition(":") for s in servers)]
+        return [(ip, SSH_PORT) for ip in cls.addresses()[:1]]
+
+class ExpiryScheduler:
+    # Min-heap (время срабатывания, user_id) с ленивым удалением: актуальное
+    # время для пользователя лежит в _fire_at, устаревшие записи кучи
+    # отбрасываются при извлечении. Цикл спит до ближайшего истечения
+    _heap = []
+    _fire_at = {}
+    _wakeup = None
+    _task = None
+
+    @classmethod
+    def rebuild(cls):
+        cls._fire_at = {}
+        for user in Database.get_users_with_expiry():
+            cls._fire_at[user.user_id] = user.expire_at
+        cls._heap = [(fire_at, user_id) for user_id, fire_at in cls._fire_at.items()]
+        heapq.heapify(cls._heap)
+
+    @classmethod
+    def push(cls, user_id: int, fire_at: datetime):
+        cls._fire_at[user_id] = fire_at
+        heapq.heappush(cls._heap, (fire_at, user_id))
+        if len(cls._heap) > 2 * len(cls._fire_at) + 64:
+            cls._heap = [(f, u) for u, f in cls._fire_at.items()]
+            heapq.heapify(cls._heap)
+        if cls._wakeup and cls._heap[0] == (fire_at, user_id):
+            cls._wakeup.set()
+
+    @classmethod
+    def depth(cls):
+        return len(cls._fire_at)
+
+    @classmethod
+    def schedule(cls, user: UserRecord):
+        user_id = user.user_id
+        expiry = user.expire_at
+        if expiry is None:
+            cls._fire_at.pop(user_id, None)
+        elif cls._fire_at.get(user_id) != expiry:
+            cls.push(user_id, expiry)
+
+    @classmethod
+    def unschedule(cls, user_id: int):
+        cls._fire_at.pop(user_id, None)
+
+    @classmethod
+    def pop_due(cls, now: datetime):
+        due = []
+        while cls._heap and cls._heap[0][0] <= now:
+            fire_at, user_id = heapq.heappop(cls._heap)
+            if cls._fire_at.get(user_id) == fire_at:
+                del cls._fire_at[user_id]
+                due.append(user_id)
+        return due
+
+    @classmethod
+    async def run(cls):
+        cls._wakeup = asyncio.Event()
+        while True:
+            due = cls.pop_due(datetime.now())
+            if due:
+                # Ошибка итерации не останавливает цикл: неотключенные
+                # пользователи повторяются позже, если их не перепланировали
+                try:
+                    users = [u for u in map(Database.get_user, due) if u and u.ssh_name]
+                    retry = [user.user_id for user in await expire_users(users)]
+                except Exception as e:
+                    logger.error(f"Ошибка планировщика истечений: {e}")
+                    retry = due
+                retry_at = datetime.now() + timedelta(seconds=EXPIRY_RETRY_DELAY)
+                for user_id in retry:
+                    if user_id not in cls._fire_at:
+                        cls.push(user_id, retry_at)
+                continue
+            timeout = (cls._heap[0][0] - datetime.now()).total_seconds() if cls._heap else None
+            cls._wakeup.clear()
+            try:
+                await asyncio.wait_for(cls._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    @classmethod
+    def start(cls):
+        cls.rebuild()
+        cls._task = asyncio.create_task(cls.run())
+
+    @classmethod
+    async def stop(cls):
+        if cls._task:
+            cls._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await cls._task
+            cls._task = None
+
+class PaymentLog:
+    # Журнал переходов платежей: JSON Lines, только дозапись, fsync на каждую
+    # запись. Пишется раньше БД (у которой отложенная запись), поэтому после
+    # падения состояние платежей восстанавливается его проигрыванием.
+    # Сжатие — как у журнала БД, где снимком служит сама БД: текущий файл
+    # откладывается в .old (новые записи идут в свежий), БД сбрасывается, и
+    # только после надежного сброса .old удаляется
+    def __init__(self, path: str = PAYMENT_LOG_FILE):
+        self.path = path
+        self.old_path = f"{path}.old"
+
+    def append(self, record: dict):
+        line = Codec.dumps(record) + b"\n"
+        with open(self.path, 'ab') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replay(self):
+        for path in (self.old_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        yield Codec.loads(line)
+                    except ValueError:
+                        # Оборванная последняя строка после падения
+                        logger.warning(f"Пропущена поврежденная запись журнала платежей: {line[:80]!r}")
+
+    def rotate(self):
+        # .old от неудавшегося сброса не трогаем: новые записи останутся в
+        # текущем файле до следующего сжатия
+        if not os.path.exists(self.old_path) and os.path.exists(self.path):
+            os.replace(self.path, self.old_path)
+
+    def discard_rotated(self):
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+
+
+class PaymentStateMachine:
+    # CREATED -> APPROVED -> CAPTURED -> ACTIVATED, плюс EXPIRED/VOIDED для
+    # неоплаченных. Переход возможен только вперед и пишется сначала в
+    # журнал, потом в БД; повторный переход — no-op, поэтому повторы и
+    # параллельные проверки не могут дважды продлить подписку
+    ORDER = ("CREATED", "APPROVED", "CAPTURED", "ACTIVATED")
+    TERMINAL = ("EXPIRED", "VOIDED")
+    LEGACY = {"COMPLETED": "ACTIVATED"}  # статус старых записей DB.json
+    _log = None
+
+    @classmethod
+    def log(cls):
+        if cls._log is None:
+            cls._log = PaymentLog()
+        return cls._log
+
+    @classmethod
+    def state(cls, payment: PaymentRecord):
+        return cls.LEGACY.get(payment.status, payment.status)
+
+    @classmethod
+    def can_transition(cls, current: str, target: str):
+        if current == target or current in cls.TERMINAL:
+            return False
+        if target in cls.TERMINAL:
+            return current in ("CREATED", "APPROVED")
+        if current not in cls.ORDER:
+            # Сырой статус PayPal из старых записей — считаем неоплаченным
+            return True
+        return cls.ORDER.index(target) > cls.ORDER.index(current)
+
+    @classmethod
+    def create(cls, user_id: int, order_id: str, plan: str, amount: float, currency: str = "EUR", **extra):
+        if Database.get_payment(order_id):
+            return False
+        cls.log().append(dict(
+            extra,
+            ts=datetime.now().isoformat(),
+            order_id=order_id,
+            to="CREATED",
+            user_id=user_id,
+            plan=plan,
+            amount=amount,
+            currency=currency
+        ))
+        Database.add_payment(user_id, order_id, plan, amount, currency, **extra)
+        return True
+
+    @classmethod
+    def unpaid_order(cls, user_id: int, plan: str):
+        # Последний еще не оплаченный заказ пользователя на этот тариф
+        orders = [
+            payment for payment in Database.get_user_payments(user_id).values()
+            if payment.plan == plan and cls.state(payment) in ("CREATED", "APPROVED") and payment.extra.get("approval_url")
+        ]
+        return max(orders, key=lambda p: p.created_at or datetime.min, default=None)
+
+    @classmethod
+    def transition(cls, order_id: str, target: str, source: str, **data):
+        payment = Database.get_payment(order_id)
+        if not payment or not cls.can_transition(cls.state(payment), target):
+            return False
+        cls.log().append(dict(data, ts=datetime.now().isoformat(), order_id=order_id, to=target, source=source))
+        Database.update_payment_status(order_id, target)
+        return True
+
+    @classmethod
+    def activate(cls, order_id: str, source: str):
+        payment = Database.get_payment(order_id)
+        if not payment or cls.state(payment) != "CAPTURED":
+            return False
+        # Продление от max(срок, сейчас), как у купонов: оставшиеся дни не теряются
+        db_user = Database.get_user(payment.user_id)
+        now = datetime.now()
+        start = max(db_user.expire_at or now, now) if db_user else now
+        expiry = start + timedelta(days=PLAN_DAYS.get(payment.plan, 30))
+        cls.transition(order_id, "ACTIVATED", source, user_id=payment.user_id, plan=payment.plan, expire_datetime=expiry.isoformat())
+        activate_subscription(payment.user_id, payment.plan, expiry)
+        Provisioner.enqueue(payment.user_id)
+        return True
+
+    @classmethod
+    def recover(cls):
+        # Доводит БД до состояния журнала: восстанавливает потерянные платежи,
+        # статусы и сроки подписки активированных заказов. Срок возвращается,
+        # только если БД не успела записать саму активацию — иначе отмененная
+        # (/cancel) подписка воскресала бы при каждом старте. Идемпотентно
+        recovered = 0
+        for record in cls.log().replay():
+            order_id, target = record["order_id"], record["to"]
+            payment = Database.get_payment(order_id)
+            if target == "CREATED":
+                if not payment:
+                    extra = {"approval_url": record["approval_url"]} if "approval_url" in record else {}
+                    Database.add_payment(record["user_id"], order_id, record["plan"], record["amount"], record["currency"], **extra)
+                    recovered += 1
+                continue
+            was_activated = payment is not None and cls.state(payment) == "ACTIVATED"
+            if payment and cls.can_transition(cls.state(payment), target):
+                Database.update_payment_status(order_id, target)
+                recovered += 1
+            if target == "ACTIVATED" and not was_activated:
+                db_user = Database.get_user(record["user_id"])
+                expiry = datetime.fromisoformat(record["expire_datetime"])
+                if not db_user or (db_user.expire_at or datetime.min) < expiry:
+                    activate_subscription(record["user_id"], record["plan"], expiry)
+                    recovered += 1
+        if recovered:
+            logger.info(f"Из журнала платежей восстановлено изменений: {recovered}")
+        cls.log().rotate()
+        if Database.flush():
+            cls.log().discard_rotated()
+
+    @classmethod
+    async def compact(cls):
+        # Между rotate и снимком в flush_async нет await: снимок БД покрывает
+        # все записи отложенного файла. Если сброс не удался или уже шел
+        # (тогда его снимок старше), .old остается до следующего раза
+        cls.log().rotate()
+        if await Database.flush_async():
+            cls.log().discard_rotated()
+
+class PaymentReconciler:
+    # Фоновая сверка платежей в статусах CREATED/APPROVED с PayPal: за один
+    # проход не больше RECONCILE_BATCH_SIZE заказов (ограничение частоты
+    # запросов), для каждого заказа — экспоненциальная пауза между проверками.
+    # Одобренные заказы списываются, пользователю приходит уведомление
+    _next_check = {}
+
+    @classmethod
+    def backoff(cls, order_id: str):
+        _, attempt = cls._next_check.get(order_id, (0.0, 0))
+        delay = min(RECONCILE_BASE_DELAY * 2 ** attempt, RECONCILE_MAX_DELAY)
+        cls._next_check[order_id] = (time.monotonic() + delay, attempt + 1)
+
+    @classmethod
+    def expedite(cls, order_id: str):
+        cls._next_check.pop(order_id, None)
+
+    @classmethod
+    def due_orders(cls, pending: dict):
+        now = time.monotonic()
+        for order_id in list(cls._next_check):
+            if order_id not in pending:
+                del cls._next_check[order_id]
+        due = [order_id for order_id in pending if cls._next_check.get(order_id, (0.0, 0))[0] <= now]
+        return due[:RECONCILE_BATCH_SIZE]
+
+    @classmethod
+    async def check(cls, order_id: str, payment: PaymentRecord):
+        unpaid = PaymentStateMachine.state(payment) in ("CREATED", "APPROVED")
+        # Запись без created_at (старые DB.json) считаем просроченной
+        expired = payment.created_at is None or datetime.now() - payment.created_at > timedelta(seconds=RECONCILE_MAX_AGE)
+        if unpaid and expired:
+            # Неоплаченные заказы PayPal все равно истекают — перестаем опрашивать
+            PaymentStateMachine.transition(order_id, "EXPIRED", "reconciler")
+            return
+        
+        result = await settle_payment(order_id, "reconciler")
+        if result == "ACTIVATED":
+            # Активировал кто-то другой (/check_payment, вебхук) — он и уведомил
+            return
+        if result in ("COMPLETED", "CAPTURED"):
+            user_id = payment.user_id
+            logger.info(f"Платеж {order_id} пользователя {user_id} подтвержден сверкой")
+            Outbox.send(user_id, I18n.t(user_id, "check_completed", plan=payment.plan))
+        else:
+            cls.backoff(order_id)
+
+    @classmethod
+    async def run_once(cls):
+        pending = Database.get_pending_payments()
+        due = cls.due_orders(pending)
+        results = await asyncio.gather(
+            *(cls.check(order_id, pending[order_id]) for order_id in due),
+            return_exceptions=True
+        )
+        for order_id, result in zip(due, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка сверки платежа {order_id}: {result}")
+                cls.backoff(order_id)
+
+class HttpServer:
+    # Минимальный HTTP/1.1 сервер на asyncio для локальных эндпоинтов
+    # (вебхуки, healthz). Обработчик маршрута: async (headers, body) ->
+    # (status, dict | str); dict отдается как JSON
+    REASONS = {
+        200: "OK",
+        400: "Bad Request",
+        403: "Forbidden",
+        404: "Not Found",
+        413: "Payload Too Large",
+        500: "Internal Server Error",
+        503: "Service Unavailable"
+    }
+    MAX_BODY = 1 << 20
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self.server = None
+
+    def route(self, method: str, path: str, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        # port=0 — свободный порт (для тестов), запоминаем фактический
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"HTTP сервер слушает {self.host}:{self.port}")
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def respond(self, writer, status: int, payload, keep_alive: bool):
+        if isinstance(payload, (dict, list)):
+            body, content_type = Codec.dumps(payload), "application/json"
+        else:
+            body, content_type = str(payload).encode(), "text/plain; charset=utf-8"
+        head = (
+            f"HTTP/1.1 {status} {self.REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode() + body)
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                
+                length = int(headers.get("content-length", 0))
+                if length > self.MAX_BODY:
+                    await self.respond(writer, 413, "payload too large", False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                
+                handler = self.routes.get((method, target.split("?", 1)[0]))
+                if handler is None:
+                    status, payload = 404, "not found"
+                else:
+                    try:
+                        status, payload = await handler(headers, body)
+                    except Exception as e:
+                        logger.error(f"Ошибка обработки {method} {target}: {e}", exc_info=True)
+                        status, payload = 500, "internal error"
+                await self.respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Апдейты разных пользователей обрабатываются параллельно (не больше
+    # concurrency), апдейты одного пользователя — строго по очереди.
+    # Семафор базового класса (@final process_update) берется до нашего
+    # лока, поэтому он лишь ограничивает число ожидающих задач, а реальный
+    # лимит параллельности — собственный семафор, который берется уже
+    # после лока пользователя: очередь одного спамера не занимает слоты
+    def __init__(self, concurrency: int, max_pending: int = None):
+        super().__init__(max_pending or concurrency * 64)
+        self.concurrency = concurrency
+        self._semaphore_active = None
+        self._locks = KeyedLock()
+        self._admitted = set()
+
+    @staticmethod
+    def update_key(update: object):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    def admit(self, update: Update, limit: int):
+        # Приложение сразу забирает апдейт из update_queue и создает задачу,
+        # поэтому буфер — это принятые и еще не обработанные апдейты: их
+        # считаем сами, вебхук отвечает 503 сверх limit
+        if len(self._admitted) >= limit:
+            return False
+        self._admitted.add(update.update_id)
+        return True
+
+    def pending(self):
+        return len(self._admitted)
+
+    async def initialize(self) -> None:
+        self._semaphore_active = asyncio.Semaphore(self.concurrency)
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        try:
+            await self.process_in_order(update, coroutine)
+        finally:
+            if isinstance(update, Update):
+                self._admitted.discard(update.update_id)
+
+    async def process_in_order(self, update: object, coroutine) -> None:
+        # Лимит частоты — до лока пользователя: лишние апдейты спамера
+        # отбрасываются сразу, а не копятся в очереди за его локом
+        if isinstance(update, Update) and await RateLimiter.reject(update):
+            coroutine.close()
+            return
+        
+        key = self.update_key(update)
+        if key is None:
+            async with self._semaphore_active:
+                await coroutine
+            return
+        
+        async with self._locks.hold(key), self._semaphore_active:
+            await coroutine
+
+
+class TokenBucket:
+    # rate жетонов в секунду, не больше capacity; take() — без блокировок
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self, now: float):
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter:
+    # Ограничение частоты до разбора апдейта хендлерами: общий бакет на бота
+    # и бакеты (user_id, вид запроса) с лимитами из RATE_LIMITS. Отказ —
+    # только словарь и арифметика, без БД. Полные (простаивающие) бакеты
+    # выбрасываются, когда их становится больше RATE_LIMIT_MAX_TRACKED
+    _buckets = {}
+    _global = None
+    _notified = {}
+
+    @staticmethod
+    def kind(update: Update):
+        if update.callback_query and (update.callback_query.data or "").startswith("pay:"):
+            return "pay"
+        text = update.message.text if update.message else None
+        if text and text.startswith("/"):
+            command = text[1:].split("@", 1)[0].split(maxsplit=1)
+            if command and command[0].lower() in RATE_LIMITS:
+                return command[0].lower()
+        return "default"
 
     @classmethod
-    def get_access_token(cls):
-        url = f"{cls.BASE_URL[PAYPAL_MODE]}/v1/oauth2/token"
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-        }
-        data = {"grant_type": "client_credentials"}
-        response = requests.post(url, headers=headers, data=data, auth=(PAYPAL_CLIENT_ID, PAYPAL_SECRET))
-        if response.status_code == 200:
-            return response.json().get("access_token")
-        logger.error(f"PayPal auth error: {response.text}")
-        return None
+    def allow(cls, user_id: int, kind: str):
+        now = time.monotonic()
+        if cls._global is None:
+            cls._global = TokenBucket(*RATE_LIMIT_GLOBAL, now)
+        key = (user_id, kind)
+        bucket = cls._buckets.get(key)
+        if bucket is None:
+            if len(cls._buckets) >= RATE_LIMIT_MAX_TRACKED:
+                cls.prune(now)
+            bucket = cls._buckets[key] = TokenBucket(*RATE_LIMITS[kind], now)
+        return bucket.take(now) and cls._global.take(now)
 
     @classmethod
-    def create_order(cls, amount, currency, description):
-        url = f"{cls.BASE_URL[PAYPAL_MODE]}/v2/checkout/orders"
-        access_token = cls.get_access_token()
-        if not access_token:
-            return None
+    def prune(cls, now: float):
+        for key, bucket in list(cls._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del cls._buckets[key]
+        for user_id, notified_at in list(cls._notified.items()):
+            if now - notified_at > RATE_LIMIT_NOTICE_INTERVAL:
+                del cls._notified[user_id]
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {access_token}",
-            "PayPal-Request-Id": f"ORDER-{random.randint(100000, 999999)}"
-        }
-        
-        payload = {
-            "intent": "CAPTURE",
-            "purchase_units": [{
-                "amount": {
-                    "currency_code": currency,
-                    "value": str(amount)
-                },
-                "description": description
-            }]
-        }
-        
-        response = requests.post(url, headers=headers, json=payload)
-        if response.status_code == 201:
-            return response.json()
-        logger.error(f"PayPal create order error: {response.text}")
-        return None
+    @classmethod
+    def should_notify(cls, user_id: int):
+        # Одно предупреждение за интервал, остальное отбрасывается молча
+        now = time.monotonic()
+        if now - cls._notified.get(user_id, -RATE_LIMIT_NOTICE_INTERVAL) < RATE_LIMIT_NOTICE_INTERVAL:
+            return False
+        cls._notified[user_id] = now
+        return True
 
     @classmethod
-    def capture_order(cls, order_id):
-        url = f"{cls.BASE_URL[PAYPAL_MODE]}/v2/checkout/orders/{order_id}/capture"
-        access_token = cls.get_access_token()
-        if not access_token:
-            return None
+    async def reject(cls, update: Update):
+        # True — апдейт отброшен, хендлеры его не увидят
+        user = update.effective_user
+        kind = cls.kind(update)
+        if user is None or cls.allow(user.id, kind):
+            return False
+        Metrics.inc("rate_limited_total", kind=kind)
+        if cls.should_notify(user.id):
+            text = I18n.t(user.id, "rate_limited")
+            try:
+                if update.callback_query:
+                    await update.callback_query.answer(text)
+                elif update.effective_message:
+                    await update.effective_message.reply_text(text)
+            except Exception as e:
+                logger.error(f"Не удалось предупредить пользователя {user.id}: {e}")
+        return True
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {access_token}"
-        }
-        
-        response = requests.post(url, headers=headers)
-        if response.status_code == 201:
-            return response.json()
-        logger.error(f"PayPal capture error: {response.text}")
-        return None
+
+class Outbox:
+    # Очередь исходящих сообщений с лимитами Telegram: общий бакет на бота
+    # (OUTBOX_RATE в секунду) и не чаще раза в OUTBOX_CHAT_INTERVAL в один
+    # чат. Очередь — min-heap по времени, раньше которого сообщение слать
+    # нельзя. На диске — OUTBOX_FILE в JSON Lines: "add" при постановке и
+    # "done" после доставки/отказа; при старте недоставленное ставится
+    # заново (доставка "хотя бы один раз"). RetryAfter ставит на паузу всю
+    # отправку, сетевые ошибки — повтор с паузой, Forbidden/BadRequest —
+    # окончательный отказ. Рассылки (job) считают sent/failed для прогресса;
+    # итоги рассылки — запись "job", исход сообщения — в его "done"
+    _heap = []
+    _seq = 0
+    _jobs = {}
+    _chat_ready_at = {}
+    _paused_until = 0.0
+    _bucket = None
+    _file = None
+    _wakeup = None
+    _task = None
+    _inflight = set()
+
+    @classmethod
+    def open(cls, path: str = OUTBOX_FILE):
+        pending = {}
+        jobs = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = Codec.loads(line)
+                    except ValueError:
+                        logger.warning(f"Пропущена поврежденная запись очереди сообщений: {line[:80]!r}")
+                        continue
+                    if record["op"] == "add":
+                        pending[record["id"]] = record
+                    elif record["op"] == "job":
+                        jobs[record["job"]] = record
+                    else:
+                        pending.pop(record["id"], None)
+                        job = jobs.get(record.get("job"))
+                        if job:
+                            outcome = "sent" if record.get("ok", True) else "failed"
+                            job[outcome] = job.get(outcome, 0) + 1
+        # Переписываем файл только с недоставленным и итогами последних
+        # рассылок — он не растет между запусками
+        active = {record.get("job") for record in pending.values()}
+        finished = [job for job in jobs if job not in active]
+        for job in finished[:-OUTBOX_JOBS_KEPT]:
+            del jobs[job]
+        cls._file = open(f"{path}.tmp", 'wb')
+        cls._heap = []
+        cls._jobs = {}
+        # Номер не переиспользуется и после доставки всего: из него id рассылок
+        cls._seq = max([*pending, *(job["seq"] for job in jobs.values())], default=0)
+        for job, record in jobs.items():
+            cls.track(job, total=record["total"], sent=record.get("sent", 0), failed=record.get("failed", 0))
+        for record in pending.values():
+            if record.get("job") not in jobs:
+                # Файл без записей "job": итог — по недоставленному
+                cls.track(record.get("job"), total=1)
+            cls.push(dict(record, attempt=0), 0.0)
+        cls.write([
+            {"op": "job", "job": job, "seq": record["seq"], **cls._jobs[job]}
+            for job, record in jobs.items()
+        ])
+        cls.write([{k: v for k, v in r.items() if k != "attempt"} for r in pending.values()])
+        cls._file.close()
+        os.replace(f"{path}.tmp", path)
+        cls._file = open(path, 'ab')
+        if pending:
+            logger.info(f"В очереди сообщений после перезапуска: {len(pending)}")
+
+    @classmethod
+    def write(cls, records: list):
+        if records:
+            cls._file.write(b"".join(Codec.dumps(r) + b"\n" for r in records))
+            cls._file.flush()
+
+    @classmethod
+    def depth(cls):
+        return len(cls._heap) + len(cls._inflight)
+
+    @classmethod
+    def push(cls, message: dict, not_before: float):
+        heapq.heappush(cls._heap, (not_before, message["id"], message))
+        if cls._wakeup:
+            cls._wakeup.set()
+
+    @classmethod
+    def track(cls, job: str, **counts):
+        if job is None:
+            return
+        progress = cls._jobs.setdefault(job, {"total": 0, "sent": 0, "failed": 0})
+        for name, value in counts.items():
+            progress[name] += value
+
+    @classmethod
+    def enqueue(cls, chat_ids, text: str, job: str = None):
+        if cls._file is None:
+            cls.open()
+        records = []
+        for chat_id in chat_ids:
+            cls._seq += 1
+            records.append({"op": "add", "id": cls._seq, "chat_id": chat_id, "text": text, "job": job})
+        summary = [{"op": "job", "job": job, "seq": cls._seq, "total": len(records)}] if job is not None else []
+        cls.write(records + summary)
+        os.fsync(cls._file.fileno())
+        cls.track(job, total=len(records))
+        for record in records:
+            cls.push(dict(record, attempt=0), 0.0)
+        return len(records)
 
     @classmethod
-    def get_order_details(cls, order_id):
-        url = f"{cls.BASE_URL[PAYPAL_MODE]}/v2/checkout/orders/{order_id}"
-        access_token = cls.get_access_token()
-        if not access_token:
+    def send(cls, chat_id: int, text: str):
+        cls.enqueue([chat_id], text)
+
+    @classmethod
+    def broadcast(cls, text: str, user_ids=None):
+        # id рассылки — из того же счетчика, что и сообщения: уникален и при
+        # нескольких рассылках в секунду, и после перезапуска
+        if cls._file is None:
+            cls.open()
+        cls._seq += 1
+        job = f"B{cls._seq}"
+        total = cls.enqueue(Database.get_user_ids() if user_ids is None else user_ids, text, job)
+        logger.info(f"Рассылка {job}: {total} получателей")
+        return job, total
+
+    @classmethod
+    def progress(cls, job: str):
+        progress = cls._jobs.get(job)
+        if progress is None:
             return None
+        return dict(progress, pending=progress["total"] - progress["sent"] - progress["failed"])
 
-        headers = {
-            "Authorization": f"Bearer {access_token}"
-        }
-        
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            return response.json()
-        logger.error(f"PayPal get order error: {response.text}")
-        return None
+    @classmethod
+    def wait_time(cls, now: float):
+        if not cls._heap:
+            return None
+        cls._bucket.refill(now)
+        bucket_wait = (1 - cls._bucket.tokens) / cls._bucket.rate if cls._bucket.tokens < 1 else 0.0
+        return max(cls._heap[0][0] - now, cls._paused_until - now, bucket_wait, 0.0)
 
-class Database:
-    @staticmethod
-    def load():
+    @classmethod
+    async def run(cls, bot):
+        cls._wakeup = asyncio.Event()
+        semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        while True:
+            now = time.monotonic()
+            timeout = cls.wait_time(now)
+            if timeout != 0.0:
+                cls._wakeup.clear()
+                try:
+                    await asyncio.wait_for(cls._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, message = heapq.heappop(cls._heap)
+            ready_at = cls._chat_ready_at.get(message["chat_id"], 0.0)
+            if ready_at > now:
+                cls.push(message, ready_at)
+                continue
+            cls._bucket.take(now)
+            cls._chat_ready_at[message["chat_id"]] = now + OUTBOX_CHAT_INTERVAL
+            await semaphore.acquire()
+            task = asyncio.create_task(cls.deliver(bot, message))
+            cls._inflight.add(task)
+            task.add_done_callback(lambda t: (cls._inflight.discard(t), semaphore.release()))
+            if len(cls._chat_ready_at) > RATE_LIMIT_MAX_TRACKED:
+                cls._chat_ready_at = {c: t for c, t in cls._chat_ready_at.items() if t > now}
+
+    @classmethod
+    async def deliver(cls, bot, message: dict):
         try:
-            if not os.path.exists(DB_FILE):
-                return Database.initialize_db()
-            with open(DB_FILE, 'r') as f:
-                return json.load(f)
+            await bot.send_message(chat_id=message["chat_id"], text=message["text"])
+            ok = True
+        except RetryAfter as e:
+            delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            logger.warning(f"Telegram просит паузу {delay} с в отправке сообщений")
+            cls._paused_until = max(cls._paused_until, time.monotonic() + delay)
+            cls.push(message, cls._paused_until)
+            return
+        except (Forbidden, BadRequest) as e:
+            logger.info(f"Сообщение в чат {message['chat_id']} не доставлено: {e}")
+            ok = False
         except Exception as e:
-            logger.error(f"Ошибка загрузки БД: {e}")
-            return Database.initialize_db()
+            message["attempt"] += 1
+            if message["attempt"] < OUTBOX_RETRIES:
+                cls.push(message, time.monotonic() + OUTBOX_CHAT_INTERVAL * 2 ** message["attempt"])
+                return
+            logger.error(f"Сообщение в чат {message['chat_id']} не доставлено после {message['attempt']} попыток: {e}")
+            ok = False
+        job = message.get("job")
+        done = {"op": "done", "id": message["id"]}
+        if job is not None:
+            done.update(job=job, ok=ok)
+        cls.write([done])
+        cls.track(job, **{"sent" if ok else "failed": 1})
 
-    @staticmethod
-    def initialize_db():
-        default_data = {
-            "users": [],
-            "purchase_options": {
-                "1m": {"Stripe_EUR": 2, "Litecoin_LTC": 0.004, "comment": "1month subscription"},
-                "2m": {"Stripe_EUR": 4, "Litecoin_LTC": 0.008, "comment": "2month subscription"},
-                "3m": {"Stripe_EUR": 5, "Litecoin_LTC": 0.010, "comment": "3month subscription"},
-                "6m": {"Stripe_EUR": 8, "Litecoin_LTC": 0.016, "comment": "6month subscription"},
-                "1y": {"Stripe_EUR": 10, "Litecoin_LTC": 0.020, "comment": "1year subscription"},
-                "5y": {"Stripe_EUR": 40, "Litecoin_LTC": 0.080, "comment": "5year subscription"}
-            },
-            "coupons": {
-                "freeweek": {"quantity": 2, "TimeLength": "1w"},
-                "freemonth": {"quantity": 2, "TimeLength": "1m"}
-            }
-        }
-        Database.save(default_data)
-        return default_data
+    @classmethod
+    def start(cls, bot):
+        if cls._file is None:
+            cls.open()
+        # Запас в один жетон: равномерный темп без всплеска на старте
+        cls._bucket = TokenBucket(OUTBOX_RATE, 1, time.monotonic())
+        cls._task = asyncio.create_task(cls.run(bot))
 
-    @staticmethod
-    def save(data):
-        try:
-            with open(DB_FILE, 'w') as f:
-                json.dump(data, f, indent=4, ensure_ascii=False)
-        except Exception as e:
-            logger.error(f"Ошибка сохранения БД: {e}")
+    @classmethod
+    async def stop(cls):
+        if cls._task:
+            cls._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await cls._task
+            cls._task = None
+        # Отправки в полете дожидаемся: иначе их "done" не попадет в файл
+        if cls._inflight:
+            await asyncio.gather(*cls._inflight, return_exceptions=True)
+        if cls._file:
+            cls._file.close()
+            cls._file = None
 
-    @staticmethod
-    def get_user(user_id: str):
-        db = Database.load()
-        return next((u for u in db["users"] if u["user_id"] == user_id), None)
 
-    @staticmethod
-    def update_user(user_data: dict):
-        db = Database.load()
-        for i, user in enumerate(db["users"]):
-            if user["user_id"] == user_data["user_id"]:
-                db["users"][i] = user_data
-                break
-        else:
-            db["users"].append(user_data)
-        Database.save(db)
+class WebhookServer:
+    # Прием апдейтов Telegram по вебхуку вместо run_polling. Не больше
+    # WEBHOOK_QUEUE_SIZE принятых и еще не обработанных апдейтов; сверх
+    # этого — 503, и Telegram повторит доставку позже
+    def __init__(self, application: Application, http: HttpServer):
+        self.application = application
+        http.route("POST", WEBHOOK_PATH, self.handle_update)
+        http.route("GET", "/healthz", self.health)
 
-    @staticmethod
-    def remove_user(user_id: str):
-        db = Database.load()
-        db["users"] = [u for u in db["users"] if u["user_id"] != user_id]
-        Database.save(db)
+    async def handle_update(self, headers: dict, body: bytes):
+        if WEBHOOK_SECRET and headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+            return 403, "forbidden"
+        try:
+            data = Codec.loads(body)
+            # Валидный JSON, но не объект ([1,2], "x") — тоже некорректный апдейт
+            if not isinstance(data, dict):
+                raise TypeError(f"ожидался объект, получен {type(data).__name__}")
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.warning(f"Некорректный апдейт в вебхуке: {e}")
+            return 400, "bad update"
+        if not self.application.update_processor.admit(update, WEBHOOK_QUEUE_SIZE):
+            logger.warning("Очередь апдейтов переполнена, отвечаем 503")
+            return 503, "queue full"
+        self.application.update_queue.put_nowait(update)
+        return 200, "ok"
 
-    @staticmethod
-    def add_payment(user_id: str, order_id: str, plan: str, amount: float, currency: str = "EUR"):
-        db = Database.load()
-        if "payments" not in db:
-            db["payments"] = {}
-            
-        db["payments"][order_id] = {
-            "user_id": user_id,
-            "plan": plan,
-            "amount": amount,
-            "currency": currency,
-            "status": "CREATED",
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat()
+    def pending(self):
+        return self.application.update_processor.pending()
+
+    async def health(self, headers: dict, body: bytes):
+        return (200 if self.application.running else 503), {
+            "status": "ok" if self.application.running else "stopped",
+            "queue_size": self.pending(),
+            "queue_limit": WEBHOOK_QUEUE_SIZE
         }
-        Database.save(db)
 
-    @staticmethod
-    def update_payment_status(order_id: str, status: str):
-        db = Database.load()
-        if "payments" in db and order_id in db["payments"]:
-            db["payments"][order_id]["status"] = status
-            db["payments"][order_id]["updated_at"] = datetime.now().isoformat()
-            Database.save(db)
-            return True
-        return False
+    async def start(self):
+        if WEBHOOK_URL:
+            await self.application.bot.set_webhook(
+                WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES
+            )
+
+class PayPalWebhook:
+    # Прием событий PayPal: CHECKOUT.ORDER.APPROVED и PAYMENT.CAPTURE.COMPLETED
+    # меняют статус платежа и срок подписки локально, без опроса Orders API.
+    # Подлинность проверяется через verify-webhook-signature, повторные
+    # доставки отсеиваются по id события
+    def __init__(self, application: Application, http: HttpServer):
+        self.application = application
+        self.seen_events = collections.OrderedDict()
+        http.route("POST", PAYPAL_WEBHOOK_PATH, self.handle_event)
+
+    def remember(self, event_id: str):
+        self.seen_events[event_id] = True
+        if len(self.seen_events) > PAYPAL_WEBHOOK_DEDUP_SIZE:
+            self.seen_events.popitem(last=False)
 
     @staticmethod
-    def get_payment(order_id: str):
-        db = Database.load()
-        return db.get("payments", {}).get(order_id)
+    def parse(body: bytes):
+        # (событие, id заказа); TypeError/KeyError/ValueError — некорректное
+        # событие: на 500 PayPal повторял бы доставку бесконечно
+        event = Codec.loads(body)
+        if not isinstance(event, dict) or not isinstance(event["id"], str):
+            raise TypeError("событие — не объект с id")
+        resource = event.get("resource", {})
+        if not isinstance(resource, dict):
+            raise TypeError("resource — не объект")
+        if event.get("event_type") == "PAYMENT.CAPTURE.COMPLETED":
+            related = resource.get("supplementary_data", {})
+            related = related.get("related_ids", {}) if isinstance(related, dict) else None
+            if not isinstance(related, dict):
+                raise TypeError("supplementary_data.related_ids — не объект")
+            order_id = related.get("order_id")
+        else:
+            order_id = resource.get("id")
+        if order_id is not None and not isinstance(order_id, str):
+            raise TypeError("id заказа — не строка")
+        return event, order_id
+
+    async def handle_event(self, headers: dict, body: bytes):
+        try:
+            event, order_id = self.parse(body)
+        except (ValueError, KeyError, TypeError):
+            return 400, "bad event"
+        event_id = event["id"]
+        if event_id in self.seen_events:
+            return 200, "duplicate"
+        
+        # Запоминаем до проверки подписи, чтобы параллельная повторная
+        # доставка не прошла второй раз
+        self.remember(event_id)
+        if PAYPAL_WEBHOOK_VERIFY and not await PayPalClient.verify_webhook_signature(headers, event):
+            self.seen_events.pop(event_id, None)
+            logger.warning(f"Событие PayPal {event_id} не прошло проверку подписи")
+            return 403, "verification failed"
+        
+        event_type = event.get("event_type")
+        if event_type == "CHECKOUT.ORDER.APPROVED":
+            await self.order_approved(order_id)
+        elif event_type == "PAYMENT.CAPTURE.COMPLETED":
+            await self.capture_completed(order_id)
+        return 200, "ok"
+
+    async def order_approved(self, order_id: str):
+        payment = Database.get_payment(order_id) if order_id else None
+        if not payment:
+            logger.warning(f"Событие PayPal для неизвестного заказа {order_id}")
+            return
+        PaymentStateMachine.transition(order_id, "APPROVED", "paypal_webhook", event="CHECKOUT.ORDER.APPROVED")
+        # Списание делает сверка — ставим заказ в начало ее очереди
+        PaymentReconciler.expedite(order_id)
+
+    async def capture_completed(self, order_id: str):
+        payment = Database.get_payment(order_id) if order_id else None
+        if not payment:
+            logger.warning(f"Событие PayPal для неизвестного заказа {order_id}")
+            return
+        async with _settle_locks.hold(order_id):
+            PaymentStateMachine.transition(order_id, "CAPTURED", "paypal_webhook", event="PAYMENT.CAPTURE.COMPLETED")
+            if not PaymentStateMachine.activate(order_id, "paypal_webhook"):
+                return
+        
+        user_id = payment.user_id
+        logger.info(f"Платеж {order_id} пользователя {user_id} подтвержден вебхуком PayPal")
+        Outbox.send(user_id, I18n.t(user_id, "check_completed", plan=payment.plan))
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
         user = update.message.from_user
-        user_id = str(user.id)
+        user_id = user.id
         
         keyboard = [
-            [InlineKeyboardButton("English", callback_data="en"),
-             InlineKeyboardButton("Русский", callback_data="ru")]
+            [InlineKeyboardButton(name, callback_data=lang) for lang, name in LANGUAGES.items()]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         db_user = Database.get_user(user_id)
         if not db_user:
-            db_user = {
-                "user_id": user_id,
-                "sshName": "",
-                "sshPassword": "",
-                "TGname": user.username or "NoUsername",
-                "expire_datetime": "",
-                "language": "en"
-            }
+            db_user = UserRecord(user_id=user_id, tg_name=user.username or "NoUsername")
             Database.update_user(db_user)
+        I18n.set_language(user_id, db_user.language)
         
         await update.message.reply_text(
-            "Choose language: / Выберите язык:",
+            I18n.render(DEFAULT_LANGUAGE, "choose_language"),
             reply_markup=reply_markup
         )
         
@@ -246,36 +3322,21 @@ async def set_language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     
     try:
         lang = query.data
-        user_id = str(query.from_user.id)
+        user_id = query.from_user.id
         db_user = Database.get_user(user_id)
         
         if not db_user:
-            db_user = {
-                "user_id": user_id,
-                "sshName": "",
-                "sshPassword": "",
-                "TGname": query.from_user.username or "NoUsername",
-                "expire_datetime": "",
-                "language": lang
-            }
+            db_user = UserRecord(user_id=user_id, tg_name=query.from_user.username or "NoUsername", language=lang)
         else:
-            db_user["language"] = lang
+            db_user.language = lang
         
         Database.update_user(db_user)
+        I18n.set_language(user_id, lang)
         
-        response = {
-            "en": "Language set to English!",
-            "ru": "Язык установлен на Русский!"
-        }.get(lang, "Language set!")
-        await query.edit_message_text(response)
-        
-        welcome_msg = {
-            "en": f"Welcome {db_user['TGname']}! Use /subscribe to see plans.",
-            "ru": f"Добро пожаловать {db_user['TGname']}! Используйте /subscribe для просмотра планов."
-        }.get(lang, "Welcome!")
+        await query.edit_message_text(I18n.render(lang, "language_set"))
         await context.bot.send_message(
             chat_id=query.message.chat_id,
-            text=welcome_msg
+            text=I18n.render(lang, "welcome", name=db_user.tg_name)
         )
         
     except Exception as e:
@@ -284,111 +3345,31 @@ async def set_language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        user_id = str(update.message.from_user.id)
-        db_user = Database.get_user(user_id)
-        lang = db_user["language"] if db_user else "en"
-        
-        messages = {
-            "en": (
-                "/start - Welcome\n"
-                "/help - Show commands\n"
-                "/subscribe - Buy/renew\n"
-                "/status - Check subscription\n"
-                "/extend - Extend\n"
-                "/cancel - Remove access\n"
-                "/serverinfo - SSH details\n"
-                "/contact - Report issues\n"
-                "/coupon - Use free codes\n"
-                "/pay - Subscription payment\n"
-                "/check_payment - Get yours payment status"
-            ),
-            "ru": (
-                "/start - Приветствие\n"
-                "/help - Список команд\n"
-                "/subscribe - Покупка/продление\n"
-                "/status - Статус подписки\n"
-                "/extend - Продлить\n"
-                "/cancel - Удалить доступ\n"
-                "/serverinfo - SSH данные\n"
-                "/contact - Сообщить проблему\n"
-                "/coupon - Использовать кодов\n"
-                "/pay - Оплата подписки\n"
-                "/check_payment - Проверка статуса оплаты"
-            )
-        }
-        
-        await update.message.reply_text(messages.get(lang, messages["en"]))
+        user_id = update.message.from_user.id
+        await update.message.reply_text(I18n.t(user_id, "help"))
         
     except Exception as e:
         logger.error(f"Ошибка в /help: {e}")
         await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.")
 
 async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.message.from_user.id
     try:
-        user_id = str(update.message.from_user.id)
-        db_user = Database.get_user(user_id)
-        lang = db_user["language"] if db_user else "en"
-        db = Database.load()
-        options = db["purchase_options"]
-
-        messages = {
-            "en": {
-                "header": "📊 Available subscription plans:\n\n",
-                "item": "• {plan}: ${price} {currency} ({comment})\n",
-                "footer": "\nUse /pay <plan> to purchase (e.g. /pay 1m)"
-            },
-            "ru": {
-                "header": "📊 Доступные планы подписки:\n\n",
-                "item": "• {plan}: ${price} {currency} ({comment})\n",
-                "footer": "\nИспользуйте /pay <план> для покупки (напр. /pay 1m)"
-            }
-        }
-
-        lang_templates = messages.get(lang, messages["en"])
-
-        msg = lang_templates["header"]
-        
-        for plan, details in options.items():
-            msg += lang_templates["item"].format(
-                plan=plan,
-                price=details['Stripe_EUR'],
-                currency="EUR",
-                comment=details['comment']
-            )
-        
-        msg += lang_templates["footer"]
-        
-        await update.message.reply_text(msg)
+        msg, reply_markup = PlanCatalog.get(I18n.language(user_id))
+        await update.message.reply_text(msg, reply_markup=reply_markup)
         
     except Exception as e:
         logger.error(f"Ошибка в /subscribe: {str(e)}", exc_info=True)
-        error_msg = {
-            "en": "⚠️ Error loading subscription plans. Please try later.",
-            "ru": "⚠️ Ошибка загрузки планов подписки. Попробуйте позже."
-        }
-        await update.message.reply_text(error_msg.get(lang, "Payment error"))
+        await update.message.reply_text(I18n.t(user_id, "subscribe_error"))
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        user_id = str(update.message.from_user.id)
+        user_id = update.message.from_user.id
         db_user = Database.get_user(user_id)
-        lang = db_user["language"] if db_user else "en"
-        
-        active = False
-        if db_user and db_user.get("expire_datetime"):
-            expire_date = datetime.fromisoformat(db_user["expire_datetime"])
-            if expire_date > datetime.now():
-                active = True
-                message = {
-                    "en": f"Active until: {db_user['expire_datetime']}",
-                    "ru": f"Активно до: {db_user['expire_datetime']}"
-                }.get(lang, f"Active until: {db_user['expire_datetime']}")
-        
-        if not active:
-            message = {
-                "en": "No active subscription.",
-                "ru": "Нет активной подписки."
-            }.get(lang, "No active subscription.")
+        
+        message = I18n.t(user_id, "no_subscription")
+        if db_user and db_user.is_active():
+            message = I18n.t(user_id, "status_active", expire=db_user.expire_at.isoformat())
         
         await update.message.reply_text(message)
         
@@ -398,28 +3379,12 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def extend(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        user_id = str(update.message.from_user.id)
+        user_id = update.message.from_user.id
         db_user = Database.get_user(user_id)
-        lang = db_user["language"] if db_user else "en"
-        
-        active = False
-        if db_user and db_user.get("expire_datetime"):
-            expire_date = datetime.fromisoformat(db_user["expire_datetime"])
-            if expire_date > datetime.now():
-                active = True
-        
-        if active:
-            message = {
-                "en": "Send 'payment confirmed' with plan (e.g., 'payment confirmed 3m') to extend.",
-                "ru": "Отправьте 'payment confirmed' с планом (например, 'payment confirmed 3m') для продления."
-            }.get(lang, "Send 'payment confirmed' with plan to extend.")
-        else:
-            message = {
-                "en": "No active subscription to extend. Use /subscribe.",
-                "ru": "Нет активной подписки для продления. Используйте /subscribe."
-            }.get(lang, "No active subscription to extend. Use /subscribe.")
         
-        await update.message.reply_text(message)
+        active = bool(db_user and db_user.is_active())
+        
+        await update.message.reply_text(I18n.t(user_id, "extend_active" if active else "extend_inactive"))
         
     except Exception as e:
         logger.error(f"Ошибка в /extend: {e}")
@@ -427,42 +3392,22 @@ async def extend(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        user_id = str(update.message.from_user.id)
+        user_id = update.message.from_user.id
         db_user = Database.get_user(user_id)
-        lang = db_user["language"] if db_user else "en"
         
-        if update.message.text.lower() == "iknowwhatiamdoing":
-            if db_user and db_user["sshName"]:
-                ssh_name = db_user["sshName"]
-                
-                subprocess.run(["sudo", "usermod", "-p", "!", ssh_name], check=True)
-                
-                home_dir = f"/home/{ssh_name}"
-                expired_dir = f"/home/{SUDO_USER}/expiredusers/{ssh_name}"
-                os.makedirs(os.path.dirname(expired_dir), exist_ok=True)
-                
-                if os.path.exists(home_dir):
-                    subprocess.run(["sudo", "mv", home_dir, expired_dir], check=True)
-                
-                with open(f"{expired_dir}/user_info.json", 'w') as f:
-                    json.dump(db_user, f, indent=4)
-                
-                Database.remove_user(user_id)
-                
-                message = {
-                    "en": "Access moved to expired.",
-                    "ru": "Доступ перемещен в expired."
-                }.get(lang, "Access moved to expired.")
+        # Подтверждение — аргумент команды: /cancel iKnowWhatIamDoing
+        if context.args and context.args[0].lower() == "iknowwhatiamdoing":
+            if db_user and db_user.ssh_name:
+                # Тот же путь, что и у истечения: удаление из БД, освобождение
+                # места на узле и возврат аккаунта в пул
+                if await Provisioner.deactivate(db_user):
+                    message = I18n.t(user_id, "cancel_done")
+                else:
+                    message = I18n.t(user_id, "cancel_renewed")
             else:
-                message = {
-                    "en": "No active account to cancel.",
-                    "ru": "Нет активного аккаунта для отмены."
-                }.get(lang, "No active account to cancel.")
+                message = I18n.t(user_id, "cancel_no_account")
         else:
-            message = {
-                "en": "Type exactly 'iKnowWhatIamDoing' to cancel.",
-                "ru": "Введите точно 'iKnowWhatIamDoing' для отмены."
-            }.get(lang, "Type exactly 'iKnowWhatIamDoing' to cancel.")
+            message = I18n.t(user_id, "cancel_confirm")
         
         await update.message.reply_text(message)
         
@@ -472,32 +3417,22 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def serverinfo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        user_id = str(update.message.from_user.id)
+        user_id = update.message.from_user.id
         db_user = Database.get_user(user_id)
-        lang = db_user["language"] if db_user else "en"
-        
-        active = False
-        if db_user and db_user.get("expire_datetime"):
-            expire_date = datetime.fromisoformat(db_user["expire_datetime"])
-            if expire_date > datetime.now():
-                active = True
-                ssh_name = db_user["sshName"]
-
-                ip = subprocess.check_output(
-                    "ip addr | grep 'inet ' | grep -v '127.0.0.1' | awk '{print $2}' | cut -d/ -f1 | head -n1",
-                    shell=True
-                ).decode().strip()
-                
-                message = {
-                    "en": f"IP: {ip}\nPort: 33\nUser: {ssh_name}\nExpiry: {db_user['expire_datetime']}",
-                    "ru": f"IP: {ip}\nПорт: 33\nПользователь: {ssh_name}\nИстекает: {db_user['expire_datetime']}"
-                }.get(lang, f"IP: {ip}\nPort: 33\nUser: {ssh_name}\nExpiry: {db_user['expire_datetime']}")
+        lang = I18n.language(user_id)
         
-        if not active:
-            message = {
-                "en": "No active subscription.",
-                "ru": "Нет активной подписки."
-            }.get(lang, "No active subscription.")
+        message = I18n.render(lang, "no_subscription")
+        if db_user and db_user.is_active():
+            servers = "\n".join(
+                I18n.render(lang, "server_endpoint", ip=ip, port=port)
+                for ip, port in Fleet.endpoints(db_user)
+            )
+            message = I18n.render(
+                lang, "server_info",
+                servers=servers,
+                ssh_name=db_user.ssh_name,
+                expire=db_user.expire_at.isoformat()
+            )
         
         await update.message.reply_text(message)
         
@@ -507,16 +3442,8 @@ async def serverinfo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 
 async def contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        user_id = str(update.message.from_user.id)
-        db_user = Database.get_user(user_id)
-        lang = db_user["language"] if db_user else "en"
-        
-        message = {
-            "en": "Send your username and problem description for admin.",
-            "ru": "Отправьте имя пользователя и описание проблемы для администратора."
-        }.get(lang, "Send your username and problem description for admin.")
-        
-        await update.message.reply_text(message)
+        user_id = update.message.from_user.id
+        await update.message.reply_text(I18n.t(user_id, "contact"))
         
     except Exception as e:
         logger.error(f"Ошибка в /contact: {e}")
@@ -524,27 +3451,75 @@ async def contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def coupon(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        user_id = str(update.message.from_user.id)
-        db_user = Database.get_user(user_id)
-        lang = db_user["language"] if db_user else "en"
-        db = Database.load()
+        user = update.message.from_user
+        user_id = user.id
         
-        coupon_keys = ", ".join(db["coupons"].keys())
+        if not context.args:
+            # Список кодов — только админам: иначе любой получит бесплатные коды
+            if user_id in ADMIN_IDS:
+                coupon_keys = ", ".join(Database.get_coupons().keys())
+                await update.message.reply_text(I18n.t(user_id, "coupon_list", codes=coupon_keys))
+            else:
+                await update.message.reply_text(I18n.t(user_id, "coupon_usage"))
+            return
+        
+        code, time_length = Database.redeem_coupon(context.args[0], user_id)
+        if time_length is None:
+            await update.message.reply_text(I18n.t(user_id, f"coupon_{code}"))
+            return
         
-        message = {
-            "en": f"Codes: {coupon_keys} - check quantities and durations in admin.",
-            "ru": f"Коды: {coupon_keys} - проверьте количество и длительность у админа."
-        }.get(lang, f"Codes: {coupon_keys} - check quantities and durations in admin.")
+        # Продление сразу после списания, без await между ними
+        db_user = Database.get_user(user_id) or UserRecord(user_id=user_id, tg_name=user.username or "NoUsername")
+        now = datetime.now()
+        db_user.expire_at = max(db_user.expire_at or now, now) + parse_time_length(time_length)
+        Database.update_user(db_user)
+        Provisioner.enqueue(user_id)
+        logger.info(f"Пользователь {user_id} использовал купон {code}")
         
-        await update.message.reply_text(message)
+        await update.message.reply_text(I18n.t(user_id, "coupon_redeemed", expire=db_user.expire_at.isoformat()))
         
     except Exception as e:
         logger.error(f"Ошибка в /coupon: {e}")
         await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.")
 
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        user_id = update.message.from_user.id
+        if user_id not in ADMIN_IDS:
+            return
+        
+        text = update.message.text.partition(" ")[2].strip()
+        if not text:
+            await update.message.reply_text(I18n.t(user_id, "broadcast_usage"))
+            return
+        
+        job, total = Outbox.broadcast(text)
+        await update.message.reply_text(I18n.t(user_id, "broadcast_queued", job=job, total=total))
+        
+    except Exception as e:
+        logger.error(f"Ошибка в /broadcast: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.")
+
+async def broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        user_id = update.message.from_user.id
+        if user_id not in ADMIN_IDS:
+            return
+        
+        job = context.args[0] if context.args else None
+        progress = Outbox.progress(job) if job else None
+        if progress is None:
+            await update.message.reply_text(I18n.t(user_id, "broadcast_not_found"))
+            return
+        await update.message.reply_text(I18n.t(user_id, "broadcast_status", job=job, **progress))
+        
+    except Exception as e:
+        logger.error(f"Ошибка в /broadcast_status: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.")
+
 async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        user_id = str(update.message.from_user.id)
+        user_id = update.message.from_user.id
         text = update.message.text.lower()
         
         if text.startswith('payment confirmed'):
@@ -553,200 +3528,294 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             parts = text.split()
             if len(parts) >= 3:
                 plan = parts[2]
-                db = Database.load()
-                if plan in db["purchase_options"]:
+                if plan in Database.get_purchase_options():
                     context.user_data['selected_plan'] = plan
             
-            db_user = Database.get_user(user_id)
-            lang = db_user["language"] if db_user else "en"
-            
-            message = {
-                "en": "Payment confirmed! Use /subscribe or /extend.",
-                "ru": "Оплата подтверждена! Используйте /subscribe или /extend."
-            }.get(lang, "Payment confirmed! Use /subscribe or /extend.")
-            
-            await update.message.reply_text(message)
+            await update.message.reply_text(I18n.t(user_id, "payment_confirmed_text"))
         else:
-            db_user = Database.get_user(user_id)
-            lang = db_user["language"] if db_user else "en"
-            
-            message = {
-                "en": "Invalid. Send 'payment confirmed' with plan (e.g., 'payment confirmed 3m').",
-                "ru": "Неверно. Отправьте 'payment confirmed' с планом (например, 'payment confirmed 3m')."
-            }.get(lang, "Invalid. Send 'payment confirmed' with plan.")
-            
-            await update.message.reply_text(message)
+            await update.message.reply_text(I18n.t(user_id, "payment_confirmed_invalid"))
             
     except Exception as e:
         logger.error(f"Ошибка в confirm_payment: {e}")
         await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.")
 
 
+async def create_payment(user_id: int, plan: str) -> str:
+    purchase_options = Database.get_purchase_options()
+    if plan not in purchase_options:
+        return I18n.t(user_id, "pay_invalid_plan")
+
+    plan_details = purchase_options[plan]
+    amount = plan_details["Stripe_EUR"]
+    description = plan_details["comment"]
+
+    # Повтор /pay или двойное нажатие отдают тот же неоплаченный заказ.
+    # Ключ идемпотентности — номер покупки тарифа: повтор запроса после сбоя
+    # получит от PayPal тот же заказ, а после оплаты ключ уже новый
+    unpaid = PaymentStateMachine.unpaid_order(user_id, plan)
+    if unpaid:
+        return I18n.t(user_id, "pay_link", url=unpaid.extra["approval_url"], order_id=unpaid.order_id)
+    purchases = sum(1 for p in Database.get_user_payments(user_id).values() if p.plan == plan)
+    request_id = f"ORDER-{user_id}-{plan}-{purchases}"
+    order = await PayPalClient.create_order(amount, "EUR", description, request_id)
+    if not order:
+        return I18n.t(user_id, "pay_unavailable")
+        
+    order_id = order["id"]
+    approval_url = next(
+        (link["href"] for link in order["links"] if link["rel"] == "approve"),
+        None
+    )
+    
+    if not approval_url:
+        logger.error(f"No approval URL in PayPal response: {order}")
+        return I18n.t(user_id, "pay_error")
+
+    PaymentStateMachine.create(user_id, order_id, plan, amount, approval_url=approval_url)
+
+    return I18n.t(user_id, "pay_link", url=approval_url, order_id=order_id)
+
 async def pay(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        user_id = str(update.message.from_user.id)
-        db_user = Database.get_user(user_id)
-        lang = db_user["language"] if db_user else "en"
+        user_id = update.message.from_user.id
         
         if not context.args:
-            message = {
-                "en": "Please specify a plan (e.g., /pay 1m)",
-                "ru": "Укажите план (например, /pay 1m)"
-            }.get(lang, "Please specify a plan")
-            await update.message.reply_text(message)
+            await update.message.reply_text(I18n.t(user_id, "pay_no_plan"))
             return
             
         plan = context.args[0].lower()
-        db = Database.load()
-        if plan not in db["purchase_options"]:
-            message = {
-                "en": "Invalid plan. Use /subscribe to see available plans.",
-                "ru": "Неверный план. Используйте /subscribe для просмотра доступных планов."
-            }.get(lang, "Invalid plan")
-            await update.message.reply_text(message)
-            return
+        await update.message.reply_text(await create_payment(user_id, plan))
+        
+    except Exception as e:
+        logger.error(f"Error in /pay: {e}")
+        await update.message.reply_text("⚠️ An error occurred. Please try again.")
 
-        plan_details = db["purchase_options"][plan]
-        amount = plan_details["Stripe_EUR"]
-        description = plan_details["comment"]
-
-        order = PayPalClient.create_order(amount, "EUR", description)
-        if not order:
-            message = {
-                "en": "Payment service is unavailable. Please try again later.",
-                "ru": "Платежный сервис недоступен. Пожалуйста, попробуйте позже."
-            }.get(lang, "Payment service unavailable")
-            await update.message.reply_text(message)
-            return
-            
-        order_id = order["id"]
-        approval_url = next(
-            (link["href"] for link in order["links"] if link["rel"] == "approve"),
-            None
-        )
+async def pay_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Кнопка тарифа под /subscribe: callback_data вида "pay:<plan>"
+    query = update.callback_query
+    await query.answer()
+    
+    try:
+        user_id = query.from_user.id
+        plan = query.data.split(":", 1)[1]
+        await query.message.reply_text(await create_payment(user_id, plan))
         
-        if not approval_url:
-            logger.error(f"No approval URL in PayPal response: {order}")
-            message = {
-                "en": "Payment error. Please try again later.",
-                "ru": "Ошибка платежа. Пожалуйста, попробуйте позже."
-            }.get(lang, "Payment error")
-            await update.message.reply_text(message)
-            return
+    except Exception as e:
+        logger.error(f"Error in pay callback: {e}")
+        await query.message.reply_text("⚠️ An error occurred. Please try again.")
 
-        Database.add_payment(user_id, order_id, plan, amount)
+def parse_time_length(value: str) -> timedelta:
+    # "1w" -> 7 дней, "2m" -> 60 дней; единицы — TIME_LENGTH_UNITS
+    return timedelta(days=int(value[:-1] or 1) * TIME_LENGTH_UNITS[value[-1].lower()])
 
-        message = {
-            "en": f"🔗 Please complete your payment: {approval_url}\n\nAfter payment, use /check_payment {order_id} to activate your subscription.",
-            "ru": f"🔗 Пожалуйста, завершите оплату: {approval_url}\n\nПосле оплаты используйте /check_payment {order_id} для активации подписки."
-        }.get(lang, f"Complete payment: {approval_url}\n\nAfter payment, use /check_payment {order_id}")
+def activate_subscription(user_id: int, plan: str, expiry: datetime) -> None:
+    # Запись могла быть удалена при истечении — оплата без /start ее создает
+    db_user = Database.get_user(user_id) or UserRecord(user_id=user_id, tg_name="NoUsername")
+    db_user.expire_at = expiry
+    db_user.plan = plan
+    Database.update_user(db_user)
+
+_settle_locks = KeyedLock()
+
+async def settle_payment(order_id: str, source: str):
+    # Сверяет заказ с PayPal и проводит его по PaymentStateMachine. Общий путь
+    # для /check_payment и PaymentReconciler; лок по заказу не дает им
+    # одновременно списать один заказ, а уже активированный заказ не стоит
+    # ни одного запроса к PayPal.
+    # Возвращает статус PayPal, "CAPTURED", "CAPTURE_FAILED", "ACTIVATED"
+    # (заказ активировали раньше, не этим вызовом) или None
+    async with _settle_locks.hold(order_id):
+        state = PaymentStateMachine.state(Database.get_payment(order_id))
+        if state == "ACTIVATED":
+            return "ACTIVATED"
+        if state == "CAPTURED":
+            # Списано, но активация не дошла (например, падение) — без PayPal
+            PaymentStateMachine.activate(order_id, source)
+            return "COMPLETED"
+        if state in PaymentStateMachine.TERMINAL:
+            return state
         
-        await update.message.reply_text(message)
+        order_details = await PayPalClient.get_order_details(order_id)
+        if not order_details:
+            return None
         
-    except Exception as e:
-        logger.error(f"Error in /pay: {e}")
-        await update.message.reply_text("⚠️ An error occurred. Please try again.")
+        status = order_details.get("status", "UNKNOWN").upper()
+        if status == "COMPLETED":
+            PaymentStateMachine.transition(order_id, "CAPTURED", source)
+            PaymentStateMachine.activate(order_id, source)
+            return "COMPLETED"
+        if status == "APPROVED":
+            PaymentStateMachine.transition(order_id, "APPROVED", source)
+            capture_result = await PayPalClient.capture_order(order_id)
+            if not capture_result or capture_result.get("status") != "COMPLETED":
+                return "CAPTURE_FAILED"
+            PaymentStateMachine.transition(order_id, "CAPTURED", source)
+            PaymentStateMachine.activate(order_id, source)
+            return "CAPTURED"
+        if status == "VOIDED":
+            PaymentStateMachine.transition(order_id, "VOIDED", source)
+        return status
 
 async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        user_id = str(update.message.from_user.id)
+        user_id = update.message.from_user.id
 
         if not context.args:
-            message = "Please specify payment ID (e.g., /check_payment ORDER-123)"
-            await update.message.reply_text(message)
+            await update.message.reply_text(I18n.t(user_id, "check_no_order"))
             return
             
         order_id = context.args[0]
         payment_info = Database.get_payment(order_id)
         
-        if not payment_info or payment_info["user_id"] != user_id:
-            message = "Payment not found or you don't have permission to check it."
-            await update.message.reply_text(message)
-            return
-            
-        order_details = PayPalClient.get_order_details(order_id)
-        if not order_details:
-            message = "Failed to get payment status. Please try again later."
-            await update.message.reply_text(message)
+        if not payment_info or payment_info.user_id != user_id:
+            await update.message.reply_text(I18n.t(user_id, "check_not_found"))
             return
             
-        status = order_details.get("status", "UNKNOWN").upper()
-        Database.update_payment_status(order_id, status)
-
-        if status == "COMPLETED":
-            plan = payment_info["plan"]
-            days = {'1m': 30, '2m': 60, '3m': 90, '6m': 180, '1y': 365, '5y': 1825}.get(plan, 30)
-            expiry = (datetime.now() + timedelta(days=days)).isoformat()
-
-            db_user = Database.get_user(user_id)
-            if db_user:
-                db_user["expire_datetime"] = expiry
-                Database.update_user(db_user)
-            
-            message = f"✅ Payment confirmed! Your {plan} subscription is now active."
-            await update.message.reply_text(message)
-            
-        elif status == "APPROVED":
-            capture_result = PayPalClient.capture_order(order_id)
-            if capture_result and capture_result.get("status") == "COMPLETED":
-                Database.update_payment_status(order_id, "COMPLETED")
-                message = "✅ Payment captured! Subscription activated."
-            else:
-                message = "⚠️ Payment capture failed. Please contact support."
-            await update.message.reply_text(message)
-            
+        result = await settle_payment(order_id, "check_payment")
+        if result is None:
+            message = I18n.t(user_id, "check_failed")
+        elif result in ("COMPLETED", "ACTIVATED"):
+            message = I18n.t(user_id, "check_completed", plan=payment_info.plan)
+        elif result == "CAPTURED":
+            message = I18n.t(user_id, "check_captured")
+        elif result == "CAPTURE_FAILED":
+            message = I18n.t(user_id, "check_capture_failed")
         else:
-            message = f"ℹ️ Payment status: {status}. Please wait or contact support."
-            await update.message.reply_text(message)
+            message = I18n.t(user_id, "check_status", status=result)
+        await update.message.reply_text(message)
             
     except Exception as e:
         logger.error(f"Error in /check_payment: {e}")
         await update.message.reply_text("⚠️ An error occurred. Please try again.")
 
+async def reconcile_payments(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await PaymentReconciler.run_once()
+    except Exception as e:
+        logger.error(f"Ошибка сверки платежей: {e}")
+
+async def flush_db(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Сброс БД заодно сжимает журнал платежей
+    await PaymentStateMachine.compact()
+
+async def refresh_server_info(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await asyncio.to_thread(ServerInfo.refresh)
+    except Exception as e:
+        logger.error(f"Ошибка обновления адреса сервера: {e}")
+
+def register_gauges(application: Application) -> None:
+    def db_file_bytes():
+        path = getattr(Database.engine(), "path", None)
+        return os.path.getsize(path) if path and os.path.exists(path) else 0
+    
+    Metrics.gauge("db_file_bytes", db_file_bytes)
+    webhook = application.bot_data.get("webhook")
+    Metrics.gauge("queue_depth", lambda: [
+        ({"queue": "updates"}, webhook.pending() if webhook else application.update_queue.qsize()),
+        ({"queue": "outbox"}, Outbox.depth()),
+        ({"queue": "provision"}, Provisioner.depth()),
+        ({"queue": "expiry"}, ExpiryScheduler.depth())
+    ])
+    Metrics.gauge("account_pool_ready", AccountPool.ready_counts)
+    Metrics.gauge("fleet_node_load", Fleet.loads)
+    Metrics.gauge("fleet_node_capacity", Fleet.capacities)
+
+async def on_startup(application: Application) -> None:
+    await asyncio.to_thread(ServerInfo.refresh)
+    ExpiryScheduler.start()
+    Outbox.start(application.bot)
+    Fleet.count()
+    Provisioner.start()
+    AccountPool.start()
+    http = application.bot_data.get("http_server")
+    if http and http.routes:
+        await http.start()
+
+async def on_shutdown(application: Application) -> None:
+    http = application.bot_data.get("http_server")
+    if http:
+        await http.stop()
+    await ExpiryScheduler.stop()
+    await Provisioner.stop()
+    await AccountPool.stop()
+    await Outbox.stop()
+    await PayPalClient.close()
+    Database.flush()
+
+async def expire_users(users: list) -> list:
+    # Отключает аккаунты и удаляет пользователей из БД (кроме продливших
+    # подписку во время отключения), возвращает неудавшихся
+    expired_users = []
+    failed_users = []
+    started = time.perf_counter()
+    
+    results = await asyncio.gather(
+        *(Provisioner.deactivate(user) for user in users),
+        return_exceptions=True
+    )
+    for user, result in zip(users, results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка обработки пользователя {user.user_id}: {result}")
+            failed_users.append(user)
+        elif result:
+            expired_users.append(user)
+            logger.info(f"Подписка пользователя {user.ssh_name} истекла")
+    
+    if expired_users:
+        logger.info(f"Удалено {len(expired_users)} истекших подписок")
+    Metrics.observe("expiry_sweep_seconds", time.perf_counter() - started)
+    Metrics.inc("expired_users_total", len(expired_users))
+    Metrics.inc("expiry_failures_total", len(failed_users))
+    return failed_users
+
 async def check_expiry(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Страховочный полный проход; основную работу делает ExpiryScheduler
     try:
         logger.info("Проверка истекающих подписок...")
-        db = Database.load()
         current_time = datetime.now()
-        expired_users = []
-        
-        for user in db["users"]:
-            if user.get("expire_datetime"):
-                try:
-                    expire_date = datetime.fromisoformat(user["expire_datetime"])
-                    if expire_date <= current_time and user["sshName"]:
-                        ssh_name = user["sshName"]
-                        
-                        subprocess.run(["sudo", "usermod", "-p", "!", ssh_name], check=True)
-                        
-                        home_dir = f"/home/{ssh_name}"
-                        expired_dir = f"/home/{SUDO_USER}/expiredusers/{ssh_name}"
-                        os.makedirs(os.path.dirname(expired_dir), exist_ok=True)
-                        
-                        if os.path.exists(home_dir):
-                            subprocess.run(["sudo", "mv", home_dir, expired_dir], check=True)
-                        
-                        with open(f"{expired_dir}/user_info.json", 'w') as f:
-                            json.dump(user, f, indent=4)
-                        
-                        expired_users.append(user)
-                        logger.info(f"Подписка пользователя {ssh_name} истекла")
-                except Exception as e:
-                    logger.error(f"Ошибка обработки пользователя {user['user_id']}: {e}")
-        
-        if expired_users:
-            user_ids = [u["user_id"] for u in expired_users]
-            db["users"] = [u for u in db["users"] if u["user_id"] not in user_ids]
-            Database.save(db)
-            logger.info(f"Удалено {len(expired_users)} истекших подписок")
+        await expire_users([u for u in Database.get_expired_users(current_time) if u.ssh_name])
         
     except Exception as e:
         logger.error(f"Ошибка в check_expiry: {e}")
 
+async def run_webhook(application: Application) -> None:
+    # Тот же порядок, что у run_polling: initialize -> post_init -> start
+    webhook = application.bot_data["webhook"]
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    async with application:
+        await on_startup(application)
+        await application.start()
+        await webhook.start()
+        try:
+            await stop_event.wait()
+        finally:
+            await application.stop()
+            await on_shutdown(application)
+
 def main() -> None:
     """Запуск бота"""
     try:
-        application = Application.builder().token(TOKEN).build()
+        Database.open()
+        PaymentStateMachine.recover()
+        builder = Application.builder().token(TOKEN).concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        if BOT_MODE == "webhook":
+            builder = builder.updater(None)
+        application = builder.post_init(on_startup).post_shutdown(on_shutdown).build()
+        
+        http = HttpServer(HTTP_HOST, HTTP_PORT)
+        application.bot_data["http_server"] = http
+        if BOT_MODE == "webhook":
+            application.bot_data["webhook"] = WebhookServer(application, http)
+        if PAYPAL_WEBHOOK_ID:
+            PayPalWebhook(application, http)
+        if METRICS_PATH:
+            http.route("GET", METRICS_PATH, Metrics.handle)
+            register_gauges(application)
         
         handlers = [
             CommandHandler("start", start),
@@ -760,28 +3829,56 @@ def main() -> None:
             CommandHandler("coupon", coupon),
             CommandHandler("pay", pay),
             CommandHandler("check_payment", check_payment),
+            CommandHandler("broadcast", broadcast),
+            CommandHandler("broadcast_status", broadcast_status),
             MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_payment),
-            CallbackQueryHandler(set_language)
+            CallbackQueryHandler(pay_callback, pattern=r"^pay:"),
+            CallbackQueryHandler(set_language, pattern=f"^({'|'.join(LANGUAGES)})$")
         ]
         
         for handler in handlers:
+            handler.callback = Metrics.timed(handler.callback)
             application.add_handler(handler)
         
         job_queue = application.job_queue
         if job_queue:
             job_queue.run_repeating(
                 check_expiry,
-                interval=3600,
-                first=10
+                interval=EXPIRY_SWEEP_INTERVAL,
+                first=EXPIRY_SWEEP_INTERVAL
+            )
+            job_queue.run_repeating(
+                refresh_server_info,
+                interval=SERVER_IP_REFRESH,
+                first=SERVER_IP_REFRESH
+            )
+            job_queue.run_repeating(
+                reconcile_payments,
+                interval=RECONCILE_INTERVAL,
+                first=RECONCILE_INTERVAL
+            )
+            job_queue.run_repeating(
+                flush_db,
+                interval=DB_FLUSH_INTERVAL,
+                first=DB_FLUSH_INTERVAL
             )
         
-        application.run_polling()
+        if BOT_MODE == "webhook":
+            asyncio.run(run_webhook(application))
+        else:
+            application.run_polling()
         
     except Exception as e:
         logger.error(f"Фатальная ошибка: {e}")
+    finally:
+        Database.flush()
 
 if __name__ == "__main__":
-    if not os.path.exists(DB_FILE):
-        Database.initialize_db()
+    if sys.argv[1:2] == ["migrate"]:
+        Database.migrate_json_to_sqlite()
+        sys.exit(0)
+    if sys.argv[1:2] == ["export"]:
+        Database.export(sys.argv[2] if len(sys.argv) > 2 else "DB.export.json")
+        sys.exit(0)
     
     main()
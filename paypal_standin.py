@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import sys
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+
+# Локальная замена PayPal для проверки вебхука без песочницы: отвечает на
+# те запросы REST API, которые делает обработчик вебхука (токен и
+# verify-webhook-signature), и воспроизводит записанные события PayPal из
+# paypal_events/ на PAYPAL_WEBHOOK_PATH бота. Бот запускается с
+# PAYPAL_API_URL на адрес заглушки и любым непустым PAYPAL_WEBHOOK_ID:
+#   python paypal_standin.py --order-id 5O190127TN364715T \
+#       --webhook-url http://127.0.0.1:8443/paypal/webhook --repeat 2
+
+BOT_FILE = Path(__file__).with_name("bot(fixed).py")
+EVENTS_DIR = Path(__file__).with_name("paypal_events")
+# Порядок доставки, как у PayPal: одобрение покупателем, затем списание
+EVENT_FILES = ("checkout_order_approved.json", "payment_capture_completed.json")
+RECORDED_ORDER_ID = "5O190127TN364715T"
+
+
+def load_bot():
+    spec = importlib.util.spec_from_file_location("bot", BOT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_events(order_id: str = RECORDED_ORDER_ID, directory: Path = EVENTS_DIR):
+    # Записанные события с подставленным id заказа; id события тоже
+    # зависит от заказа, иначе бот отбросит события второго заказа как повтор
+    events = []
+    for name in EVENT_FILES:
+        event = json.loads((directory / name).read_text(encoding="utf-8"))
+        if order_id != RECORDED_ORDER_ID:
+            event["id"] = f"{event['id']}-{order_id}"
+        resource = event["resource"]
+        if event["event_type"] == "CHECKOUT.ORDER.APPROVED":
+            resource["id"] = order_id
+        else:
+            resource["supplementary_data"]["related_ids"]["order_id"] = order_id
+        events.append(event)
+    return events
+
+
+def transmission_headers():
+    # Заголовки доставки PayPal; подпись проверяет verify() этой же заглушки
+    return {
+        "Content-Type": "application/json",
+        "PayPal-Auth-Algo": "SHA256withRSA",
+        "PayPal-Cert-Url": "https://api.sandbox.paypal.com/v1/notifications/certs/CERT-360caa42-fca2a594-standin",
+        "PayPal-Transmission-Id": str(uuid.uuid4()),
+        "PayPal-Transmission-Sig": "standin",
+        "PayPal-Transmission-Time": datetime.now(timezone.utc).isoformat()
+    }
+
+
+async def replay(webhook_url: str, events: list, repeat: int = 1):
+    # Каждое событие доставляется repeat раз подряд (повторная доставка
+    # PayPal), ответы бота — [(event_type, status, text)]
+    results = []
+    async with httpx.AsyncClient(timeout=10) as client:
+        for event in events:
+            for _ in range(repeat):
+                response = await client.post(webhook_url, content=json.dumps(event), headers=transmission_headers())
+                results.append((event["event_type"], response.status_code, response.text))
+    return results
+
+
+class PayPalStandIn:
+    # Маршруты REST API PayPal на HttpServer бота. verification_status —
+    # ответ verify-webhook-signature ("FAILURE" — проверка отказа в подписи)
+    def __init__(self, http, verification_status: str = "SUCCESS"):
+        self.verification_status = verification_status
+        self.verified = []
+        http.route("POST", "/v1/oauth2/token", self.token)
+        http.route("POST", "/v1/notifications/verify-webhook-signature", self.verify)
+
+    async def token(self, headers: dict, body: bytes):
+        return 200, {"access_token": "standin", "token_type": "Bearer", "expires_in": 3600}
+
+    async def verify(self, headers: dict, body: bytes):
+        if not headers.get("authorization", "").startswith("Bearer "):
+            return 401, {"name": "AUTHENTICATION_FAILURE"}
+        self.verified.append(json.loads(body)["webhook_event"]["id"])
+        return 200, {"verification_status": self.verification_status}
+
+
+def parse_args(argv: list):
+    parser = argparse.ArgumentParser(description="Локальная заглушка PayPal с записанными вебхуками")
+    parser.add_argument("--webhook-url", required=True, help="адрес PAYPAL_WEBHOOK_PATH бота")
+    parser.add_argument("--order-id", default=RECORDED_ORDER_ID, help="заказ, созданный ботом через /pay")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089, help="порт заглушки для PAYPAL_API_URL")
+    parser.add_argument("--repeat", type=int, default=1, help="сколько раз доставить каждое событие")
+    parser.add_argument("--verification", default="SUCCESS", choices=("SUCCESS", "FAILURE"))
+    return parser.parse_args(argv)
+
+
+async def serve_and_replay(args):
+    bot = load_bot()
+    http = bot.HttpServer(args.host, args.port)
+    PayPalStandIn(http, args.verification)
+    await http.start()
+    try:
+        for event_type, status, text in await replay(args.webhook_url, load_events(args.order_id), args.repeat):
+            print(f"{event_type}: {status} {text}")
+    finally:
+        await http.stop()
+
+
+def main(argv: list = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve_and_replay(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import asyncio
+import importlib.util
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+# Каждый тест получает свежую копию модуля бота в своем временном каталоге:
+# состояние бота живет в атрибутах классов, а файлы БД и журналов — в cwd.
+# Системные команды идут через DryRunRunner
+
+
+def load_bot():
+    spec = importlib.util.spec_from_file_location("bot", ROOT / "bot(fixed).py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    module = load_bot()
+    module.PROVISION_RUNNER = "dry"
+    return module
+
+
+class Message:
+    # Входящее сообщение хендлера: ответы копятся в replies
+    def __init__(self, user_id: int, text: str):
+        self.from_user = types.SimpleNamespace(id=user_id, username=f"user{user_id}")
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        await asyncio.sleep(0)
+        self.replies.append(text)
+
+
+@pytest.fixture
+def command():
+    # command(user_id, "coupon", "CODE") -> (update, context) для CommandHandler
+    def make(user_id: int, name: str, *args):
+        update = types.SimpleNamespace(message=Message(user_id, " ".join((f"/{name}",) + args)))
+        return update, types.SimpleNamespace(args=list(args), user_data={})
+    return make
+
+
+@pytest.fixture
+def restart(bot):
+    # "Перезапуск процесса": свежая копия модуля поверх файлов в том же каталоге
+    def start():
+        module = load_bot()
+        module.DB_ENGINE = bot.DB_ENGINE
+        module.PROVISION_RUNNER = "dry"
+        module.Database.open()
+        return module
+    return start
@@ -0,0 +1,34 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+# Пул заранее созданных аккаунтов на DryRunRunner: истекшие аккаунты
+# возвращаются в пул вместо useradd, но не те, чье имя снова занято
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def bot(bot, request):
+    bot.DB_ENGINE = request.param
+    bot.POOL_SIZE = 1
+    bot.Database.open()
+    return bot
+
+
+def test_name_taken_again_is_not_recycled(bot):
+    runner = bot.Provisioner.runner()
+    bot.Database.update_user(bot.UserRecord(user_id=5, ssh_name="vpn5", expire_at=datetime.now() + timedelta(days=3)))
+    assert bot.Database.get_user_by_ssh_name("vpn5").user_id == 5
+    assert bot.Database.get_user_by_ssh_name("") is None
+
+    async def scenario():
+        bot.AccountPool._expired["local"].append("vpn5")
+        await asyncio.gather(*bot.AccountPool.refill("local"))
+        with pytest.raises(RuntimeError):
+            await bot.AccountPool.recycle_account("local", "vpn5")
+
+    asyncio.run(scenario())
+    assert not bot.AccountPool._expired["local"]
+    assert list(bot.AccountPool._ready["local"]) == ["vpnp00001"]
+    assert runner.commands[0] == ("sudo", "useradd", "-m", "-s", bot.PROVISION_SHELL, "vpnp00001")
+    assert not any("vpn5" in cmd for cmd in runner.commands)
@@ -0,0 +1,76 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+# /cancel iKnowWhatIamDoing снимает подписку тем же путем, что и истечение:
+# блокировка, перенос домашнего каталога, удаление из БД, освобождение узла
+
+
+@pytest.fixture
+def bot(bot):
+    bot.Fleet.configure([{"name": "node-a", "transport": "dry"}])
+    bot.Database.open()
+    return bot
+
+
+async def provisioned(bot, user_id: int):
+    bot.Database.update_user(bot.UserRecord(user_id=user_id, expire_at=datetime.now() + timedelta(days=10)))
+    await bot.Provisioner.provision(user_id)
+    return bot.Database.get_user(user_id)
+
+
+def test_cancel_needs_confirmation(bot, command):
+    async def scenario():
+        await provisioned(bot, 5)
+        update, context = command(5, "cancel")
+        await bot.cancel(update, context)
+        return update.message.replies
+
+    assert asyncio.run(scenario()) == [bot.I18n.t(5, "cancel_confirm")]
+    assert bot.Database.get_user(5).ssh_name == "vpn5"
+
+
+def test_cancel_tears_down_account(bot, command):
+    node = bot.Fleet.node("node-a")
+
+    async def scenario():
+        await provisioned(bot, 5)
+        assert node.load == 1
+        node.runner.commands.clear()
+        update, context = command(5, "cancel", "iKnowWhatIamDoing")
+        await bot.cancel(update, context)
+        return update.message.replies
+
+    assert asyncio.run(scenario()) == [bot.I18n.t(5, "cancel_done")]
+    assert bot.Database.get_user(5) is None
+    assert node.load == 0
+    archive = bot.Provisioner.archive_dir("vpn5")
+    assert node.runner.commands[0] == ("sudo", "usermod", "-p", "!", "vpn5")
+    assert ("sudo", "mv", "/home/vpn5", archive) in node.runner.commands
+    assert node.runner.commands[-1] == ("sudo", "tee", f"{archive}/user_info.json")
+
+
+def test_cancel_keeps_access_renewed_mid_teardown(bot, command):
+    node = bot.Fleet.node("node-a")
+
+    class SlowRunner(bot.DryRunRunner):
+        async def run(self, cmd, input=None):
+            await asyncio.sleep(0.02)
+            return await super().run(cmd, input)
+
+    async def scenario():
+        await provisioned(bot, 5)
+        node.runner = SlowRunner()
+        update, context = command(5, "cancel", "iKnowWhatIamDoing")
+        task = asyncio.create_task(bot.cancel(update, context))
+        await asyncio.sleep(0.05)
+        bot.activate_subscription(5, "1m", datetime.now() + timedelta(days=40))
+        await task
+        return update.message.replies
+
+    assert asyncio.run(scenario()) == [bot.I18n.t(5, "cancel_renewed")]
+    user = bot.Database.get_user(5)
+    assert user.ssh_name == "vpn5" and user.provisioned_at is None
+    assert node.load == 1
+    assert node.runner.commands[-1] == ("sudo", "mv", bot.Provisioner.archive_dir("vpn5"), "/home/vpn5")
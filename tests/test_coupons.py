@@ -0,0 +1,84 @@
+import asyncio
+import threading
+
+import pytest
+
+# Погашение купона с ограниченным количеством: всплеск одновременных
+# /coupon от разных пользователей дает ровно quantity успехов
+
+LIMIT = 7
+USERS = 50
+
+
+@pytest.fixture(params=["json", "journal", "sqlite"])
+def bot(bot, request):
+    default_data = bot.Database.default_data
+
+    def limited_data():
+        data = default_data()
+        data["coupons"]["burst"] = {"quantity": LIMIT, "TimeLength": "1w"}
+        return data
+
+    bot.Database.default_data = staticmethod(limited_data)
+    bot.DB_ENGINE = request.param
+    bot.Database.open()
+    return bot
+
+
+async def redeem_all(bot, command, user_ids):
+    calls = [command(user_id, "coupon", "BURST") for user_id in user_ids]
+    await asyncio.gather(*(bot.coupon(update, context) for update, context in calls))
+    return [update.message.replies for update, _ in calls]
+
+
+def test_concurrent_redemptions_stop_at_limit(bot, command):
+    replies = asyncio.run(redeem_all(bot, command, range(1, USERS + 1)))
+
+    redeemed = [user_id for user_id, reply in zip(range(1, USERS + 1), replies) if reply[0].startswith("🎁")]
+    assert len(redeemed) == LIMIT
+    assert all(bot.Database.get_user(user_id).expire_at for user_id in redeemed)
+    assert bot.Database.get_coupons()["burst"]["quantity"] == 0
+    assert sorted(map(int, bot.Database.get_coupons()["burst"]["redeemed_by"])) == redeemed
+
+
+def test_one_redemption_per_user(bot, command):
+    replies = asyncio.run(redeem_all(bot, command, [5] * 10))
+
+    assert sum(reply[0].startswith("🎁") for reply in replies) == 1
+    assert bot.Database.get_coupons()["burst"]["quantity"] == LIMIT - 1
+
+
+def test_sqlite_connections_race_without_db_lock(bot):
+    # Разные соединения в потоках: атомарность дает сама транзакция SQLite
+    if bot.DB_ENGINE != "sqlite":
+        pytest.skip("отдельные соединения есть только у sqlite")
+    barrier = threading.Barrier(8)
+    results = []
+
+    def worker(first_user: int):
+        storage = bot.SqliteStorage()
+        storage.db().execute("PRAGMA busy_timeout = 5000")
+        barrier.wait()
+        for user_id in range(first_user, first_user + USERS):
+            results.append(storage.redeem_coupon("burst", user_id)[1])
+
+    threads = [threading.Thread(target=worker, args=(i * 1000,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(result is not None for result in results) == LIMIT
+    assert bot.Database.get_coupons()["burst"]["quantity"] == 0
+
+
+def test_code_list_only_for_admins(bot, command):
+    bot.ADMIN_IDS = {1}
+    admin, admin_context = command(1, "coupon")
+    user, user_context = command(2, "coupon")
+    asyncio.run(bot.coupon(admin, admin_context))
+    asyncio.run(bot.coupon(user, user_context))
+
+    assert "burst" in admin.message.replies[0]
+    assert "burst" not in user.message.replies[0]
+    assert user.message.replies == [bot.I18n.t(2, "coupon_usage")]
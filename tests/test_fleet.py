@@ -0,0 +1,72 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+# Флот из фейковых узлов "dry": размещение на наименее загруженном узле,
+# команды уходят в транспорт своего узла, истечение освобождает место
+
+
+@pytest.fixture
+def bot(bot):
+    bot.Fleet.configure([
+        {"name": "big", "capacity": 2, "transport": "dry", "host": "10.0.0.1"},
+        {"name": "small", "capacity": 1, "transport": "dry", "host": "10.0.0.2", "port": 2222}
+    ])
+    bot.Database.open()
+    return bot
+
+
+def subscribe(bot, user_id: int):
+    bot.Database.update_user(bot.UserRecord(user_id=user_id, expire_at=datetime.now() + timedelta(days=30)))
+
+
+def test_least_loaded_placement_and_capacity(bot):
+    for user_id in (1, 2, 3, 4):
+        subscribe(bot, user_id)
+
+    async def scenario():
+        for user_id in (1, 2, 3):
+            await bot.Provisioner.provision(user_id)
+        with pytest.raises(RuntimeError):
+            await bot.Provisioner.provision(4)
+
+    asyncio.run(scenario())
+    placement = {user_id: bot.Database.get_user(user_id).server for user_id in (1, 2, 3)}
+    assert placement == {1: "big", 2: "small", 3: "big"}
+    assert [node.load for node in bot.Fleet.nodes()] == [2, 1]
+    assert bot.Fleet.endpoints(bot.Database.get_user(2)) == [("10.0.0.2", 2222)]
+
+    big, small = bot.Fleet.node("big").runner, bot.Fleet.node("small").runner
+    assert {cmd[-1] for cmd in big.commands if cmd[1] == "useradd"} == {"vpn1", "vpn3"}
+    assert {cmd[-1] for cmd in small.commands if cmd[1] == "useradd"} == {"vpn2"}
+    assert bot.Provisioner.runner().commands == []
+
+
+def test_expiry_releases_node_and_count_matches_db(bot):
+    for user_id in (1, 2):
+        subscribe(bot, user_id)
+    small = bot.Fleet.node("small")
+
+    async def scenario():
+        for user_id in (1, 2):
+            await bot.Provisioner.provision(user_id)
+        user = bot.Database.get_user(2)
+        user.expire_at = datetime.now() - timedelta(minutes=1)
+        bot.Database.update_user(user)
+        small.runner.commands.clear()
+        return await bot.expire_users([bot.Database.get_user(2)])
+
+    assert asyncio.run(scenario()) == []
+    assert small.load == 0
+    assert small.runner.commands[0] == ("sudo", "usermod", "-p", "!", "vpn2")
+    assert not any("vpn2" in cmd for cmd in bot.Fleet.node("big").runner.commands)
+
+    loads = [node.load for node in bot.Fleet.nodes()]
+    bot.Fleet.count()
+    assert [node.load for node in bot.Fleet.nodes()] == loads == [1, 0]
+
+    # Освободившееся место снова занимается
+    subscribe(bot, 3)
+    asyncio.run(bot.Provisioner.provision(3))
+    assert bot.Database.get_user(3).server == "small"
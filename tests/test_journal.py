@@ -0,0 +1,70 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+# Журналируемое JSON-хранилище: падение между поколениями журнала или с
+# оборванной последней строкой не теряет и не дублирует изменения
+
+
+@pytest.fixture
+def bot(bot):
+    bot.DB_ENGINE = "journal"
+    bot.Database.open()
+    return bot
+
+
+def add_users(bot, user_ids):
+    for user_id in user_ids:
+        bot.Database.update_user(bot.UserRecord(user_id=user_id, expire_at=datetime.now() + timedelta(days=user_id)))
+
+
+def user_ids(bot):
+    return sorted(bot.Database.get_user_ids())
+
+
+def test_journal_tail_replayed_after_kill(bot, restart):
+    add_users(bot, range(1, 6))
+    bot.Database.remove_user(3)
+
+    restarted = restart()
+    assert user_ids(restarted) == [1, 2, 4, 5]
+    assert restarted.Database.get_user(5).expire_at.date() == (datetime.now() + timedelta(days=5)).date()
+
+
+def test_kill_after_rotation_before_snapshot(bot, restart):
+    engine = bot.Database.engine()
+    add_users(bot, range(1, 4))
+    old_generation, _ = engine.rotate()
+    # Новое поколение уже принимает записи, снимок записать не успели
+    add_users(bot, range(4, 6))
+    assert os.path.exists(engine.journal_path(old_generation))
+
+    restarted = restart()
+    assert user_ids(restarted) == [1, 2, 3, 4, 5]
+    restarted_engine = restarted.Database.engine()
+    assert restarted_engine.journal_generations() == [restarted_engine._generation]
+
+
+def test_kill_after_snapshot_before_old_journal_removed(bot, restart):
+    engine = bot.Database.engine()
+    add_users(bot, range(1, 4))
+    old_generation, payload = engine.rotate()
+    engine.write_atomic(payload, engine.next_seq())
+    bot.Database.remove_user(1)
+
+    restarted = restart()
+    assert user_ids(restarted) == [2, 3]
+    assert old_generation not in restarted.Database.engine().journal_generations()
+
+
+def test_torn_last_record_is_skipped(bot, restart):
+    engine = bot.Database.engine()
+    add_users(bot, range(1, 4))
+    with open(engine.journal_path(engine._generation), 'ab') as f:
+        f.write(b'{"op": "user", "v": {"user_id": 9')
+
+    restarted = restart()
+    assert user_ids(restarted) == [1, 2, 3]
+    add_users(restarted, [7])
+    assert user_ids(restart()) == [1, 2, 3, 7]
@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+# Журнал платежей пишется раньше БД: падение после записи в payments.log, но
+# до сброса БД, при старте дает ровно одну активацию подписки
+
+
+class Crash(BaseException):
+    pass
+
+
+@pytest.fixture(params=["json", "journal", "sqlite"])
+def bot(bot, request):
+    bot.DB_ENGINE = request.param
+    bot.Database.open()
+    return bot
+
+
+def captured_order(bot, user_id: int, order_id: str):
+    bot.PaymentStateMachine.create(user_id, order_id, "1m", 2)
+    bot.PaymentStateMachine.transition(order_id, "CAPTURED", "test")
+
+
+def crash_after_log(bot, target: str):
+    # Процесс умирает сразу после fsync записи о переходе в target
+    append = bot.PaymentLog.append
+
+    def append_then_crash(log, record):
+        append(log, record)
+        if record["to"] == target:
+            raise Crash()
+
+    bot.PaymentLog.append = append_then_crash
+
+
+def days_left(user):
+    return (user.expire_at - datetime.now()) / timedelta(days=1)
+
+
+def test_crash_between_log_and_db_activates_once(bot, restart):
+    captured_order(bot, 42, "ORDER1")
+    crash_after_log(bot, "ACTIVATED")
+    with pytest.raises(Crash):
+        bot.PaymentStateMachine.activate("ORDER1", "test")
+
+    for _ in range(2):
+        restarted = restart()
+        restarted.PaymentStateMachine.recover()
+        assert restarted.Database.get_payment("ORDER1").status == "ACTIVATED"
+        assert 29.9 < days_left(restarted.Database.get_user(42)) <= 30
+        # Уже активированный заказ повторно не активируется
+        assert not restarted.PaymentStateMachine.activate("ORDER1", "test")
+
+
+def test_flushed_activation_is_not_replayed(bot, restart):
+    bot.Database.update_user(bot.UserRecord(user_id=42, expire_at=datetime.now() + timedelta(days=10)))
+    captured_order(bot, 42, "ORDER1")
+    assert bot.PaymentStateMachine.activate("ORDER1", "test")
+    # Сброс БД прошел, а отложенный журнал удалить не успели
+    bot.PaymentStateMachine.log().rotate()
+    assert bot.Database.flush()
+
+    restarted = restart()
+    restarted.PaymentStateMachine.recover()
+    assert 39.9 < days_left(restarted.Database.get_user(42)) <= 40
+
+
+def test_cancelled_subscription_stays_cancelled(bot, restart):
+    captured_order(bot, 42, "ORDER1")
+    bot.PaymentStateMachine.activate("ORDER1", "test")
+    bot.Database.remove_user(42)
+    assert bot.Database.flush()
+
+    restarted = restart()
+    restarted.PaymentStateMachine.recover()
+    assert restarted.Database.get_user(42) is None
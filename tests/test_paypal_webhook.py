@@ -0,0 +1,99 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+import paypal_standin
+
+# Вебхук PayPal против локальной заглушки: записанные события доставляются
+# по HTTP дважды, бот проверяет подпись у заглушки, повтор отбрасывается,
+# а списание продлевает подписку
+
+
+@pytest.fixture
+def bot(bot):
+    bot.DB_ENGINE = "json"
+    bot.PAYPAL_WEBHOOK_ID = "standin"
+    bot.PAYPAL_WEBHOOK_VERIFY = True
+    bot.Database.open()
+    return bot
+
+
+async def deliver(bot, events, verification: str = "SUCCESS", repeat: int = 2):
+    standin_http = bot.HttpServer("127.0.0.1", 0)
+    standin = paypal_standin.PayPalStandIn(standin_http, verification)
+    bot_http = bot.HttpServer("127.0.0.1", 0)
+    bot.PayPalWebhook(None, bot_http)
+    await standin_http.start()
+    await bot_http.start()
+    bot.PAYPAL_API_URL = f"http://127.0.0.1:{standin_http.port}"
+    try:
+        url = f"http://127.0.0.1:{bot_http.port}{bot.PAYPAL_WEBHOOK_PATH}"
+        return standin, await paypal_standin.replay(url, events, repeat)
+    finally:
+        await bot.PayPalClient.close()
+        await bot_http.stop()
+        await standin_http.stop()
+
+
+def test_replayed_events_activate_once(bot):
+    order_id = paypal_standin.RECORDED_ORDER_ID
+    bot.PaymentStateMachine.create(42, order_id, "1m", 2)
+    events = paypal_standin.load_events()
+
+    standin, results = asyncio.run(deliver(bot, events))
+
+    assert results == [
+        ("CHECKOUT.ORDER.APPROVED", 200, "ok"),
+        ("CHECKOUT.ORDER.APPROVED", 200, "duplicate"),
+        ("PAYMENT.CAPTURE.COMPLETED", 200, "ok"),
+        ("PAYMENT.CAPTURE.COMPLETED", 200, "duplicate")
+    ]
+    # Повторная доставка отсеяна до проверки подписи
+    assert standin.verified == [event["id"] for event in events]
+    assert bot.Database.get_payment(order_id).status == "ACTIVATED"
+    user = bot.Database.get_user(42)
+    assert user.plan == "1m"
+    assert abs(user.expire_at - (datetime.now() + timedelta(days=30))) < timedelta(minutes=1)
+
+
+def test_failed_verification_is_not_remembered(bot):
+    order_id = "3C679366HH908993F"
+    bot.PaymentStateMachine.create(7, order_id, "1m", 2)
+    events = paypal_standin.load_events(order_id)
+
+    _, results = asyncio.run(deliver(bot, events, verification="FAILURE", repeat=1))
+    assert [status for _, status, _ in results] == [403, 403]
+    assert bot.Database.get_payment(order_id).status == "CREATED"
+    assert bot.Database.get_user(7) is None
+
+    # Подлинная доставка тех же событий после отказа проходит
+    _, results = asyncio.run(deliver(bot, events, repeat=1))
+    assert [status for _, status, _ in results] == [200, 200]
+    assert bot.Database.get_payment(order_id).status == "ACTIVATED"
+    assert bot.Database.get_user(7).expire_at > datetime.now() + timedelta(days=29)
+
+
+def test_malformed_events_answer_400(bot):
+    approved, captured = paypal_standin.load_events()
+    bodies = [b"[1,2]", b"null", json.dumps(dict(approved, id=["x"])).encode()]
+    bodies += [json.dumps(dict(approved, resource=value)).encode() for value in (None, "x", [1])]
+    bodies += [
+        json.dumps(dict(captured, resource=dict(captured["resource"], supplementary_data=value))).encode()
+        for value in (None, "x", {"related_ids": "x"}, {"related_ids": {"order_id": {"id": 1}}})
+    ]
+
+    async def post_all():
+        http = bot.HttpServer("127.0.0.1", 0)
+        bot.PayPalWebhook(None, http)
+        await http.start()
+        try:
+            async with httpx.AsyncClient() as client:
+                url = f"http://127.0.0.1:{http.port}{bot.PAYPAL_WEBHOOK_PATH}"
+                return [(await client.post(url, content=body)).status_code for body in bodies]
+        finally:
+            await http.stop()
+
+    assert asyncio.run(post_all()) == [400] * len(bodies)
@@ -0,0 +1,113 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+# Конвейер создания аккаунтов на DryRunRunner: записанные команды, повтор
+# после сбоя доводит тот же аккаунт, параллельность ограничена
+
+
+@pytest.fixture
+def bot(bot):
+    bot.PROVISION_RETRY_DELAY = 0
+    bot.Database.open()
+    return bot
+
+
+def subscribe(bot, user_id: int, days: int = 30):
+    bot.Database.update_user(bot.UserRecord(user_id=user_id, expire_at=datetime.now() + timedelta(days=days)))
+
+
+def test_provision_records_commands_and_credentials(bot):
+    bot.PROVISION_QUOTA_KB = 1024
+    subscribe(bot, 7)
+    asyncio.run(bot.Provisioner.provision(7))
+
+    user = bot.Database.get_user(7)
+    assert user.ssh_name == "vpn7" and len(user.ssh_password) == 16
+    assert user.provisioned_at is not None
+    assert bot.Provisioner.runner().commands == [
+        ("sudo", "useradd", "-m", "-s", bot.PROVISION_SHELL, "vpn7"),
+        ("sudo", "chpasswd"),
+        ("sudo", "install", "-d", "-m", "700", "-o", "vpn7", "-g", "vpn7", "/home/vpn7"),
+        ("sudo", "setquota", "-u", "vpn7", "1024", "1024", "0", "0", "-a")
+    ]
+
+
+def test_retry_after_failure_finishes_same_account(bot):
+    runner = bot.Provisioner.runner()
+    runner.returncodes = {"install": 1}
+    subscribe(bot, 7)
+    with pytest.raises(RuntimeError):
+        asyncio.run(bot.Provisioner.provision(7))
+
+    failed = bot.Database.get_user(7)
+    credentials = (failed.ssh_name, failed.ssh_password)
+    assert failed.provisioned_at is None
+    assert runner.commands.count(("sudo", "install", "-d", "-m", "700", "-o", "vpn7", "-g", "vpn7", "/home/vpn7")) == bot.PROVISION_RETRIES
+
+    runner.returncodes = {}
+    runner.commands.clear()
+    asyncio.run(bot.Provisioner.provision(7))
+    user = bot.Database.get_user(7)
+    assert (user.ssh_name, user.ssh_password) == credentials
+    assert user.provisioned_at is not None
+    assert runner.commands[0] == ("sudo", "useradd", "-m", "-s", bot.PROVISION_SHELL, "vpn7")
+    assert bot.Fleet.node().load == 1
+
+    # Уже созданный аккаунт повторно не трогается
+    runner.commands.clear()
+    asyncio.run(bot.Provisioner.provision(7))
+    assert runner.commands == []
+
+
+def test_queue_bounds_parallel_commands(bot):
+    bot.PROVISION_CONCURRENCY = 2
+
+    class CountingRunner(bot.DryRunRunner):
+        active = peak = 0
+
+        async def run(self, cmd, input=None):
+            CountingRunner.active += 1
+            CountingRunner.peak = max(CountingRunner.peak, CountingRunner.active)
+            await asyncio.sleep(0.01)
+            CountingRunner.active -= 1
+            return await super().run(cmd, input)
+
+    bot.Provisioner._runner = CountingRunner()
+    for user_id in range(1, 7):
+        subscribe(bot, user_id)
+
+    async def scenario():
+        bot.Provisioner.start()
+        await bot.Provisioner._queue.join()
+        await bot.Provisioner.stop()
+
+    asyncio.run(scenario())
+    assert all(bot.Database.get_user(user_id).provisioned_at for user_id in range(1, 7))
+    assert CountingRunner.peak == 2
+
+
+def test_expiry_deactivates_provisioned_account(bot):
+    subscribe(bot, 7)
+    runner = bot.Provisioner.runner()
+
+    async def scenario():
+        await bot.Provisioner.provision(7)
+        user = bot.Database.get_user(7)
+        user.expire_at = datetime.now() - timedelta(minutes=1)
+        bot.Database.update_user(user)
+        runner.commands.clear()
+        return await bot.expire_users([bot.Database.get_user(7)])
+
+    assert asyncio.run(scenario()) == []
+    archive = bot.Provisioner.archive_dir("vpn7")
+    assert runner.commands == [
+        ("sudo", "usermod", "-p", "!", "vpn7"),
+        ("mkdir", "-p", archive.rsplit("/", 1)[0]),
+        ("test", "-d", "/home/vpn7"),
+        ("sudo", "mv", "/home/vpn7", archive),
+        ("sudo", "tee", f"{archive}/user_info.json")
+    ]
+    assert bot.Database.get_user(7) is None
+    assert bot.Fleet.node().load == 0
@@ -0,0 +1,70 @@
+import asyncio
+import json
+
+import pytest
+
+# Фоновая сверка платежей: старые записи без created_at истекают, а заказ,
+# активированный параллельно через /check_payment, не уведомляется дважды
+
+
+@pytest.fixture
+def bot(bot):
+    bot.DB_ENGINE = "json"
+    return bot
+
+
+@pytest.fixture
+def paypal(bot):
+    calls = []
+
+    async def get_order_details(order_id):
+        calls.append(order_id)
+        return {"id": order_id, "status": "COMPLETED"}
+
+    bot.PayPalClient.get_order_details = get_order_details
+    return calls
+
+
+def test_payment_without_created_at_expires(bot, paypal):
+    data = bot.Database.default_data()
+    data["payments"] = {"LEGACY1": {"user_id": 42, "plan": "1m", "amount": 2, "currency": "EUR", "status": "CREATED"}}
+    with open(bot.DB_FILE, "w") as f:
+        json.dump(data, f)
+    bot.Database.open()
+
+    asyncio.run(bot.PaymentReconciler.run_once())
+    assert bot.Database.get_payment("LEGACY1").status == "EXPIRED"
+    assert paypal == []
+    assert bot.Database.get_pending_payments() == {}
+
+
+def test_order_activated_concurrently_is_notified_once(bot, paypal, command):
+    bot.Database.open()
+    bot.PaymentStateMachine.create(42, "ORDER1", "1m", 2)
+
+    async def scenario():
+        pending = bot.Database.get_pending_payments()
+        update, context = command(42, "check_payment", "ORDER1")
+        await bot.check_payment(update, context)
+        queued = bot.Outbox.depth()
+        await bot.PaymentReconciler.check("ORDER1", pending["ORDER1"])
+        return update.message.replies, queued
+
+    replies, queued = asyncio.run(scenario())
+    assert replies == [bot.I18n.t(42, "check_completed", plan="1m")]
+    assert bot.Outbox.depth() == queued
+    assert paypal == ["ORDER1"]
+    assert bot.Database.get_payment("ORDER1").status == "ACTIVATED"
+
+
+def test_reconciler_notifies_when_it_activates(bot, paypal):
+    bot.Database.open()
+    bot.PaymentStateMachine.create(42, "ORDER1", "1m", 2)
+
+    async def scenario():
+        before = bot.Outbox.depth()
+        await bot.PaymentReconciler.run_once()
+        return bot.Outbox.depth() - before
+
+    assert asyncio.run(scenario()) == 1
+    assert bot.Database.get_payment("ORDER1").status == "ACTIVATED"
@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+import httpx
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from telegram.request import BaseRequest
+
+# Вебхук Telegram офлайн: синтетические Update JSON по HTTP в настоящее
+# приложение с PerUserUpdateProcessor, Bot API подменен заглушкой
+
+
+class FakeRequest(BaseRequest):
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        result = {"id": 1, "is_bot": True, "first_name": "test", "username": "test_bot"}
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def update_json(update_id: int):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": update_id, "type": "private"},
+            "from": {"id": update_id, "is_bot": False, "first_name": "Test"},
+            "text": "hello"
+        }
+    }
+
+
+async def saturate(bot):
+    bot.WEBHOOK_QUEUE_SIZE = 5
+    release = asyncio.Event()
+    handled = []
+
+    async def slow_handler(update, context):
+        await release.wait()
+        handled.append(update.update_id)
+
+    application = (
+        Application.builder().token("1:TEST").request(FakeRequest()).updater(None)
+        .concurrent_updates(bot.PerUserUpdateProcessor(2)).build()
+    )
+    application.add_handler(TypeHandler(Update, slow_handler))
+    http = bot.HttpServer("127.0.0.1", 0)
+    bot.WebhookServer(application, http)
+    await application.initialize()
+    await application.start()
+    await http.start()
+    base = f"http://127.0.0.1:{http.port}"
+    try:
+        async with httpx.AsyncClient(base_url=base) as client:
+            flood = [
+                (await client.post(bot.WEBHOOK_PATH, json=update_json(i))).status_code
+                for i in range(1, 31)
+            ]
+            bad = [
+                (await client.post(bot.WEBHOOK_PATH, content=body)).status_code
+                for body in (b"[1,2]", b"not json", b"{}")
+            ]
+            health = (await client.get("/healthz")).json()
+            release.set()
+            for _ in range(100):
+                if len(handled) == 5 and application.update_processor.pending() == 0:
+                    break
+                await asyncio.sleep(0.01)
+            after = (await client.post(bot.WEBHOOK_PATH, json=update_json(100))).status_code
+            await asyncio.sleep(0.05)
+    finally:
+        await http.stop()
+        await application.stop()
+        await application.shutdown()
+    return flood, bad, health, sorted(handled), after
+
+
+def test_webhook_answers_503_when_saturated(bot):
+    flood, bad, health, handled, after = asyncio.run(saturate(bot))
+
+    assert flood == [200] * 5 + [503] * 25
+    assert bad == [400, 400, 400]
+    assert health == {"status": "ok", "queue_size": 5, "queue_limit": 5}
+    assert handled == [1, 2, 3, 4, 5, 100]
+    assert after == 200